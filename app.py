@@ -1,17 +1,23 @@
 import streamlit as st
 import pandas as pd
-import requests
+import numpy as np
 import folium
 from streamlit_folium import st_folium
-from ortools.constraint_solver import routing_enums_pb2
-from ortools.constraint_solver import pywrapcp
 from haversine import haversine, Unit
 import io
 import datetime
 import re
 import time 
 import urllib.parse
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
 import openpyxl 
+from motor_vrp import resolver_camino, resolver_flota, matriz_costo_flota, matriz_tiempo_con_espera, codificar_deptos, penalizacion_cruce_deptos, restricciones_recorrido, insertar_esporadicos, insertar_esporadicos_regret, mejorar_patron, zonas_balanceadas, cotas_flota, semilla_reparable, presupuesto_segundos, PESO_DEPTO_ZONAS_METROS, SEGUNDOS_MIN_POR_MODELO, FRACCION_PRESUPUESTO_REPARACION
+from red_ruteo import LimitadorTasa, Cortocircuito, ProveedorORS, ProveedorOSRM, ProveedorOffline, ProveedorConRespaldo, crear_sesion_http, calibrar_desde_cache, clave_coordenada, vaciar_cache_ruteo, obtener_matriz_masiva, obtener_matriz_dispersa, obtener_trazados_masivos, PERFIL_ORS, COSTO_INALCANZABLE
+from planillas import COLUMNAS_CRONOGRAMA, leer_planilla
 
 # --- CONFIGURACIÓN DE LA PÁGINA ---
 st.set_page_config(page_title="Gestor de Rutas Logísticas", layout="wide")
@@ -23,6 +29,28 @@ api_key_default = "5b3ce3597851110001cf62480080f4189d6143db946e7c7267b9343d"
 st.sidebar.header("🔑 Conexión OpenRouteService")
 api_key_user = st.sidebar.text_input("API Key propia (Solo si te quedas sin saldo diario)", type="password", help="Si te sale el error 'Quota exceeded', pega aquí tu propia API Key.")
 api_key = api_key_user if api_key_user else api_key_default
+motor_ruteo = st.sidebar.selectbox("🔌 Motor de ruteo:", ["OpenRouteService (nube)", "OpenRouteService propio (URL)", "OSRM propio (URL)", "Borrador offline (sin API)"], help="Un servidor propio en tu red responde matrices grandes en una sola consulta y sin cupo diario. El borrador offline estima distancias en línea recta para probar estrategias al instante.")
+config_motor = {"url": "", "max_locs": 1000, "factor_desvio": 1.3, "velocidad_kmh": 30.0, "calibrar": False}
+if motor_ruteo in ["OpenRouteService propio (URL)", "OSRM propio (URL)"]:
+    config_motor["url"] = st.sidebar.text_input("URL del servidor:", "http://localhost:8080/ors" if "OpenRouteService" in motor_ruteo else "http://localhost:5000")
+    config_motor["max_locs"] = st.sidebar.number_input("Máx. puntos por consulta de matriz:", min_value=2, max_value=10000, value=1000, step=50)
+elif motor_ruteo == "Borrador offline (sin API)":
+    config_motor["factor_desvio"] = st.sidebar.number_input("Factor de desvío por calles:", min_value=1.0, max_value=3.0, value=1.3, step=0.05, help="Cuánto más larga es la ruta real que la línea recta.")
+    config_motor["velocidad_kmh"] = st.sidebar.number_input("Velocidad promedio (km/h):", min_value=5.0, max_value=120.0, value=30.0, step=1.0)
+    config_motor["calibrar"] = st.sidebar.checkbox("Calibrar con distancias reales guardadas en caché", value=True)
+if motor_ruteo != "Borrador offline (sin API)":
+    config_motor["respaldo_offline"] = st.sidebar.checkbox("🛟 Si el motor falla, seguir con distancias estimadas", value=True, help="Ante cupo agotado, caídas repetidas o plazo vencido, los tramos que falten se estiman en línea recta calibrada en vez de frenar el plan.")
+plazo_red_segundos = st.sidebar.number_input("⏱️ Espera máxima de red por plan (seg)", min_value=30, max_value=3600, value=300, step=30)
+plazo_optimizacion_segundos = st.sidebar.number_input("🧮 Tiempo máximo de optimización por plan (seg)", min_value=5, max_value=3600, value=120, step=5, help="Se reparte entre todas las rutas, días y departamentos del plan según su tamaño.")
+# k de la heurística de inyección de esporádicos (Patrón Fijo): 1 = más barata en el orden de la planilla; 2 o más = regret-k
+HEURISTICAS_INYECCION = {"⚡ Más barata, en orden de planilla": 1, "🧠 Regret-2 (menos autos)": 2, "🧠 Regret-3": 3}
+FUENTES_ARRANQUE = ["🔁 Plan anterior (si existe)", "📄 Orden del Excel (Ruta + Orden)", "✨ Desde cero"]
+fuente_arranque = st.sidebar.selectbox("Punto de partida del optimizador", FUENTES_ARRANQUE, help="Con rutas conocidas el optimizador arranca desde ellas: converge antes y se aleja poco de lo que ya funciona. Si no son válidas para las restricciones actuales, se arranca desde cero.")
+reoptimizacion_incremental = st.sidebar.checkbox("⚡ Reoptimización incremental", value=True, help="Si el punto de partida ya cubre casi todas las paradas (cambiaron pocas), se reparan esas rutas quitando las bajas e insertando las altas donde menos cuestan, con una búsqueda corta en vez de resolver todo de nuevo. Las distancias ya consultadas salen de la caché: solo se piden las de los puntos nuevos.")
+vecinos_dispersos = st.sidebar.number_input("🕸️ Vecinos con distancia real en planes grandes", min_value=0, max_value=200, value=0, step=5, help="0 = matriz completa. Con más de 300 puntos, solo se consultan al motor los tramos de cada parada con sus vecinos más cercanos (y todo lo que llega o sale del destino); el resto se estima en línea recta calibrada con esos mismos tramos reales, y el optimizador solo prueba esos vecinos como siguiente parada. Pasa de N² a N·k consultas.")
+segundos_sin_mejora = st.sidebar.number_input("Cortar una optimización si no mejora en (seg)", min_value=0.0, max_value=60.0, value=2.0, step=0.5, help="0 = usar siempre todo el tiempo asignado.")
+ors_peticiones_por_minuto = st.sidebar.number_input("Peticiones por minuto a ORS", min_value=1, max_value=1000, value=40, step=1, help="Cupo de tu plan de OpenRouteService. Las consultas grandes se reparten en paralelo sin superar este ritmo.")
+pedir_vaciar_cache = st.sidebar.button("🧹 Vaciar caché de distancias", help="Borra las distancias y tiempos guardados en disco. Úsalo si cambiaron calles o sentidos de circulación.")
 
 if 'calculo_terminado' not in st.session_state:
     st.session_state['calculo_terminado'] = False
@@ -59,19 +87,34 @@ if(panel) {
 # --- BARRA LATERAL: CARGA ---
 st.sidebar.markdown("---")
 st.sidebar.header("Carga de Datos")
-archivo_subido = st.sidebar.file_uploader("Sube tu archivo Excel", type=["xlsx", "xls"])
+archivo_subido = st.sidebar.file_uploader("Sube tu archivo Excel, CSV o Parquet", type=["xlsx", "xls", "csv", "parquet"])
 
 # --- FUNCIONES AUXILIARES ---
-def preparar_coordenadas(coord_str):
-    try:
-        partes = str(coord_str).split(',')
-        if len(partes) >= 2:
-            lat = float(partes[0].strip())
-            lon = float(partes[1].strip())
-            return [lon, lat]
-        return None
-    except Exception:
-        return None
+def preparar_coordenadas(serie_coordenadas):
+    # "lat, lon" -> columnas flotantes Lat/Lon de una sola pasada; lo que no se pueda leer queda en NaN
+    partes = serie_coordenadas.astype(str).str.split(',', n=2, expand=True).reindex(columns=[0, 1])
+    lat = pd.to_numeric(partes[0].str.strip(), errors='coerce')
+    lon = pd.to_numeric(partes[1].str.strip(), errors='coerce')
+    return lat.astype(float), lon.astype(float)
+
+def coordenadas_lon_lat(df_puntos):
+    return df_puntos[['Lon', 'Lat']].to_numpy().tolist()
+
+# --- CARGA DE LA PLANILLA: UNA LECTURA POR ARCHIVO, REUTILIZADA ENTRE RERUNS ---
+@st.cache_data(show_spinner="Leyendo el archivo...", max_entries=8)
+def cargar_planilla(huella_contenido, nombre_archivo, _contenido):
+    # La huella SHA-256 identifica el archivo: los reruns por widgets reutilizan el DataFrame ya procesado
+    df = leer_planilla(_contenido, nombre_archivo)
+    df.columns = df.columns.str.strip()
+
+    if 'Ruta' not in df.columns:
+        df['Ruta'] = "Sin Asignar"
+    df['Ruta'] = df['Ruta'].fillna("Sin Asignar")
+
+    if 'Coordenadas' not in df.columns:
+        df['Coordenadas'] = np.nan
+    df['Lat'], df['Lon'] = preparar_coordenadas(df['Coordenadas'])
+    return df.dropna(subset=['Lat', 'Lon']).copy()
 
 def limpiar_nombre_excel(nombre):
     return re.sub(r'[\\/*?:\[\]]', '_', str(nombre))[:31]
@@ -98,112 +141,256 @@ def dibujar_geozona_circular(coordenadas_lon_lat, nombre_capa, color, mapa, most
         ).add_to(capa)
         capa.add_to(mapa)
 
-# --- CONEXIÓN PURA BLINDADA CONTRA CAÍDAS ---
-def pedir_matriz_ors_con_reintento(body, headers):
-    for intento in range(5): 
+# --- RED DE RUTEO: SESIÓN, CUPOS Y CORTOCIRCUITOS COMPARTIDOS ENTRE RERUNS; ELECCIÓN DEL MOTOR ---
+@st.cache_resource
+def obtener_limitador_tasa(servicio, peticiones_por_minuto):
+    return LimitadorTasa(peticiones_por_minuto)
+
+@st.cache_resource
+def obtener_sesion_http():
+    return crear_sesion_http()
+
+@st.cache_resource
+def obtener_cortocircuito(servicio):
+    return Cortocircuito()
+
+def avisar_uso_respaldo(proveedor):
+    avisos = getattr(proveedor, 'avisos', None)
+    if avisos:
+        motivos = " ".join(sorted("Cupo de la API agotado." if a == "QUOTA_EXCEEDED" else a for a in avisos))
+        st.warning(f"⚠️ {motivos} Los tramos faltantes se estimaron en modo borrador offline y no se guardaron en la caché.")
+
+def crear_proveedor_ruteo(motor, config, api_key, peticiones_por_minuto):
+    proveedor = crear_proveedor_principal(motor, config, api_key, peticiones_por_minuto)
+    if config.get("respaldo_offline") and motor != "Borrador offline (sin API)":
+        return ProveedorConRespaldo(proveedor)
+    return proveedor
+
+def crear_proveedor_principal(motor, config, api_key, peticiones_por_minuto):
+    limites_propios = {"max_locaciones": int(config["max_locs"]), "max_celdas": int(config["max_locs"]) ** 2}
+    if motor == "Borrador offline (sin API)":
+        return ProveedorOffline(config["factor_desvio"], config["velocidad_kmh"])
+    if motor == "OSRM propio (URL)":
+        return ProveedorOSRM(config["url"], limites=limites_propios, sesion=obtener_sesion_http(), cortocircuito=obtener_cortocircuito(config["url"].rstrip('/')))
+    if motor == "OpenRouteService propio (URL)":
+        return ProveedorORS(config["url"], {'Content-Type': 'application/json'}, limites=limites_propios, clave_cache=f"ors-propio:{PERFIL_ORS}", sesion=obtener_sesion_http(), cortocircuito=obtener_cortocircuito(config["url"].rstrip('/')))
+    return ProveedorORS(
+        "https://api.openrouteservice.org", {'Authorization': api_key, 'Content-Type': 'application/json'},
+        limitador_matriz=obtener_limitador_tasa("matrix", peticiones_por_minuto),
+        limitador_trazado=obtener_limitador_tasa("directions", peticiones_por_minuto),
+        sesion=obtener_sesion_http(), cortocircuito=obtener_cortocircuito("https://api.openrouteservice.org")
+    )
+
+# --- MODO DISPERSO: SOLO EN PLANES GRANDES Y CON UN MOTOR DE RED ---
+UMBRAL_PUNTOS_DISPERSO = 300
+
+def matriz_es_dispersa(num_puntos, proveedor):
+    # Modo disperso activo y plan por encima del umbral de puntos (sin red no hay consultas que ahorrar)
+    return bool(vecinos_dispersos) and num_puntos > UMBRAL_PUNTOS_DISPERSO and not isinstance(proveedor, ProveedorOffline)
+
+def obtener_matriz_plan(lista_coords, proveedor, obligatorios=()):
+    if matriz_es_dispersa(len(lista_coords), proveedor):
+        return obtener_matriz_dispersa(lista_coords, proveedor, vecinos_dispersos, obligatorios)
+    return obtener_matriz_masiva(lista_coords, proveedor)
+
+def vecinos_del_modelo(dispersa):
+    # Todo modelo recortado de una matriz dispersa, aunque sea chico, solo prueba sus vecinos como siguiente parada:
+    # fuera de ellos las celdas son estimadas y el optimizador no debe apoyarse en ellas
+    return vecinos_dispersos if dispersa else None
+
+# --- REGISTRO DEL PLAN: UNA SOLA MATRIZ PARA TODOS LOS DÍAS Y UN RECORTE POR SUBPROBLEMA ---
+def matriz_del_plan(df_plan, proveedor, obligatorios=()):
+    # Cada coordenada única de todo el plan entra una sola vez; los días y departamentos recortan su parte sin volver a la red
+    posicion, unicas = {}, []
+    for pt in coordenadas_lon_lat(df_plan):
+        clave = clave_coordenada(pt)
+        if clave not in posicion:
+            posicion[clave] = len(unicas)
+            unicas.append(pt)
+    matriz_dist, matriz_dur, err = obtener_matriz_plan(unicas, proveedor, obligatorios) if len(unicas) > 1 else (np.zeros((1, 1), dtype=np.int64), np.zeros((1, 1), dtype=np.int64), None)
+    return {"posicion": posicion, "dist": matriz_dist, "dur": matriz_dur, "error": err, "dispersa": matriz_es_dispersa(len(unicas), proveedor)}
+
+def recortar_matriz(matriz_plan, lista_coords):
+    # Mismo contrato que obtener_matriz_masiva: (distancias, duraciones, error)
+    if matriz_plan["error"]:
+        return None, None, matriz_plan["error"]
+    idx = [matriz_plan["posicion"][clave_coordenada(pt)] for pt in lista_coords]
+    return matriz_plan["dist"][np.ix_(idx, idx)], matriz_plan["dur"][np.ix_(idx, idx)], None
+
+# --- RESOLUCIÓN EN PARALELO DE SUBPROBLEMAS INDEPENDIENTES (DÍAS, RUTAS, DEPARTAMENTOS) ---
+SOLVER_PROCESOS_MAX = max(1, int(os.environ.get("RUTEO_PROCESOS_SOLVER", os.cpu_count() or 1)))
+
+@st.cache_resource
+def obtener_pool_solver():
+    # "spawn": los procesos hijos solo importan motor_vrp, nunca re-ejecutan la app
+    return ProcessPoolExecutor(max_workers=SOLVER_PROCESOS_MAX, mp_context=multiprocessing.get_context("spawn"))
+
+def repartir_presupuesto(tareas, fin_optimizacion):
+    # Cada modelo pide tiempo según su tamaño; si no entra en lo que queda del plan, todos ceden en proporción
+    # (una reparación incremental solo necesita una búsqueda corta alrededor de la semilla)
+    pedidos = [presupuesto_segundos(len(kwargs["costo"])) * (FRACCION_PRESUPUESTO_REPARACION if kwargs.get("reparar") else 1.0) for _, kwargs in tareas]
+    if fin_optimizacion is None:
+        return pedidos
+    capacidad = max(0.0, fin_optimizacion - time.monotonic()) * min(SOLVER_PROCESOS_MAX, len(tareas))
+    factor = min(1.0, capacidad / sum(pedidos))
+    return [max(SEGUNDOS_MIN_POR_MODELO, p * factor) for p in pedidos]
+
+def semilla_cargable(kwargs):
+    # Una reparación solo cuenta (y solo recorta el presupuesto) si la semilla completada es una asignación válida del modelo
+    if "tiempo" in kwargs:
+        return semilla_reparable(kwargs["costo"], kwargs["rutas_iniciales"], kwargs["dummy_idx"], kwargs["end_idx"], tiempo=kwargs["tiempo"], tiempo_max=kwargs["tiempo_max"], num_vehiculos=kwargs.get("num_vehiculos"))
+    return semilla_reparable(kwargs["costo"], kwargs["rutas_iniciales"], kwargs["inicio"], kwargs["fin"], restricciones=kwargs.get("restricciones"))
+
+def resolver_subproblemas(tareas, etiqueta="Optimizando", fin_optimizacion=None, segundos_sin_mejora=None):
+    # tareas = [(funcion_de_motor_vrp, kwargs)]; los resultados vuelven en el orden de envío
+    resultados = [None] * len(tareas)
+    if not tareas:
+        return resultados
+    for _, kwargs in tareas:
+        if kwargs.get("reparar"):
+            kwargs["reparar"] = semilla_cargable(kwargs)
+    for (_, kwargs), segundos in zip(tareas, repartir_presupuesto(tareas, fin_optimizacion)):
+        kwargs["segundos_limite"] = segundos
+        kwargs["segundos_sin_mejora"] = segundos_sin_mejora
+    barra = st.progress(0.0, text=f"{etiqueta}: 0/{len(tareas)}")
+    resueltas = set()
+    if SOLVER_PROCESOS_MAX > 1 and len(tareas) > 1:
         try:
-            resp = requests.post('https://api.openrouteservice.org/v2/matrix/driving-car', json=body, headers=headers, timeout=70)
-            if resp.status_code == 200:
-                return resp.json(), None
-            elif "Quota" in resp.text or resp.status_code == 403:
-                return None, "QUOTA_EXCEEDED"
-            elif resp.status_code == 429 or "Rate limit" in resp.text:
-                time.sleep(60) 
-            elif resp.status_code >= 500 or "unknown" in resp.text.lower():
-                time.sleep(5)
-            else:
-                return None, resp.text
-        except requests.exceptions.RequestException:
-            time.sleep(5)
-    return None, "Superado el límite de reintentos. El servidor está caído temporalmente."
-
-def pedir_trazado_ors_con_reintento(body, headers):
-    for intento in range(5):
+            pool = obtener_pool_solver()
+            futuros = {pool.submit(funcion, **kwargs): i for i, (funcion, kwargs) in enumerate(tareas)}
+            for futuro in as_completed(futuros):
+                try:
+                    resultados[futuros[futuro]] = futuro.result()
+                except BrokenProcessPool:
+                    raise
+                except Exception:
+                    # Falló solo esta tarea (pickling, OR-Tools, semilla rara): se reintenta abajo en este proceso
+                    continue
+                resueltas.add(futuros[futuro])
+                barra.progress(len(resueltas) / len(tareas), text=f"{etiqueta}: {len(resueltas)}/{len(tareas)}")
+        except BrokenProcessPool:
+            # Si un proceso murió (memoria, señal), se descarta el pool y lo que falte se resuelve aquí mismo
+            obtener_pool_solver.clear()
+    fallidas = []
+    for i, (funcion, kwargs) in enumerate(tareas):
+        if i in resueltas: continue
         try:
-            resp = requests.post('https://api.openrouteservice.org/v2/directions/driving-car/geojson', json=body, headers=headers, timeout=70)
-            if resp.status_code == 200:
-                return resp.json(), None
-            elif "Quota" in resp.text or resp.status_code == 403:
-                return None, "QUOTA_EXCEEDED"
-            elif resp.status_code == 429 or "Rate limit" in resp.text:
-                time.sleep(60)
-            elif resp.status_code >= 500 or "unknown" in resp.text.lower():
-                time.sleep(5)
-            else:
-                return None, resp.text
-        except requests.exceptions.RequestException:
-            time.sleep(5)
-    return None, "Superado el límite de reintentos."
-
-def obtener_matriz_masiva(lista_coords, headers):
-    N = len(lista_coords)
-    if N <= 50:
-        body_matrix = {"locations": lista_coords, "metrics": ["distance", "duration"]}
-        data, err = pedir_matriz_ors_con_reintento(body_matrix, headers)
-        if data:
-            return data['distances'], data['durations'], None
-        return None, None, err
+            resultados[i] = funcion(**kwargs)
+        except Exception as e:
+            # Una tarea rota queda sin resultado (quien llama la trata como sin solución) y el resto del plan sigue
+            fallidas.append(f"{type(e).__name__}: {e}")
+        resueltas.add(i)
+        barra.progress(len(resueltas) / len(tareas), text=f"{etiqueta}: {len(resueltas)}/{len(tareas)}")
+    barra.empty()
+    if fallidas:
+        st.warning(f"⚠️ {len(fallidas)} de {len(tareas)} modelos fallaron y quedaron sin resolver ({fallidas[0]}). El resto del plan se calculó igual.")
+    reparados = sum(1 for _, kwargs in tareas if kwargs.get("reparar"))
+    if reparados:
+        st.caption(f"⚡ Reoptimización incremental: {reparados} de {len(tareas)} modelos se repararon sobre las rutas conocidas en vez de resolverse de nuevo.")
+    return resultados
+
+# --- ARRANQUE EN CALIENTE: RUTAS INICIALES DESDE EL PLAN ANTERIOR O EL ORDEN DEL EXCEL ---
+CAMBIOS_MAX_INCREMENTAL = 0.25
+
+def claves_parada(df_puntos):
+    # Una parada es la misma si coinciden nombre y coordenadas (~1 m): si se movió, cuenta como baja + alta
+    return list(zip(df_puntos['Lugar'].astype(str).str.strip(), df_puntos['Lat'].astype(float).round(5), df_puntos['Lon'].astype(float).round(5)))
+
+def recorridos_conocidos(fuente, df_origen, dia):
+    # {ruta: [claves de parada en orden]} de ese día
+    if fuente == FUENTES_ARRANQUE[0]:
+        recorridos = {}
+        for d in st.session_state.get('datos_resumen') or []:
+            if d['dia'] == dia and d['paradas']:
+                df_paradas = pd.DataFrame(d['paradas'])
+                df_paradas['Lat'], df_paradas['Lon'] = preparar_coordenadas(df_paradas['Coordenadas'])
+                recorridos[d['ruta']] = claves_parada(df_paradas)
+        return recorridos
+    if fuente == FUENTES_ARRANQUE[1]:
+        df_dia = df_origen[df_origen['Día'] == dia]
+        if 'Orden' in df_dia:
+            df_dia = df_dia.sort_values('Orden', kind='stable')
+        return {ruta: claves_parada(grupo) for ruta, grupo in df_dia.groupby('Ruta', sort=False)}
+    return {}
+
+def cambios_contra_plan_anterior(df_actual):
+    # (altas, bajas) por día entre la planilla cargada y el último plan calculado, comparando nombre y coordenadas
+    dias = set(df_actual['Día'])
+    previas = set()
+    for d in st.session_state.get('datos_resumen') or []:
+        if d['dia'] in dias and d['paradas']:
+            df_paradas = pd.DataFrame(d['paradas'])
+            df_paradas['Lat'], df_paradas['Lon'] = preparar_coordenadas(df_paradas['Coordenadas'])
+            previas.update((d['dia'], c) for c in claves_parada(df_paradas))
+    if not previas:
+        return None
+    actuales = set(zip(df_actual['Día'], claves_parada(df_actual)))
+    return len(actuales - previas), len(previas - actuales)
+
+def arranque_del_modelo(recorridos, claves_nodos, excluir=()):
+    # kwargs de semilla para motor_vrp: si el plan conocido cubre casi todo el modelo, se repara en lugar de re-optimizar
+    semilla = semilla_en_nodos(recorridos, claves_nodos, excluir)
+    cubiertas = sum(len(r) for r in semilla)
+    nuevas = len(claves_nodos) - len(set(excluir)) - cubiertas
+    reparar = reoptimizacion_incremental and cubiertas > 0 and nuevas <= max(2, CAMBIOS_MAX_INCREMENTAL * cubiertas)
+    return {"rutas_iniciales": semilla, "reparar": reparar}
+
+def semilla_en_nodos(recorridos, lugares_nodos, excluir=()):
+    # Traduce recorridos (por clave de parada) a índices de nodo del modelo; lo que no está en el modelo se descarta
+    posicion = {}
+    for k, lugar in enumerate(lugares_nodos):
+        if k not in excluir:
+            posicion.setdefault(lugar, k)
+    vistos, rutas = set(), []
+    for lugares in recorridos:
+        ruta = []
+        for lugar in lugares:
+            nodo = posicion.get(lugar)
+            if nodo is not None and nodo not in vistos:
+                vistos.add(nodo)
+                ruta.append(nodo)
+        if ruta:
+            rutas.append(ruta)
+    return rutas
+
+def trazar_rutas_pendientes(pendientes, proveedor):
+    # Traza de una vez todas las rutas del plan y arma las filas de datos_para_resumen.
+    # El trazado tiene su propia espera de red: no hereda lo que consumieron las matrices y la optimización
+    proveedor.iniciar_plazo(plazo_red_segundos)
+    datos = []
+    resultados = obtener_trazados_masivos([p['coords_ordenadas'] for p in pendientes], proveedor)
+    for p, (geojson, err_dirs) in zip(pendientes, resultados):
+        if err_dirs == "QUOTA_EXCEEDED":
+            st.error(f"❌ ¡SALDO DIARIO AGOTADO al dibujar {p['ruta']}!")
+            st.stop()
+        if err_dirs:
+            st.error(f"Error trazando calles de {p['ruta']} ({p['dia']}): {err_dirs}")
+            continue
+        props = geojson['features'][0]['properties']['summary']
+        segments = geojson['features'][0]['properties'].get('segments', [])
+        datos.append({
+            "id_unico": p['id_unico'], "dia": p['dia'], "ruta": p['ruta'],
+            "puntos": p['puntos'], "dist_km": round(props['distance']/1000, 2),
+            "drive_mins": round(props['duration']/60, 0), "color": p['color'],
+            "paradas": p['paradas'], "segmentos": segments,
+            "geojson": geojson,
+            "coords_ordenadas": p['coords_ordenadas']
+        })
+    return datos
+
+if pedir_vaciar_cache:
+    vaciar_cache_ruteo()
+    st.sidebar.success("Caché de distancias vaciada.")
+
+if motor_ruteo == "Borrador offline (sin API)" and config_motor["calibrar"]:
+    calibracion = calibrar_desde_cache(PERFIL_ORS)
+    if calibracion:
+        config_motor["factor_desvio"], config_motor["velocidad_kmh"], n_muestras = calibracion
+        st.sidebar.caption(f"Calibrado con {n_muestras} tramos reales: desvío x{config_motor['factor_desvio']:.2f}, {config_motor['velocidad_kmh']:.0f} km/h.")
     else:
-        matriz_dist = [[0.0] * N for _ in range(N)]
-        matriz_dur = [[0.0] * N for _ in range(N)]
-        chunk_size = 15 
-        for i in range(0, N, chunk_size):
-            for j in range(0, N, chunk_size):
-                src_chunk = lista_coords[i : i+chunk_size]
-                dst_chunk = lista_coords[j : j+chunk_size]
-                locs = []
-                src_indices, dst_indices = [], []
-                for pt in src_chunk:
-                    if pt not in locs: locs.append(pt)
-                    src_indices.append(locs.index(pt))
-                for pt in dst_chunk:
-                    if pt not in locs: locs.append(pt)
-                    dst_indices.append(locs.index(pt))
-                body_matrix = {"locations": locs, "sources": src_indices, "destinations": dst_indices, "metrics": ["distance", "duration"]}
-                data, err = pedir_matriz_ors_con_reintento(body_matrix, headers)
-                if data:
-                    dists, durs = data['distances'], data['durations']
-                    for u in range(len(src_chunk)):
-                        for v in range(len(dst_chunk)):
-                            matriz_dist[i+u][j+v] = dists[u][v]
-                            matriz_dur[i+u][j+v] = durs[u][v]
-                else:
-                    return None, None, err
-                time.sleep(1.2) 
-        return matriz_dist, matriz_dur, None
-
-def obtener_trazado_masivo(coords_ordenadas, headers):
-    total_dist, total_dur = 0, 0
-    all_segments, merged_coordinates = [], []
-    chunk_size = 40
-    for i in range(0, len(coords_ordenadas) - 1, chunk_size - 1):
-        chunk = coords_ordenadas[i:i + chunk_size]
-        if len(chunk) < 2: break
-        body_dirs = {"coordinates": chunk, "radiuses": [-1] * len(chunk)}
-        data, err = pedir_trazado_ors_con_reintento(body_dirs, headers)
-        if data:
-            props = data['features'][0]['properties']['summary']
-            segs = data['features'][0]['properties'].get('segments', [])
-            geom = data['features'][0]['geometry']['coordinates']
-            total_dist += props['distance']
-            total_dur += props['duration']
-            all_segments.extend(segs)
-            if not merged_coordinates:
-                merged_coordinates.extend(geom)
-            else:
-                merged_coordinates.extend(geom[1:])
-        else:
-            return None, err
-        time.sleep(1.5)
-    fake_geojson = {
-        "type": "FeatureCollection",
-        "features": [{
-            "type": "Feature",
-            "properties": {"summary": {"distance": total_dist, "duration": total_dur}, "segments": all_segments},
-            "geometry": {"type": "LineString", "coordinates": merged_coordinates}
-        }]
-    }
-    return fake_geojson, None
+        st.sidebar.caption("Aún no hay distancias reales en caché: se usan los valores manuales.")
+
+proveedor_ruteo = crear_proveedor_ruteo(motor_ruteo, config_motor, api_key, ors_peticiones_por_minuto)
 
 # =====================================================================
 # BLOQUE DE SEGURIDAD ABSOLUTA: Nada se ejecuta si no hay archivo
@@ -212,21 +399,20 @@ if archivo_subido is None:
     st.info("👈 Por favor, sube tu archivo Excel en la barra lateral para comenzar.")
 else:
     # --- PROCESAMIENTO INICIAL DEL DATAFRAME ---
-    df = pd.read_excel(archivo_subido)
-    df.columns = df.columns.str.strip() 
+    contenido_archivo = archivo_subido.getvalue()
+    try:
+        df = cargar_planilla(hashlib.sha256(contenido_archivo).hexdigest(), archivo_subido.name, contenido_archivo)
+    except ImportError as e:
+        st.error(f"❌ Falta una librería para leer este formato: {e}")
+        st.stop()
+    except Exception as e:
+        st.error(f"❌ No se pudo leer el archivo: {e}")
+        st.stop()
 
     # -------------------------------------------------------------
     # IDENTIFICADOR INTELIGENTE DE ARCHIVO DESCARGADO
     # -------------------------------------------------------------
-    columnas_requeridas_cronograma = ['Orden', 'Día', 'Ruta', 'Departamento', 'Lugar', 'Coordenadas', 'Llegada', 'Salida', 'Minutos Tramo', 'Minutos Acumulados', 'Km Tramo', 'Km Acumulados']
-    es_cronograma_descargado = all(col in df.columns for col in columnas_requeridas_cronograma)
-
-    if 'Ruta' not in df.columns:
-        df['Ruta'] = "Sin Asignar"
-    df['Ruta'] = df['Ruta'].fillna("Sin Asignar")
-
-    df['Coords_Procesadas'] = df['Coordenadas'].apply(preparar_coordenadas)
-    df = df.dropna(subset=['Coords_Procesadas']).copy()
+    es_cronograma_descargado = all(col in df.columns for col in COLUMNAS_CRONOGRAMA)
 
     if df.empty:
         st.error("❌ No se encontraron coordenadas válidas en el archivo.")
@@ -245,9 +431,8 @@ else:
                 df_valido = df.sort_values(by=['Día', 'Ruta', 'Orden'])
                 
                 colores = ['blue', 'red', 'green', 'purple', 'orange', 'darkred', 'cadetblue', 'darkblue', 'pink', 'lightgreen']
-                datos_para_resumen = []
+                trazados_pendientes = []
                 color_idx = 0
-                headers = {'Authorization': api_key, 'Content-Type': 'application/json'}
                 
                 grupos = df_valido.groupby(['Día', 'Ruta'], sort=False)
                 
@@ -256,17 +441,9 @@ else:
                     color_actual = colores[color_idx % len(colores)]
                     color_idx += 1
                     
-                    coords_ordenadas = df_grupo['Coords_Procesadas'].tolist()
+                    coords_ordenadas = coordenadas_lon_lat(df_grupo)
                     
                     if len(coords_ordenadas) > 1:
-                        geojson, err_dirs = obtener_trazado_masivo(coords_ordenadas, headers)
-                        if err_dirs:
-                            st.error(f"Error trazando {ruta}: {err_dirs}")
-                            continue
-                            
-                        props = geojson['features'][0]['properties']['summary']
-                        segments = geojson['features'][0]['properties'].get('segments', [])
-                        
                         paradas_info = []
                         for _, row in df_grupo.iterrows():
                             paradas_info.append({
@@ -275,15 +452,15 @@ else:
                                 "Coordenadas": row.get('Coordenadas',''), "Orden": row.get('Orden', '')
                             })
                             
-                        datos_para_resumen.append({
+                        trazados_pendientes.append({
                             "id_unico": id_unico, "dia": dia, "ruta": ruta,
-                            "puntos": len(df_grupo), "dist_km": round(props['distance']/1000, 2),
-                            "drive_mins": round(props['duration']/60, 0), "color": color_actual,
-                            "paradas": paradas_info, "segmentos": segments,
-                            "geojson": geojson,
+                            "puntos": len(df_grupo), "color": color_actual,
+                            "paradas": paradas_info,
                             "coords_ordenadas": coords_ordenadas
                         })
 
+                datos_para_resumen = trazar_rutas_pendientes(trazados_pendientes, proveedor_ruteo)
+                avisar_uso_respaldo(proveedor_ruteo)
                 st.session_state['datos_resumen'] = datos_para_resumen
                 st.session_state['calculo_terminado'] = True
 
@@ -485,7 +662,7 @@ else:
             st.sidebar.header("Configuración de Flota Automática")
             
             if "Patrón Fijo" in tipo_ruteo:
-                st.sidebar.info("🗓️ Modo Patrón Maestro (Tu Lógica): Extrae los clientes esporádicos para asegurar una FLOTA MÍNIMA BASE. Luego inyecta esos puntos controlando el reloj para JAMÁS pasar de las 14:30 hs (+10 min de tolerancia estricta).")
+                st.sidebar.info("🗓️ Modo Patrón Maestro (Tu Lógica): Extrae los clientes esporádicos para asegurar una FLOTA MÍNIMA BASE. Luego inyecta esos puntos controlando el reloj para JAMÁS pasar del límite de llegada (+ la tolerancia elegida abajo).")
             elif "Fijo" in tipo_ruteo:
                 st.sidebar.info("🏢 Modo Fijo: Corta el mapa y calcula flota 100% independiente por departamento. NUNCA mezcla zonas en un auto.")
             elif "Flexible" in tipo_ruteo:
@@ -507,6 +684,17 @@ else:
                 hora_llegada_vrp = st.time_input("Límite Llegada", datetime.time(14, 30))
                 
             min_parada_vrp = st.sidebar.number_input("Minutos espera por parada", min_value=0, value=15, step=1)
+
+            k_inyeccion = 1
+            tolerancia_patron_min = 10
+            optimizar_patron_semanal = False
+            if "Patrón Fijo" in tipo_ruteo:
+                k_inyeccion = HEURISTICAS_INYECCION[st.sidebar.selectbox("💉 Inyección de esporádicos:", list(HEURISTICAS_INYECCION), help="Regret-k inserta primero a los clientes con menos alternativas: evita abrir autos por el orden de carga, a cambio de más cálculo en planes grandes.")]
+                tolerancia_patron_min = st.sidebar.number_input("Tolerancia sobre el límite de llegada (min)", min_value=0, max_value=120, value=10, step=1, help="Ningún día del patrón puede terminar más tarde que el límite + esta tolerancia.")
+                optimizar_patron_semanal = st.sidebar.checkbox("🔄 Optimizar el patrón contra todos los días", value=True, help="Después de armarlo, intenta vaciar autos y reubicar clientes midiendo cada cambio en todos los días seleccionados a la vez.")
+            paradas_por_zona = 0
+            if tipo_ruteo in ["Creación de rutas propias (Ideal Libre)", "Creación de rutas propias (Departamental Flexible)"]:
+                paradas_por_zona = st.sidebar.number_input("🧩 Partir días grandes en zonas de hasta (paradas)", min_value=0, max_value=10000, value=250, step=50, help="0 = nunca. Los días con más paradas se dividen en zonas geográficas parejas (en Flexible, el departamento inclina la división sin prohibir mezclar), cada zona se resuelve en paralelo y al final se vacían autos y se reubican clientes entre zonas vecinas.")
             
             start_dt = datetime.datetime.combine(datetime.date.today(), hora_salida_vrp)
             end_dt = datetime.datetime.combine(datetime.date.today(), hora_llegada_vrp)
@@ -518,6 +706,11 @@ else:
 
         # --- BOTÓN DE CÁLCULO ---
         if st.sidebar.button("🗺️ Calcular Rutas", type="primary"):
+            proveedor_ruteo.iniciar_plazo(plazo_red_segundos)
+            if fuente_arranque == FUENTES_ARRANQUE[0]:
+                cambios = cambios_contra_plan_anterior(df_filtrado_dias)
+                if cambios:
+                    st.info(f"🔁 Cambios respecto al plan anterior: {cambios[0]} paradas nuevas o movidas y {cambios[1]} quitadas o movidas.")
             st.session_state['hora_salida_rutas_dict'] = hora_salida_rutas_dict
             st.session_state['tipo_ruteo'] = tipo_ruteo 
             
@@ -528,14 +721,13 @@ else:
                 
             with st.spinner("Procesando la red logística y calculando tiempos..."):
                 
-                lat_centro = df_filtrado_dias.iloc[0]['Coords_Procesadas'][1]
-                lon_centro = df_filtrado_dias.iloc[0]['Coords_Procesadas'][0]
+                lat_centro = df_filtrado_dias.iloc[0]['Lat']
+                lon_centro = df_filtrado_dias.iloc[0]['Lon']
                 mapa_calculado = folium.Map(location=[lat_centro, lon_centro], zoom_start=11)
 
                 colores = ['blue', 'red', 'green', 'purple', 'orange', 'darkred', 'cadetblue', 'darkblue', 'pink', 'lightgreen']
-                datos_para_resumen = []
+                trazados_pendientes = []
                 color_idx = 0
-                headers = {'Authorization': api_key, 'Content-Type': 'application/json'}
 
                 destino_row_global = None
                 if "Creación de rutas propias" in tipo_ruteo:
@@ -548,10 +740,13 @@ else:
                 # LÓGICA 1 Y 2: RUTEO CLÁSICO Y OPTIMIZADOS
                 # ==========================================================
                 if tipo_ruteo in ["Ruteo según Excel (Orden Original)", "Ruteo Optimizado (IA)", "Ruteo Optimizado (IA) v2"]:
+                    # 1. Se preparan todas las rutas (matrices y restricciones); 2. se resuelven en paralelo; 3. se arman en orden
+                    rutas_del_plan = []
+                    tareas_solver = []
                     for dia in dias_seleccionados:
                         df_dia_general = df[df['Día'] == dia]
                         if not df_dia_general.empty:
-                            dibujar_geozona_circular(df_dia_general['Coords_Procesadas'].tolist(), f"🌍 DÍA: {dia}", "black", mapa_calculado)
+                            dibujar_geozona_circular(coordenadas_lon_lat(df_dia_general), f"🌍 DÍA: {dia}", "black", mapa_calculado)
 
                         for ruta in rutas_seleccionadas:
                             df_ruta = df[(df['Día'] == dia) & (df['Ruta'] == ruta)].copy().reset_index(drop=True)
@@ -561,43 +756,30 @@ else:
                             color_actual = colores[color_idx % len(colores)]
                             color_idx += 1
                             
-                            lista_coords = df_ruta['Coords_Procesadas'].tolist()
-                            nodos_ordenados = []
-                            coords_ordenadas = []
+                            lista_coords = coordenadas_lon_lat(df_ruta)
+                            registro = {"id_unico": id_unico, "dia": dia, "ruta": ruta, "df_ruta": df_ruta, "color": color_actual, "lista_coords": lista_coords, "nodos_ordenados": [], "tarea": None}
 
                             if tipo_ruteo == "Ruteo según Excel (Orden Original)":
-                                nodos_ordenados = list(range(len(df_ruta)))
-                                coords_ordenadas = lista_coords
+                                registro["nodos_ordenados"] = list(range(len(df_ruta)))
                             else: 
                                 num_locs = len(lista_coords)
                                 if num_locs < 2:
-                                    nodos_ordenados = [0]
-                                    coords_ordenadas = lista_coords
+                                    registro["nodos_ordenados"] = [0]
                                 else:
-                                    matriz_dist, matriz_dur, err_matriz = obtener_matriz_masiva(lista_coords, headers)
+                                    matriz_dist, matriz_dur, err_matriz = obtener_matriz_masiva(lista_coords, proveedor_ruteo)
                                     if err_matriz == "QUOTA_EXCEEDED":
                                         st.error(f"❌ ¡SALDO DIARIO AGOTADO en la ruta {ruta}! Pega tu propia clave en el menú lateral.")
                                         st.stop()
                                         
                                     if not err_matriz:
                                         N = num_locs
-                                        extended_dist = [[0] * (N + 2) for _ in range(N + 2)]
-                                        
-                                        for i in range(N):
-                                            for j in range(N):
-                                                val = matriz_dist[i][j]
-                                                extended_dist[i][j] = int(val) if val is not None else 99999999
+                                        extended_dist = np.pad(matriz_dist, ((0, 2), (0, 2)))
                                                 
                                         sel_inicio = opciones_inicio_dict.get(id_unico, "🤖 IA Decide")
                                         lugares_actuales = df_ruta['Lugar'].tolist()
                                         
                                         idx_inicio = lugares_actuales.index(sel_inicio) if sel_inicio in lugares_actuales and sel_inicio != "🤖 IA Decide" else -1
-                                        
-                                        if idx_inicio != -1:
-                                            for j in range(N): extended_dist[N][j] = 99999999
-                                            extended_dist[N][idx_inicio] = 0
-                                        else:
-                                            for j in range(N): extended_dist[N][j] = 0
+                                        restricciones = restricciones_recorrido(primero=idx_inicio)
                                             
                                         if tipo_ruteo == "Ruteo Optimizado (IA)":
                                             sel_anteante = opciones_anteante_dict.get(id_unico, "🤖 IA Decide")
@@ -610,29 +792,8 @@ else:
                                             idx_pen = lugares_actuales.index(sel_pen) if sel_pen in lugares_actuales and sel_pen != "🤖 IA Decide" else -1
                                             idx_fin = lugares_actuales.index(sel_fin) if sel_fin in lugares_actuales and sel_fin != "🤖 IA Decide" else -1
                                             
-                                            if idx_fin != -1:
-                                                for i in range(N): extended_dist[i][N+1] = 99999999
-                                                extended_dist[idx_fin][N+1] = 0
-                                            else:
-                                                for i in range(N): extended_dist[i][N+1] = 0
-
-                                            if idx_pen != -1 and idx_fin != -1:
-                                                for j in range(N): 
-                                                    if j != idx_fin: extended_dist[idx_pen][j] = 99999999
-                                                for i in range(N + 1): 
-                                                    if i != idx_pen: extended_dist[i][idx_fin] = 99999999
-
-                                            if idx_ante != -1 and idx_pen != -1:
-                                                for j in range(N):
-                                                    if j != idx_pen: extended_dist[idx_ante][j] = 99999999
-                                                for i in range(N + 1): 
-                                                    if i != idx_ante: extended_dist[i][idx_pen] = 99999999
-                                                    
-                                            if idx_anteante != -1 and idx_ante != -1:
-                                                for j in range(N):
-                                                    if j != idx_ante: extended_dist[idx_anteante][j] = 99999999
-                                                for i in range(N + 1): 
-                                                    if i != idx_anteante: extended_dist[i][idx_ante] = 99999999
+                                            # Cada par (anterior -> siguiente) elegido queda pegado en el recorrido
+                                            restricciones = restricciones_recorrido(primero=idx_inicio, ultimo=idx_fin, cadena=[(idx_pen, idx_fin), (idx_ante, idx_pen), (idx_anteante, idx_ante)])
                                                     
                                         elif tipo_ruteo == "Ruteo Optimizado (IA) v2":
                                             deptos_actuales = df_ruta['Departamento'].tolist()
@@ -641,32 +802,8 @@ else:
                                                 if str(depto_val).strip().upper() == 'LABNU':
                                                     idx_labnu = idx_loc
                                                     break
-                                            
-                                            if idx_labnu != -1:
-                                                for i in range(N): extended_dist[i][N+1] = 99999999
-                                                extended_dist[idx_labnu][N+1] = 0
-                                            else:
-                                                for i in range(N): extended_dist[i][N+1] = 0
-
-                                        manager = pywrapcp.RoutingIndexManager(N + 2, 1, [N], [N+1])
-                                        routing = pywrapcp.RoutingModel(manager)
-                                        
-                                        def distance_callback(from_index, to_index):
-                                            from_node = manager.IndexToNode(from_index)
-                                            to_node = manager.IndexToNode(to_index)
-                                            return int(extended_dist[from_node][to_node])
-                                            
-                                        transit_callback_index = routing.RegisterTransitCallback(distance_callback)
-                                        routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
-                                        
-                                        if tipo_ruteo == "Ruteo Optimizado (IA) v2":
-                                            def sequence_callback(from_index):
-                                                return 1
-                                            seq_call_idx = routing.RegisterUnaryTransitCallback(sequence_callback)
-                                            routing.AddDimension(seq_call_idx, 0, 9999, True, "Sequence")
-                                            seq_dim = routing.GetDimensionOrDie("Sequence")
-                                            solver = routing.solver()
-                                            
+
+                                            precedencias = []
                                             deptos_actuales = df_ruta['Departamento'].tolist()
                                             dept_config = opciones_deptos_dict.get(id_unico, {})
                                             
@@ -691,96 +828,86 @@ else:
                                                 
                                                 if len(target_last_nodes) > 0:
                                                     first_special = target_last_nodes[0]
-                                                    for r in reg_indices:
-                                                        solver.Add(seq_dim.CumulVar(manager.NodeToIndex(r)) < seq_dim.CumulVar(manager.NodeToIndex(first_special)))
+                                                    precedencias.extend((r, first_special) for r in reg_indices)
                                                         
                                                 for i in range(len(target_last_nodes) - 1):
-                                                    node_before = target_last_nodes[i]
-                                                    node_after = target_last_nodes[i+1]
-                                                    solver.Add(seq_dim.CumulVar(manager.NodeToIndex(node_before)) < seq_dim.CumulVar(manager.NodeToIndex(node_after)))
-                                        
-                                        search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-                                        search_parameters.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.SAVINGS
-                                        search_parameters.local_search_metaheuristic = routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
-                                        search_parameters.time_limit.seconds = 5 
-                                        
-                                        solution = routing.SolveWithParameters(search_parameters)
+                                                    precedencias.append((target_last_nodes[i], target_last_nodes[i+1]))
+
+                                            restricciones = restricciones_recorrido(primero=idx_inicio, ultimo=idx_labnu, precedencias=precedencias)
                                         
-                                        if solution:
-                                            idx = routing.Start(0)
-                                            while not routing.IsEnd(idx):
-                                                node = manager.IndexToNode(idx)
-                                                if node < N:
-                                                    nodos_ordenados.append(node)
-                                                idx = solution.Value(routing.NextVar(idx))
-                                            coords_ordenadas = [lista_coords[i] for i in nodos_ordenados]
-                                        else:
-                                            st.error(f"No se encontró solución matemática para {ruta}. Revisa no haber creado un bucle imposible.")
-                                            continue
+                                        arranque = arranque_del_modelo([recorridos_conocidos(fuente_arranque, df, dia).get(ruta, [])], claves_parada(df_ruta))
+                                        registro["tarea"] = len(tareas_solver)
+                                        tareas_solver.append((resolver_camino, {"costo": extended_dist, "inicio": N, "fin": N + 1, "restricciones": restricciones, **arranque}))
                                     else:
                                         st.error(f"Error Matriz en {ruta}: {err_matriz}")
                                         continue
 
-                            if len(coords_ordenadas) > 1:
-                                geojson, err_dirs = obtener_trazado_masivo(coords_ordenadas, headers)
-                                if err_dirs == "QUOTA_EXCEEDED":
-                                    st.error(f"❌ ¡SALDO DIARIO AGOTADO al dibujar {ruta}!")
-                                    st.stop()
-                                    
-                                if not err_dirs:
-                                    props = geojson['features'][0]['properties']['summary']
-                                    segments = geojson['features'][0]['properties'].get('segments', [])
-                                    
-                                    paradas_info = []
-                                    for nodo_idx in nodos_ordenados:
-                                        fila = df_ruta.iloc[nodo_idx]
-                                        paradas_info.append({
-                                            "Día": fila.get('Día',''), "Ruta": fila.get('Ruta',''),
-                                            "Departamento": fila.get('Departamento',''), "Lugar": fila.get('Lugar',''),
-                                            "Coordenadas": fila.get('Coordenadas','')
-                                        })
-
-                                    datos_para_resumen.append({
-                                        "id_unico": id_unico, "dia": dia, "ruta": ruta,
-                                        "puntos": len(df_ruta), "dist_km": round(props['distance']/1000, 2),
-                                        "drive_mins": round(props['duration']/60, 0), "color": color_actual,
-                                        "paradas": paradas_info, "segmentos": segments,
-                                        "geojson": geojson,
-                                        "coords_ordenadas": coords_ordenadas
-                                    })
-                                else:
-                                    st.error(f"Error trazando calles de {ruta}: {err_dirs}")
+                            rutas_del_plan.append(registro)
+
+                    # El tiempo de optimización corre desde que están todas las matrices, no desde el clic
+                    fin_optimizacion = time.monotonic() + plazo_optimizacion_segundos
+                    resultados_solver = resolver_subproblemas(tareas_solver, "Optimizando recorridos", fin_optimizacion, segundos_sin_mejora)
+
+                    for registro in rutas_del_plan:
+                        nodos_ordenados = registro["nodos_ordenados"]
+                        if registro["tarea"] is not None:
+                            nodos_ordenados = resultados_solver[registro["tarea"]]
+                            if nodos_ordenados is None:
+                                st.error(f"No se encontró solución matemática para {registro['ruta']}. Revisa no haber creado un bucle imposible.")
+                                continue
+                        coords_ordenadas = [registro["lista_coords"][i] for i in nodos_ordenados]
+
+                        if len(coords_ordenadas) > 1:
+                            df_ruta = registro["df_ruta"]
+                            paradas_info = []
+                            for nodo_idx in nodos_ordenados:
+                                fila = df_ruta.iloc[nodo_idx]
+                                paradas_info.append({
+                                    "Día": fila.get('Día',''), "Ruta": fila.get('Ruta',''),
+                                    "Departamento": fila.get('Departamento',''), "Lugar": fila.get('Lugar',''),
+                                    "Coordenadas": fila.get('Coordenadas','')
+                                })
+
+                            trazados_pendientes.append({
+                                "id_unico": registro["id_unico"], "dia": registro["dia"], "ruta": registro["ruta"],
+                                "puntos": len(df_ruta), "color": registro["color"],
+                                "paradas": paradas_info,
+                                "coords_ordenadas": coords_ordenadas
+                            })
 
                 # ==========================================================
                 # LÓGICA 3 Y 4: CREACIÓN DE RUTAS PROPIAS (LIBRE Y FLEXIBLE DIARIO)
                 # ==========================================================
                 elif tipo_ruteo in ["Creación de rutas propias (Ideal Libre)", "Creación de rutas propias (Departamental Flexible)"]:
+                    dias_del_plan = []
+                    tareas_solver = []
+                    # La mayoría de los clientes se repite en la semana: una matriz para todos los días y cada día recorta la suya
+                    matriz_semana = matriz_del_plan(pd.concat([df_filtrado_dias, destino_row_global.to_frame().T], ignore_index=True), proveedor_ruteo, coordenadas_lon_lat(destino_row_global.to_frame().T))
                     for dia in dias_seleccionados:
                         df_dia = df[df['Día'] == dia].copy().reset_index(drop=True)
                         if punto_final_vrp not in df_dia['Lugar'].values:
                             df_dia = pd.concat([df_dia, destino_row_global.to_frame().T], ignore_index=True)
                         
                         end_idx = df_dia[df_dia['Lugar'] == punto_final_vrp].index[0]
-                        lista_coords = df_dia['Coords_Procesadas'].tolist()
+                        lista_coords = coordenadas_lon_lat(df_dia)
                         num_locs = len(lista_coords)
                         
                         if num_locs < 2: continue
 
-                        matriz_dist, matriz_dur, err_matriz = obtener_matriz_masiva(lista_coords, headers)
+                        matriz_dist, matriz_dur, err_matriz = recortar_matriz(matriz_semana, lista_coords)
                         if err_matriz == "QUOTA_EXCEEDED":
                             st.error(f"❌ ¡SALDO DIARIO AGOTADO en el Día {dia}!")
                             st.stop()
                             
                         if not err_matriz:
                             dummy_idx = num_locs
-                            for i in range(num_locs):
-                                matriz_dist[i].append(0); matriz_dur[i].append(0)
-                            matriz_dist.append([0] * (num_locs + 1)); matriz_dur.append([0] * (num_locs + 1))
+                            matriz_dist = np.pad(matriz_dist, ((0, 1), (0, 1)))
+                            matriz_dur = np.pad(matriz_dur, ((0, 1), (0, 1)))
                             
                             for i in range(num_locs):
                                 if i != dummy_idx and i != end_idx:
-                                    val_dur = matriz_dur[i][end_idx]
-                                    if val_dur is None:
+                                    val_dur = matriz_dur[i, end_idx]
+                                    if val_dur >= COSTO_INALCANZABLE:
                                         st.error(f"❌ Error de Mapa: El punto '{df_dia.iloc[i]['Lugar']}' no tiene conexión por calle.")
                                         st.stop()
                                     tiempo_minimo_viaje = int(min_parada_vrp * 60) + int(val_dur)
@@ -788,113 +915,87 @@ else:
                                         st.error(f"❌ Error Físico Real: Ir desde '{df_dia.iloc[i]['Lugar']}' hasta el destino final toma por sí solo {tiempo_minimo_viaje//60} min.")
                                         st.stop()
 
-                            num_vehicles = num_locs 
-                            manager = pywrapcp.RoutingIndexManager(num_locs + 1, num_vehicles, [dummy_idx] * num_vehicles, [int(end_idx)] * num_vehicles)
-                            routing = pywrapcp.RoutingModel(manager)
-                            
-                            def distance_callback(from_index, to_index):
-                                from_node = manager.IndexToNode(from_index)
-                                to_node = manager.IndexToNode(to_index)
-                                val = matriz_dist[from_node][to_node]
-                                dist = int(val) if val is not None else 99999999 
-                                
-                                if from_node == dummy_idx and to_node != end_idx:
-                                    return dist + 100000000 
-                                    
-                                if "Flexible" in tipo_ruteo:
-                                    if from_node < num_locs and to_node < num_locs and from_node != end_idx and to_node != end_idx and from_node != dummy_idx:
-                                        dept_f = str(df_dia.iloc[from_node].get('Departamento', '')).strip().lower()
-                                        dept_t = str(df_dia.iloc[to_node].get('Departamento', '')).strip().lower()
-                                        if dept_f and dept_t and dept_f != dept_t:
-                                            dist += 500000 
-                                return int(dist)
-                                
-                            transit_callback_index = routing.RegisterTransitCallback(distance_callback)
-                            routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
-                            
-                            routing.SetFixedCostOfAllVehicles(100000000)
-                            
-                            def time_callback(from_index, to_index):
-                                from_node = manager.IndexToNode(from_index)
-                                to_node = manager.IndexToNode(to_index)
-                                val_dur = matriz_dur[from_node][to_node]
-                                drive_time = int(val_dur) if val_dur is not None else 99999999 
-                                wait_time = int(min_parada_vrp * 60) if to_node != dummy_idx and to_node != end_idx else 0
-                                return int(drive_time + wait_time)
-                                
-                            time_callback_index = routing.RegisterTransitCallback(time_callback)
-                            routing.AddDimension(time_callback_index, 0, max_time_sec, True, "Time")
-
-                            search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-                            search_parameters.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.SAVINGS
-                            search_parameters.time_limit.seconds = 20 
-                            
-                            solution = routing.SolveWithParameters(search_parameters)
-                            
-                            if solution:
-                                vehiculo_real_count = 1
-                                for vehicle_id in range(num_vehicles):
-                                    index = routing.Start(vehicle_id)
-                                    first_visit = solution.Value(routing.NextVar(index))
-                                    
-                                    if manager.IndexToNode(first_visit) == end_idx:
-                                        continue 
-                                    
-                                    nodos_ordenados = []
-                                    while not routing.IsEnd(index):
-                                        node = manager.IndexToNode(index)
-                                        if node != dummy_idx:
-                                            nodos_ordenados.append(node)
-                                        index = solution.Value(routing.NextVar(index))
-                                    nodos_ordenados.append(end_idx)
-                                    
-                                    coords_ordenadas = [lista_coords[i] for i in nodos_ordenados]
-                                    ruta_nombre = f"Auto {vehiculo_real_count}"
-                                    id_unico = f"{dia} - {ruta_nombre}"
-                                    vehiculo_real_count += 1
-                                    color_actual = colores[color_idx % len(colores)]
-                                    color_idx += 1
-                                    
-                                    geojson, err_dirs = obtener_trazado_masivo(coords_ordenadas, headers)
-                                    if err_dirs == "QUOTA_EXCEEDED":
-                                        st.error(f"❌ ¡SALDO DIARIO AGOTADO al dibujar {ruta_nombre}!")
-                                        st.stop()
-                                        
-                                    if not err_dirs:
-                                        props = geojson['features'][0]['properties']['summary']
-                                        segments = geojson['features'][0]['properties'].get('segments', [])
-                                        paradas_info = []
-                                        for nodo_idx in nodos_ordenados:
-                                            fila = df_dia.iloc[nodo_idx]
-                                            paradas_info.append({
-                                                "Día": fila.get('Día',''), "Ruta": ruta_nombre, 
-                                                "Departamento": fila.get('Departamento',''), "Lugar": fila.get('Lugar',''),
-                                                "Coordenadas": fila.get('Coordenadas','')
-                                            })
-                                        datos_para_resumen.append({
-                                            "id_unico": id_unico, "dia": dia, "ruta": ruta_nombre,
-                                            "puntos": len(nodos_ordenados), "dist_km": round(props['distance']/1000, 2),
-                                            "drive_mins": round(props['duration']/60, 0), "color": color_actual,
-                                            "paradas": paradas_info, "segmentos": segments,
-                                            "geojson": geojson,
-                                            "coords_ordenadas": coords_ordenadas
-                                        })
-                                    else:
-                                        st.error(f"Error en trazado: {err_dirs}")
+                            codigos_depto_dia = codificar_deptos(df_dia['Departamento'] if 'Departamento' in df_dia else [''] * num_locs) if "Flexible" in tipo_ruteo else None
+                            costo_dia = matriz_costo_flota(matriz_dist, dummy_idx, end_idx, codigos_depto_dia)
+                            tiempo_dia = matriz_tiempo_con_espera(matriz_dur, min_parada_vrp * 60, [dummy_idx, end_idx])
+                            clientes_dia = np.array([i for i in range(num_locs) if i != end_idx])
+                            if paradas_por_zona and len(clientes_dia) > paradas_por_zona:
+                                # Día grande: un modelo por zona (cada una con su destino y su ficticio) y se unen al final
+                                zonas = zonas_balanceadas(np.asarray(lista_coords, dtype=float)[clientes_dia], paradas_por_zona, None if codigos_depto_dia is None else codigos_depto_dia[clientes_dia], PESO_DEPTO_ZONAS_METROS if "Flexible" in tipo_ruteo else 0.0)
+                                grupos = [clientes_dia[zonas == z].tolist() + [int(end_idx)] for z in range(zonas.max() + 1)]
                             else:
-                                st.error(f"❌ Imposible matemático en el {dia}.")
+                                grupos = [list(range(num_locs))]
+                            cotas_dia = cotas_flota(tiempo_dia, dummy_idx, end_idx, max_time_sec)
+                            for grupo in grupos:
+                                nodos = grupo + [dummy_idx] if len(grupos) > 1 else list(range(num_locs + 1))
+                                tareas_solver.append((resolver_flota, {
+                                    "costo": costo_dia[np.ix_(nodos, nodos)],
+                                    "tiempo": tiempo_dia[np.ix_(nodos, nodos)],
+                                    "dummy_idx": len(nodos) - 1, "end_idx": nodos.index(int(end_idx)), "tiempo_max": max_time_sec, "vecinos_k": vecinos_del_modelo(matriz_semana["dispersa"]),
+                                    **({"cotas": cotas_dia} if len(grupos) == 1 else {}),
+                                    **arranque_del_modelo(recorridos_conocidos(fuente_arranque, df, dia).values(), claves_parada(df_dia.iloc[nodos[:-1]]), excluir={nodos.index(int(end_idx))})
+                                }))
+                            dias_del_plan.append((dia, df_dia, end_idx, lista_coords, grupos, costo_dia[:num_locs, :num_locs], matriz_dur[:num_locs, :num_locs], cotas_dia[0]))
                         else:
                             st.error(f"Error Matriz {dia}: {err_matriz}")
 
+                    fin_optimizacion = time.monotonic() + plazo_optimizacion_segundos
+                    resultados_solver = iter(resolver_subproblemas(tareas_solver, "Armando flota por día", fin_optimizacion, segundos_sin_mejora))
+
+                    autos_vs_minimo = []
+                    for n_dia, (dia, df_dia, end_idx, lista_coords, grupos, costo_union, dur_union, minimo_autos) in enumerate(dias_del_plan):
+                        rutas_por_zona = [next(resultados_solver) for _ in grupos]
+                        if any(rutas is None for rutas in rutas_por_zona):
+                            st.error(f"❌ Imposible matemático en el {dia}.")
+                            continue
+                        rutas_dia = [[grupo[n] for n in ruta] for grupo, rutas in zip(grupos, rutas_por_zona) for ruta in rutas]
+                        if len(grupos) > 1:
+                            # Costura entre zonas: vaciar los autos más cortos en los vecinos y reubicar clientes de borde
+                            segundos_costura = max(SEGUNDOS_MIN_POR_MODELO, (fin_optimizacion - time.monotonic()) / (len(dias_del_plan) - n_dia))
+                            autos_por_zona = len(rutas_dia)
+                            rutas_dia = mejorar_patron(rutas_dia, np.ones((len(costo_union), 1), dtype=bool), dur_union, costo_union, int(end_idx), int(min_parada_vrp * 60), max_time_sec, segundos_costura)
+                            st.caption(f"🧩 {dia}: {len(grupos)} zonas resueltas en paralelo; la costura entre zonas pasó de {autos_por_zona} a {len(rutas_dia)} autos.")
+                        autos_vs_minimo.append(f"{dia} {len(rutas_dia)}/{minimo_autos}")
+                        vehiculo_real_count = 1
+                        for nodos_ordenados in rutas_dia:
+                            nodos_ordenados = nodos_ordenados + [end_idx]
+                            
+                            coords_ordenadas = [lista_coords[i] for i in nodos_ordenados]
+                            ruta_nombre = f"Auto {vehiculo_real_count}"
+                            id_unico = f"{dia} - {ruta_nombre}"
+                            vehiculo_real_count += 1
+                            color_actual = colores[color_idx % len(colores)]
+                            color_idx += 1
+                            
+                            paradas_info = []
+                            for nodo_idx in nodos_ordenados:
+                                fila = df_dia.iloc[nodo_idx]
+                                paradas_info.append({
+                                    "Día": fila.get('Día',''), "Ruta": ruta_nombre, 
+                                    "Departamento": fila.get('Departamento',''), "Lugar": fila.get('Lugar',''),
+                                    "Coordenadas": fila.get('Coordenadas','')
+                                })
+                            trazados_pendientes.append({
+                                "id_unico": id_unico, "dia": dia, "ruta": ruta_nombre,
+                                "puntos": len(nodos_ordenados), "color": color_actual,
+                                "paradas": paradas_info,
+                                "coords_ordenadas": coords_ordenadas
+                            })
+                    if autos_vs_minimo:
+                        st.caption("🚚 Autos usados / mínimo teórico por tiempo de jornada: " + ", ".join(autos_vs_minimo))
+
                 # ==========================================================
                 # LÓGICA 5: CREACIÓN DE RUTAS PROPIAS (DEPARTAMENTAL FIJO - NORMAL)
                 # ==========================================================
                 elif tipo_ruteo == "Creación de rutas propias (Departamental Fijo)":
+                    deptos_del_plan = []
+                    tareas_solver = []
+                    # Una matriz por departamento para toda la semana (nunca se mezclan, así que no se piden pares entre departamentos)
+                    matrices_depto = {}
                     for dia in dias_seleccionados:
                         df_dia_completo = df[df['Día'] == dia].copy().reset_index(drop=True)
                         dept_series = df_dia_completo[df_dia_completo['Lugar'] != punto_final_vrp]['Departamento']
                         departamentos = [d for d in dept_series.unique() if pd.notna(d) and str(d).strip() != '']
-                        vehiculo_real_count = 1
                         
                         for dept in departamentos:
                             df_dept = df_dia_completo[(df_dia_completo['Departamento'] == dept) & (df_dia_completo['Lugar'] != punto_final_vrp)].copy().reset_index(drop=True)
@@ -902,26 +1003,28 @@ else:
                             
                             df_dept = pd.concat([df_dept, destino_row_global.to_frame().T], ignore_index=True)
                             end_idx = len(df_dept) - 1
-                            lista_coords = df_dept['Coords_Procesadas'].tolist()
+                            lista_coords = coordenadas_lon_lat(df_dept)
                             num_locs = len(lista_coords)
                             
                             if num_locs < 2: continue
 
-                            matriz_dist, matriz_dur, err_matriz = obtener_matriz_masiva(lista_coords, headers)
+                            if dept not in matrices_depto:
+                                df_depto_semana = df_filtrado_dias[(df_filtrado_dias['Departamento'] == dept) & (df_filtrado_dias['Lugar'] != punto_final_vrp)]
+                                matrices_depto[dept] = matriz_del_plan(pd.concat([df_depto_semana, destino_row_global.to_frame().T], ignore_index=True), proveedor_ruteo, coordenadas_lon_lat(destino_row_global.to_frame().T))
+                            matriz_dist, matriz_dur, err_matriz = recortar_matriz(matrices_depto[dept], lista_coords)
                             if err_matriz == "QUOTA_EXCEEDED":
                                 st.error(f"❌ ¡SALDO DIARIO AGOTADO en el Día {dia}, Depto {dept}!")
                                 st.stop()
                                 
                             if not err_matriz:
                                 dummy_idx = num_locs
-                                for i in range(num_locs):
-                                    matriz_dist[i].append(0); matriz_dur[i].append(0)
-                                matriz_dist.append([0] * (num_locs + 1)); matriz_dur.append([0] * (num_locs + 1))
+                                matriz_dist = np.pad(matriz_dist, ((0, 1), (0, 1)))
+                                matriz_dur = np.pad(matriz_dur, ((0, 1), (0, 1)))
                                 
                                 for i in range(num_locs):
                                     if i != dummy_idx and i != end_idx:
-                                        val_dur = matriz_dur[i][end_idx]
-                                        if val_dur is None:
+                                        val_dur = matriz_dur[i, end_idx]
+                                        if val_dur >= COSTO_INALCANZABLE:
                                             st.error(f"❌ Error de Mapa: El punto '{df_dept.iloc[i]['Lugar']}' no tiene conexión por calle.")
                                             st.stop()
                                         tiempo_minimo_viaje = int(min_parada_vrp * 60) + int(val_dur)
@@ -929,133 +1032,82 @@ else:
                                             st.error(f"❌ Error Físico Real: Ir desde '{df_dept.iloc[i]['Lugar']}' ({dept}) hasta el destino toma {tiempo_minimo_viaje//60} min reales.")
                                             st.stop()
 
-                                num_vehicles = num_locs 
-                                manager = pywrapcp.RoutingIndexManager(num_locs + 1, num_vehicles, [dummy_idx] * num_vehicles, [int(end_idx)] * num_vehicles)
-                                routing = pywrapcp.RoutingModel(manager)
-                                
-                                def distance_callback(from_index, to_index):
-                                    from_node = manager.IndexToNode(from_index)
-                                    to_node = manager.IndexToNode(to_index)
-                                    val = matriz_dist[from_node][to_node]
-                                    dist = int(val) if val is not None else 99999999 
-                                    if from_node == dummy_idx and to_node != end_idx: return dist + 100000000 
-                                    return int(dist)
-                                    
-                                transit_callback_index = routing.RegisterTransitCallback(distance_callback)
-                                routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
-                                
-                                routing.SetFixedCostOfAllVehicles(100000000)
-                                
-                                def time_callback(from_index, to_index):
-                                    from_node = manager.IndexToNode(from_index)
-                                    to_node = manager.IndexToNode(to_index)
-                                    val_dur = matriz_dur[from_node][to_node]
-                                    drive_time = int(val_dur) if val_dur is not None else 99999999 
-                                    wait_time = int(min_parada_vrp * 60) if to_node != dummy_idx and to_node != end_idx else 0
-                                    return int(drive_time + wait_time)
-                                    
-                                time_callback_index = routing.RegisterTransitCallback(time_callback)
-                                routing.AddDimension(time_callback_index, 0, max_time_sec, True, "Time")
-
-                                search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-                                search_parameters.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.SAVINGS
-                                search_parameters.local_search_metaheuristic = routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
-                                search_parameters.time_limit.seconds = 10 
-                                
-                                solution = routing.SolveWithParameters(search_parameters)
-                                
-                                if solution:
-                                    for vehicle_id in range(num_vehicles):
-                                        index = routing.Start(vehicle_id)
-                                        first_visit = solution.Value(routing.NextVar(index))
-                                        if manager.IndexToNode(first_visit) == end_idx: continue 
-                                        nodos_ordenados = []
-                                        while not routing.IsEnd(index):
-                                            node = manager.IndexToNode(index)
-                                            if node != dummy_idx: nodos_ordenados.append(node)
-                                            index = solution.Value(routing.NextVar(index))
-                                        nodos_ordenados.append(end_idx)
-                                        
-                                        coords_ordenadas = [lista_coords[i] for i in nodos_ordenados]
-                                        nombre_dept_limpio = str(dept).strip()
-                                        ruta_nombre = f"Auto {vehiculo_real_count} ({nombre_dept_limpio})"
-                                        id_unico = f"{dia} - {ruta_nombre}"
-                                        vehiculo_real_count += 1
-                                        color_actual = colores[color_idx % len(colores)]
-                                        color_idx += 1
-                                        
-                                        geojson, err_dirs = obtener_trazado_masivo(coords_ordenadas, headers)
-                                        if err_dirs == "QUOTA_EXCEEDED":
-                                            st.error(f"❌ ¡SALDO DIARIO AGOTADO al dibujar {ruta_nombre}!")
-                                            st.stop()
-                                        if not err_dirs:
-                                            props = geojson['features'][0]['properties']['summary']
-                                            segments = geojson['features'][0]['properties'].get('segments', [])
-                                            paradas_info = []
-                                            for nodo_idx in nodos_ordenados:
-                                                fila = df_dept.iloc[nodo_idx]
-                                                paradas_info.append({
-                                                    "Día": fila.get('Día',''), "Ruta": ruta_nombre, 
-                                                    "Departamento": fila.get('Departamento',''), "Lugar": fila.get('Lugar',''),
-                                                    "Coordenadas": fila.get('Coordenadas','')
-                                                })
-                                            datos_para_resumen.append({
-                                                "id_unico": id_unico, "dia": dia, "ruta": ruta_nombre,
-                                                "puntos": len(nodos_ordenados), "dist_km": round(props['distance']/1000, 2),
-                                                "drive_mins": round(props['duration']/60, 0), "color": color_actual,
-                                                "paradas": paradas_info, "segmentos": segments,
-                                                "geojson": geojson,
-                                                "coords_ordenadas": coords_ordenadas
-                                            })
-                                        else:
-                                            st.error(f"Error en trazado: {err_dirs}")
-                                else:
-                                    st.error(f"❌ Imposible matemático en el {dia} para {dept}.")
+                                tareas_solver.append((resolver_flota, {
+                                    "costo": matriz_costo_flota(matriz_dist, dummy_idx, end_idx),
+                                    "tiempo": matriz_tiempo_con_espera(matriz_dur, min_parada_vrp * 60, [dummy_idx, end_idx]),
+                                    "dummy_idx": dummy_idx, "end_idx": end_idx, "tiempo_max": max_time_sec,
+                                    "busqueda_guiada": True, "vecinos_k": vecinos_del_modelo(matrices_depto[dept]["dispersa"]),
+                                    **arranque_del_modelo(recorridos_conocidos(fuente_arranque, df, dia).values(), claves_parada(df_dept), excluir={end_idx})
+                                }))
+                                deptos_del_plan.append((dia, dept, df_dept, end_idx, lista_coords))
                             else:
                                 st.error(f"Error Matriz {dia} - {dept}: {err_matriz}")
 
+                    fin_optimizacion = time.monotonic() + plazo_optimizacion_segundos
+                    resultados_solver = resolver_subproblemas(tareas_solver, "Armando flota por departamento", fin_optimizacion, segundos_sin_mejora)
+
+                    vehiculos_por_dia = {}
+                    for (dia, dept, df_dept, end_idx, lista_coords), rutas_dept in zip(deptos_del_plan, resultados_solver):
+                        if rutas_dept is None:
+                            st.error(f"❌ Imposible matemático en el {dia} para {dept}.")
+                            continue
+                        for nodos_ordenados in rutas_dept:
+                            nodos_ordenados = nodos_ordenados + [end_idx]
+                            
+                            coords_ordenadas = [lista_coords[i] for i in nodos_ordenados]
+                            nombre_dept_limpio = str(dept).strip()
+                            vehiculo_real_count = vehiculos_por_dia.get(dia, 1)
+                            ruta_nombre = f"Auto {vehiculo_real_count} ({nombre_dept_limpio})"
+                            id_unico = f"{dia} - {ruta_nombre}"
+                            vehiculos_por_dia[dia] = vehiculo_real_count + 1
+                            color_actual = colores[color_idx % len(colores)]
+                            color_idx += 1
+                            
+                            paradas_info = []
+                            for nodo_idx in nodos_ordenados:
+                                fila = df_dept.iloc[nodo_idx]
+                                paradas_info.append({
+                                    "Día": fila.get('Día',''), "Ruta": ruta_nombre, 
+                                    "Departamento": fila.get('Departamento',''), "Lugar": fila.get('Lugar',''),
+                                    "Coordenadas": fila.get('Coordenadas','')
+                                })
+                            trazados_pendientes.append({
+                                "id_unico": id_unico, "dia": dia, "ruta": ruta_nombre,
+                                "puntos": len(nodos_ordenados), "color": color_actual,
+                                "paradas": paradas_info,
+                                "coords_ordenadas": coords_ordenadas
+                            })
+
                 # ==========================================================
                 # LÓGICA 6, 7 Y 8: CREACIÓN DE RUTAS PROPIAS (PATRÓN MAESTRO - CON LÍMITE ESTRICTO DE +10 MIN)
                 # ==========================================================
                 elif "Patrón Fijo" in tipo_ruteo:
-                    st.info("🧠 Generando Patrón Maestro: Extrayendo los clientes esporádicos para garantizar la FLOTA MÍNIMA. Los sobrantes se inyectarán con límite matemático ESTRICTO de +10 minutos.")
+                    st.info(f"🧠 Generando Patrón Maestro: Extrayendo los clientes esporádicos para garantizar la FLOTA MÍNIMA. Los sobrantes se inyectarán con límite matemático ESTRICTO de +{tolerancia_patron_min} minutos.")
                     
                     df_total_puntos = df_filtrado_dias[df_filtrado_dias['Lugar'] != punto_final_vrp].drop_duplicates(subset=['Lugar']).copy().reset_index(drop=True)
                     
                     # MATRIZ ÚNICA MUNDIAL
                     df_master_global = pd.concat([df_total_puntos, destino_row_global.to_frame().T], ignore_index=True)
-                    lista_coords_global = df_master_global['Coords_Procesadas'].tolist()
+                    lista_coords_global = coordenadas_lon_lat(df_master_global)
                     lugares_globales = df_master_global['Lugar'].tolist()
+                    claves_globales = claves_parada(df_master_global)
                     end_idx_global = len(lugares_globales) - 1
+                    codigos_depto_global = codificar_deptos(df_master_global['Departamento'] if 'Departamento' in df_master_global else [''] * len(df_master_global))
 
-                    matriz_dist_global, matriz_dur_global, err_matriz_glob = obtener_matriz_masiva(lista_coords_global, headers)
+                    matriz_dist_global, matriz_dur_global, err_matriz_glob = obtener_matriz_plan(lista_coords_global, proveedor_ruteo, lista_coords_global[end_idx_global:])
                     if err_matriz_glob: st.error(err_matriz_glob); st.stop()
+                    dispersa_global = matriz_es_dispersa(len(lista_coords_global), proveedor_ruteo)
                     
-                    # LIMPIEZA MATEMÁTICA A ENTEROS
-                    for i in range(len(matriz_dist_global)):
-                        for j in range(len(matriz_dist_global[0])):
-                            if matriz_dist_global[i][j] is None: matriz_dist_global[i][j] = 99999999
-                            else: matriz_dist_global[i][j] = int(matriz_dist_global[i][j])
-                            if matriz_dur_global[i][j] is None: matriz_dur_global[i][j] = 99999999
-                            else: matriz_dur_global[i][j] = int(matriz_dur_global[i][j])
-
-                    def calcular_tiempo_ruta_en_dia_especifico(ruta_locs, day):
-                        locs_day = set(df_filtrado_dias[df_filtrado_dias['Día'] == day]['Lugar'])
-                        r_day = [l for l in ruta_locs if l in locs_day]
-                        if not r_day: return 0, 0
-                        
-                        t = 0
-                        d = 0
-                        for i in range(len(r_day) - 1):
-                            idx_A = lugares_globales.index(r_day[i])
-                            idx_B = lugares_globales.index(r_day[i+1])
-                            t += int(min_parada_vrp * 60) + matriz_dur_global[idx_A][idx_B]
-                            d += matriz_dist_global[idx_A][idx_B]
-                            
-                        idx_last = lugares_globales.index(r_day[-1])
-                        t += int(min_parada_vrp * 60) + matriz_dur_global[idx_last][end_idx_global]
-                        d += matriz_dist_global[idx_last][end_idx_global]
-                        return t, d
+                    # Mapa entero lugar -> nodo y presencia [nodo, día] para el reloj por día de la inyección
+                    indice_global = {lugar: g for g, lugar in enumerate(lugares_globales)}
+                    presente_global = np.zeros((len(lugares_globales), len(dias_seleccionados)), dtype=bool)
+                    presente_global[df_filtrado_dias['Lugar'].map(indice_global).to_numpy(), df_filtrado_dias['Día'].map({d: i for i, d in enumerate(dias_seleccionados)}).to_numpy()] = True
+                    # En Flexible la optimización semanal paga el mismo castigo por cruzar departamentos que el día pico
+                    costo_patron_global = matriz_dist_global
+                    if "Flexible" in tipo_ruteo:
+                        cruce_global = penalizacion_cruce_deptos(codigos_depto_global)
+                        cruce_global[:, end_idx_global] = 0
+                        costo_patron_global = matriz_dist_global + cruce_global
 
                     rutas_maestras_base = []
                     vehiculo_real_count = 1
@@ -1068,116 +1120,70 @@ else:
                     else:
                         subsets.append(("General", df_total_puntos['Lugar'].tolist()))
 
+                    # 1. EL FILTRO DE FRECUENCIA DEL USUARIO: se arma el día pico de cada subconjunto y se resuelven todos a la vez
+                    subsets_preparados = []
+                    tareas_solver = []
                     for subset_name, subset_lugares in subsets:
-                        # 1. EL FILTRO DE FRECUENCIA DEL USUARIO
                         df_subset_filtrado = df_filtrado_dias[df_filtrado_dias['Lugar'].isin(subset_lugares)]
                         dia_pico = df_subset_filtrado.groupby('Día').size().idxmax()
                         lugares_pico_base = df_subset_filtrado[df_subset_filtrado['Día'] == dia_pico]['Lugar'].unique().tolist()
                         
-                        pico_indices = [lugares_globales.index(l) for l in lugares_pico_base]
+                        pico_indices = [indice_global[l] for l in lugares_pico_base]
                         num_sub = len(pico_indices)
                         dummy_idx = num_sub
                         end_idx_sub = num_sub + 1
                         
                         rutas_core_locs = []
+                        tarea = None
                         
                         if num_sub < 2:
                             if num_sub == 1: rutas_core_locs.append([lugares_pico_base[0]])
                         else:
-                            sub_dist = [[0]*(num_sub+2) for _ in range(num_sub+2)]
-                            sub_dur = [[0]*(num_sub+2) for _ in range(num_sub+2)]
-                            for i in range(num_sub):
-                                for j in range(num_sub):
-                                    sub_dist[i][j] = int(matriz_dist_global[pico_indices[i]][pico_indices[j]])
-                                    sub_dur[i][j] = int(matriz_dur_global[pico_indices[i]][pico_indices[j]])
-                                sub_dist[i][end_idx_sub] = int(matriz_dist_global[pico_indices[i]][end_idx_global])
-                                sub_dur[i][end_idx_sub] = int(matriz_dur_global[pico_indices[i]][end_idx_global])
-                                
-                            manager = pywrapcp.RoutingIndexManager(num_sub + 2, num_sub, [dummy_idx]*num_sub, [end_idx_sub]*num_sub)
-                            routing = pywrapcp.RoutingModel(manager)
-                            
-                            def d_call(f, t):
-                                fn, tn = manager.IndexToNode(f), manager.IndexToNode(t)
-                                dist = int(sub_dist[fn][tn])
-                                if fn == dummy_idx and tn != end_idx_sub: return dist + 100000000 
-                                
-                                if "Flexible" in tipo_ruteo and fn < num_sub and tn < num_sub:
-                                    g_fn, g_tn = pico_indices[fn], pico_indices[tn]
-                                    d_f = str(df_master_global.iloc[g_fn].get('Departamento','')).strip().lower()
-                                    d_t = str(df_master_global.iloc[g_tn].get('Departamento','')).strip().lower()
-                                    if d_f and d_t and d_f != d_t: dist += 500000
-                                return dist
-                                
-                            def t_call(f, t):
-                                fn, tn = manager.IndexToNode(f), manager.IndexToNode(t)
-                                wt = int(min_parada_vrp*60) if tn != dummy_idx and tn != end_idx_sub else 0
-                                return int(sub_dur[fn][tn]) + wt
-                                
-                            transit_cb = routing.RegisterTransitCallback(d_call)
-                            routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
-                            time_cb = routing.RegisterTransitCallback(t_call)
-                            
-                            routing.AddDimension(time_cb, 0, max_time_sec, True, "Time")
-                            routing.SetFixedCostOfAllVehicles(100000000) 
-                            
-                            search_params = pywrapcp.DefaultRoutingSearchParameters()
-                            search_params.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.SAVINGS
-                            search_params.time_limit.seconds = 10
+                            sub_dist = np.zeros((num_sub + 2, num_sub + 2), dtype=np.int64)
+                            sub_dur = np.zeros((num_sub + 2, num_sub + 2), dtype=np.int64)
+                            sub_dist[:num_sub, :num_sub] = matriz_dist_global[np.ix_(pico_indices, pico_indices)]
+                            sub_dur[:num_sub, :num_sub] = matriz_dur_global[np.ix_(pico_indices, pico_indices)]
+                            sub_dist[:num_sub, end_idx_sub] = matriz_dist_global[pico_indices, end_idx_global]
+                            sub_dur[:num_sub, end_idx_sub] = matriz_dur_global[pico_indices, end_idx_global]
                             
-                            sol = routing.SolveWithParameters(search_params)
-                            if sol:
-                                for vid in range(num_sub):
-                                    idx = routing.Start(vid)
-                                    fv = sol.Value(routing.NextVar(idx))
-                                    if manager.IndexToNode(fv) == end_idx_sub: continue
+                            codigos_pico = codigos_depto_global[pico_indices] if "Flexible" in tipo_ruteo else None
+                            tarea = len(tareas_solver)
+                            tareas_solver.append((resolver_flota, {
+                                "costo": matriz_costo_flota(sub_dist, dummy_idx, end_idx_sub, codigos_pico),
+                                "tiempo": matriz_tiempo_con_espera(sub_dur, min_parada_vrp * 60, [dummy_idx, end_idx_sub]),
+                                "dummy_idx": dummy_idx, "end_idx": end_idx_sub, "tiempo_max": max_time_sec,
+                                "vecinos_k": vecinos_del_modelo(dispersa_global),
+                                **arranque_del_modelo(recorridos_conocidos(fuente_arranque, df, dia_pico).values(), [claves_globales[g] for g in pico_indices])
+                            }))
+                        subsets_preparados.append((subset_name, subset_lugares, df_subset_filtrado, lugares_pico_base, rutas_core_locs, tarea))
+
+                    fin_optimizacion = time.monotonic() + plazo_optimizacion_segundos
+                    resultados_solver = resolver_subproblemas(tareas_solver, "Armando patrón base", fin_optimizacion, segundos_sin_mejora)
+
+                    for subset_name, subset_lugares, df_subset_filtrado, lugares_pico_base, rutas_core_locs, tarea in subsets_preparados:
+                        if tarea is not None and resultados_solver[tarea]:
+                            rutas_core_locs.extend([lugares_pico_base[n] for n in r] for r in resultados_solver[tarea])
                                     
-                                    r = []
-                                    while not routing.IsEnd(idx):
-                                        n = manager.IndexToNode(idx)
-                                        if n != dummy_idx: r.append(lugares_pico_base[n])
-                                        idx = sol.Value(routing.NextVar(idx))
-                                    rutas_core_locs.append(r)
-                                    
-                        # 2. INYECCIÓN CON RELOJ ESTRICTO (+10 MIN EXACTOS): 
-                        lugares_faltantes = [l for l in subset_lugares if l not in lugares_pico_base]
-                        
-                        for f_loc in lugares_faltantes:
-                            dias_activos = df_subset_filtrado[df_subset_filtrado['Lugar'] == f_loc]['Día'].unique()
-                            f_idx = lugares_globales.index(f_loc)
-                            
-                            best_r = -1
-                            best_pos = -1
-                            min_extra_dist = float('inf')
-                            
-                            for r_idx, ruta in enumerate(rutas_core_locs):
-                                for pos in range(len(ruta) + 1):
-                                    ruta_simulada = list(ruta)
-                                    ruta_simulada.insert(pos, f_loc)
-                                    
-                                    es_valida = True
-                                    dist_extra_total = 0
-                                    
-                                    for day in dias_activos:
-                                        t_sim, d_sim = calcular_tiempo_ruta_en_dia_especifico(ruta_simulada, day)
-                                        
-                                        # LA REGLA DE ORO DE LOS +10 MINUTOS EXACTOS (600 SEGUNDOS)
-                                        if t_sim > (max_time_sec + 600):
-                                            es_valida = False
-                                            break
-                                        
-                                        _, d_orig = calcular_tiempo_ruta_en_dia_especifico(ruta, day)
-                                        dist_extra_total += (d_sim - d_orig)
-                                        
-                                    if es_valida and dist_extra_total < min_extra_dist:
-                                        min_extra_dist = dist_extra_total
-                                        best_r = r_idx
-                                        best_pos = pos
-                                        
-                            if best_r != -1:
-                                rutas_core_locs[best_r].insert(best_pos, f_loc)
-                            else:
-                                # Si es físicamente imposible meterlo en los autos existentes con +10 min, abre auto nuevo.
-                                rutas_core_locs.append([f_loc])
+                        # 2. INYECCIÓN CON RELOJ ESTRICTO (LÍMITE + TOLERANCIA): 
+                        set_pico = set(lugares_pico_base)
+                        lugares_faltantes = [l for l in subset_lugares if l not in set_pico]
+                        # Cada esporádico va al hueco que menos distancia suma en sus días activos sin pasar el límite + tolerancia en ninguno
+                        limite_patron = max_time_sec + int(tolerancia_patron_min * 60)
+                        argumentos_inyeccion = (
+                            [[indice_global[l] for l in r] for r in rutas_core_locs], [indice_global[l] for l in lugares_faltantes],
+                            presente_global, matriz_dur_global, matriz_dist_global, end_idx_global, int(min_parada_vrp * 60), limite_patron
+                        )
+                        if k_inyeccion > 1:
+                            rutas_core = insertar_esporadicos_regret(*argumentos_inyeccion, k=k_inyeccion)
+                        else:
+                            rutas_core = insertar_esporadicos(*argumentos_inyeccion)
+
+                        # 3. OPTIMIZACIÓN SEMANAL: vaciar autos y reubicar clientes midiendo todos los días a la vez
+                        if optimizar_patron_semanal and rutas_core:
+                            subsets_restantes = len(subsets_preparados) - [s[0] for s in subsets_preparados].index(subset_name)
+                            segundos_patron = max(SEGUNDOS_MIN_POR_MODELO, (fin_optimizacion - time.monotonic()) / subsets_restantes)
+                            rutas_core = mejorar_patron(rutas_core, presente_global, matriz_dur_global, costo_patron_global, end_idx_global, int(min_parada_vrp * 60), limite_patron, segundos_patron)
+                        rutas_core_locs = [[lugares_globales[g] for g in r] for r in rutas_core]
                                 
                         for r in rutas_core_locs:
                             name_suffix = f" ({str(subset_name).strip()})" if subset_name != "General" else ""
@@ -1189,7 +1195,7 @@ else:
                             vehiculo_real_count += 1
 
                     # --- 4. APLICAR EL PATRÓN A CADA DÍA ---
-                    st.info("🗓️ Imprimiendo el Patrón Maestro final. Como la IA simuló el reloj estricto en la inyección (Max +10 min), mantenemos la flota mínima sin desfasar los horarios.")
+                    st.info(f"🗓️ Imprimiendo el Patrón Maestro final. Como la IA simuló el reloj estricto en la inyección (Max +{tolerancia_patron_min} min), mantenemos la flota mínima sin desfasar los horarios.")
                     for dia in dias_seleccionados:
                         df_dia = df[df['Día'] == dia].copy().reset_index(drop=True)
                         if punto_final_vrp not in df_dia['Lugar'].values:
@@ -1197,7 +1203,7 @@ else:
 
                         lugares_del_dia = set(df_dia['Lugar'].tolist())
                         
-                        lista_coords_dia = df_dia['Coords_Procesadas'].tolist()
+                        lista_coords_dia = coordenadas_lon_lat(df_dia)
                         if len(lista_coords_dia) > 1:
                             dibujar_geozona_circular(lista_coords_dia, f"🌍 DÍA: {dia}", "black", mapa_calculado)
 
@@ -1216,21 +1222,13 @@ else:
                             for l in lugares_hoy:
                                 fila = df_dia[df_dia['Lugar'] == l].iloc[0]
                                 filas_hoy.append(fila)
-                                coords_ordenadas.append(fila['Coords_Procesadas'])
+                                coords_ordenadas.append([fila['Lon'], fila['Lat']])
 
                             df_ruta_hoy = pd.DataFrame(filas_hoy)
                             ruta_nombre = ruta_maestra["nombre"]
                             id_unico = f"{dia} - {ruta_nombre}"
                             color_actual = colores[ruta_maestra["color_idx"] % len(colores)]
 
-                            geojson, err_dirs = obtener_trazado_masivo(coords_ordenadas, headers)
-                            if err_dirs:
-                                st.error(err_dirs)
-                                continue
-
-                            props = geojson['features'][0]['properties']['summary']
-                            segments = geojson['features'][0]['properties'].get('segments', [])
-
                             paradas_info = []
                             for _, row_hoy in df_ruta_hoy.iterrows():
                                 paradas_info.append({
@@ -1239,25 +1237,28 @@ else:
                                     "Coordenadas": row_hoy.get('Coordenadas','')
                                 })
 
-                            datos_para_resumen.append({
+                            trazados_pendientes.append({
                                 "id_unico": id_unico, "dia": dia, "ruta": ruta_nombre,
-                                "puntos": len(df_ruta_hoy), "dist_km": round(props['distance']/1000, 2),
-                                "drive_mins": round(props['duration']/60, 0), "color": color_actual,
-                                "paradas": paradas_info, "segmentos": segments,
-                                "geojson": geojson,
+                                "puntos": len(df_ruta_hoy), "color": color_actual,
+                                "paradas": paradas_info,
                                 "coords_ordenadas": coords_ordenadas
                             })
-                            
-                            fg_trazado = folium.FeatureGroup(name=f"🛣️ Trazado: {ruta_nombre} ({dia})")
-                            folium.GeoJson(geojson, style_function=lambda x, c=color_actual: {'color':c, 'weight':4, 'opacity':0.8}).add_to(fg_trazado)
 
-                            for i, (_, row_hoy) in enumerate(df_ruta_hoy.iterrows()):
-                                lat, lon = row_hoy['Coords_Procesadas'][1], row_hoy['Coords_Procesadas'][0]
-                                popup_txt = f"<b>{i+1}. {row_hoy.get('Lugar','')}</b><br>{row_hoy.get('Departamento','')}"
-                                icon_html = f"<div style='background:{color_actual};color:white;border-radius:50%;width:20px;text-align:center;border:1px solid white;font-weight:bold;font-size:10pt'>{i+1}</div>"
-                                folium.Marker([lat, lon], popup=popup_txt, icon=folium.DivIcon(html=icon_html)).add_to(fg_trazado)
+                datos_para_resumen = trazar_rutas_pendientes(trazados_pendientes, proveedor_ruteo)
+                avisar_uso_respaldo(proveedor_ruteo)
+
+                if "Patrón Fijo" in tipo_ruteo:
+                    for d in datos_para_resumen:
+                        fg_trazado = folium.FeatureGroup(name=f"🛣️ Trazado: {d['ruta']} ({d['dia']})")
+                        folium.GeoJson(d['geojson'], style_function=lambda x, c=d['color']: {'color':c, 'weight':4, 'opacity':0.8}).add_to(fg_trazado)
+
+                        for i, p in enumerate(d['paradas']):
+                            lat, lon = d['coords_ordenadas'][i][1], d['coords_ordenadas'][i][0]
+                            popup_txt = f"<b>{i+1}. {p.get('Lugar','')}</b><br>{p.get('Departamento','')}"
+                            icon_html = f"<div style='background:{d['color']};color:white;border-radius:50%;width:20px;text-align:center;border:1px solid white;font-weight:bold;font-size:10pt'>{i+1}</div>"
+                            folium.Marker([lat, lon], popup=popup_txt, icon=folium.DivIcon(html=icon_html)).add_to(fg_trazado)
 
-                            fg_trazado.add_to(mapa_calculado)
+                        fg_trazado.add_to(mapa_calculado)
 
                 folium.LayerControl(collapsed=True).add_to(mapa_calculado)
                 mapa_calculado.get_root().html.add_child(folium.Element(js_toggle_capas))
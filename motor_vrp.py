@@ -0,0 +1,771 @@
+import time
+import numpy as np
+import pandas as pd
+from ortools.constraint_solver import routing_enums_pb2
+from ortools.constraint_solver import pywrapcp
+
+# Funciones puras de armado y resolución de modelos: sin Streamlit ni estado global,
+# así los procesos del pool de cálculo pueden importarlas sin ejecutar la app.
+
+# --- MATRICES DE COSTO Y TIEMPO PARA EL SOLVER (SIN CALLBACKS DE PYTHON) ---
+PENALIZACION_SALIDA_FICTICIA = 100000000
+PENALIZACION_CRUCE_DEPTO = 500000
+COSTO_FIJO_VEHICULO = 100000000
+
+def codificar_deptos(deptos):
+    # Un código entero por departamento (sin distinguir mayúsculas ni espacios); -1 si está vacío
+    normalizados = pd.Series(list(deptos), dtype=object).map(str).str.strip().str.lower()
+    codigos, _ = pd.factorize(normalizados.mask(normalizados == ''))
+    return codigos
+
+def penalizacion_cruce_deptos(codigos_depto):
+    codigos_depto = np.asarray(codigos_depto)
+    con_depto = codigos_depto >= 0
+    cruza = (codigos_depto[:, np.newaxis] != codigos_depto[np.newaxis, :]) & con_depto[:, np.newaxis] & con_depto[np.newaxis, :]
+    return cruza.astype(np.int64) * PENALIZACION_CRUCE_DEPTO
+
+def matriz_costo_flota(matriz_dist, dummy_idx, end_idx, codigos_depto=None):
+    # Arranque desde el nodo ficticio castigado (cada auto que sale cuesta) y, si se pide, cruce de departamentos
+    costo = np.array(matriz_dist, dtype=np.int64)
+    costo[dummy_idx, np.arange(len(costo)) != end_idx] += PENALIZACION_SALIDA_FICTICIA
+    if codigos_depto is not None:
+        cruce = penalizacion_cruce_deptos(codigos_depto)
+        if end_idx < len(cruce):
+            cruce[end_idx, :] = 0
+            cruce[:, end_idx] = 0
+        costo[:len(cruce), :len(cruce)] += cruce
+    return costo
+
+def matriz_tiempo_con_espera(matriz_dur, segundos_parada, nodos_sin_espera):
+    espera = np.full(len(matriz_dur), int(segundos_parada), dtype=np.int64)
+    espera[list(nodos_sin_espera)] = 0
+    return np.asarray(matriz_dur, dtype=np.int64) + espera[np.newaxis, :]
+
+def registrar_matriz(routing, matriz):
+    return routing.RegisterTransitMatrix(np.asarray(matriz, dtype=np.int64).tolist())
+
+# --- PRESUPUESTO DE TIEMPO Y CORTE POR CONVERGENCIA ---
+SEGUNDOS_MIN_POR_MODELO = 0.5
+SEGUNDOS_MAX_POR_MODELO = 120.0
+
+def presupuesto_segundos(num_nodos):
+    # ~1-2 s para rutas chicas, crece algo más que lineal con el tamaño del modelo
+    return min(SEGUNDOS_MAX_POR_MODELO, max(SEGUNDOS_MIN_POR_MODELO, 1.0 + (num_nodos / 15.0) ** 1.3))
+
+def parametros_busqueda(segundos_limite, busqueda_guiada):
+    parametros = pywrapcp.DefaultRoutingSearchParameters()
+    parametros.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.SAVINGS
+    if busqueda_guiada:
+        parametros.local_search_metaheuristic = routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
+    parametros.time_limit.FromMilliseconds(max(1, int(segundos_limite * 1000)))
+    return parametros
+
+def cortar_sin_mejora(routing, segundos_sin_mejora):
+    # Cada solución nueva que acepta la búsqueda pasa por aquí: si el costo real no baja en la ventana, se termina
+    # (quien llama conserva la función devuelta mientras dura el Solve)
+    if not segundos_sin_mejora:
+        return None
+    estado = {"mejor": None, "desde": time.monotonic()}
+    def al_encontrar_solucion():
+        costo = routing.CostVar().Value()
+        ahora = time.monotonic()
+        if estado["mejor"] is None or costo < estado["mejor"]:
+            estado["mejor"], estado["desde"] = costo, ahora
+        elif ahora - estado["desde"] > segundos_sin_mejora:
+            routing.solver().FinishCurrentSearch()
+    routing.AddAtSolutionCallback(al_encontrar_solucion)
+    return al_encontrar_solucion
+
+# --- REPARACIÓN INCREMENTAL: INSERCIÓN MÁS BARATA SOBRE RUTAS CONOCIDAS ---
+FRACCION_PRESUPUESTO_REPARACION = 0.2
+
+def insertar_mas_barato(rutas, nodos_nuevos, costo, inicio, fin, tiempo=None, tiempo_max=None):
+    # Cada nodo nuevo va al hueco (entre dos paradas consecutivas de cualquier ruta) que menos costo agrega
+    # sin pasarse del tiempo máximo; si no entra en ninguna, abre una ruta propia
+    rutas = [list(r) for r in rutas]
+    costo = np.asarray(costo)
+    sin_lugar = np.iinfo(np.int64).max
+    for k in nodos_nuevos:
+        mejor = None
+        for i, ruta in enumerate(rutas):
+            secuencia = np.array([inicio] + ruta + [fin])
+            previos, siguientes = secuencia[:-1], secuencia[1:]
+            delta = costo[previos, k] + costo[k, siguientes] - costo[previos, siguientes]
+            if tiempo is not None:
+                extra = tiempo[previos, k] + tiempo[k, siguientes] - tiempo[previos, siguientes]
+                delta = np.where(tiempo[previos, siguientes].sum() + extra <= tiempo_max, delta, sin_lugar)
+            pos = int(np.argmin(delta))
+            if delta[pos] < sin_lugar and (mejor is None or delta[pos] < mejor[0]):
+                mejor = (delta[pos], i, pos)
+        if mejor is None:
+            rutas.append([k])
+        else:
+            rutas[mejor[1]].insert(mejor[2], k)
+    return rutas
+
+def semilla_reparable(costo, rutas_iniciales, inicio, fin, tiempo=None, tiempo_max=None, num_vehiculos=None, restricciones=None):
+    # Completa la semilla como lo hace el motor en modo reparación y dice si queda una asignación válida:
+    # flota = cada auto dentro del tiempo máximo y no más autos que el tope; recorrido = pines y precedencias respetados
+    if not rutas_iniciales:
+        return False
+    costo = np.asarray(costo)
+    if tiempo is None:
+        cubiertos = set(rutas_iniciales[0])
+        nuevos = [n for n in range(len(costo)) if n not in cubiertos and n != inicio and n != fin]
+        ruta = [n for r in insertar_mas_barato(rutas_iniciales[:1], nuevos, costo, inicio, fin) for n in r]
+        return cumple_restricciones(ruta, restricciones or restricciones_recorrido())
+    cubiertos = {n for ruta in rutas_iniciales for n in ruta}
+    nuevos = [n for n in range(len(costo)) if n not in cubiertos and n != inicio and n != fin]
+    tiempo = np.asarray(tiempo)
+    rutas = insertar_mas_barato(rutas_iniciales, nuevos, costo, inicio, fin, tiempo, tiempo_max)
+    if len(rutas) > (num_vehiculos or len(costo) - 1):
+        return False
+    for ruta in rutas:
+        secuencia = np.array([inicio] + list(ruta) + [fin])
+        if tiempo[secuencia[:-1], secuencia[1:]].sum() > tiempo_max:
+            return False
+    return True
+
+def resolver_desde_semilla(routing, manager, parametros, *semillas, segundos_sin_semilla=None):
+    # Arranque en caliente: la búsqueda parte de la primera semilla que sea una asignación válida; si ninguna lo es, de SAVINGS
+    # (con segundos_sin_semilla, el presupuesto recortado de una reparación vuelve a ser el completo)
+    semillas = [rutas for rutas in semillas if rutas]
+    if semillas:
+        routing.CloseModelWithParameters(parametros)
+        for rutas in semillas:
+            inicial = routing.ReadAssignmentFromRoutes([[manager.NodeToIndex(n) for n in ruta] for ruta in rutas], True)
+            if inicial is not None:
+                return routing.SolveFromAssignmentWithParameters(inicial, parametros)
+    if segundos_sin_semilla:
+        parametros.time_limit.FromMilliseconds(max(1, int(segundos_sin_semilla * 1000)))
+    return routing.SolveWithParameters(parametros)
+
+# --- RESTRICCIONES DE UN RECORRIDO (IA E IA v2 COMPARTEN EL MISMO MOTOR) ---
+def restricciones_recorrido(primero=-1, ultimo=-1, cadena=(), precedencias=()):
+    # primero/último: parada fija al salir y al llegar (-1 = la IA decide); cadena = [(anterior, siguiente)] pegados;
+    # precedencias = [(antes, después)] sin exigir que sean vecinos. Los pines que se contradicen se descartan.
+    primero, ultimo = int(primero), int(ultimo)
+    if primero != -1 and ultimo == primero:
+        ultimo = -1
+    grupo, sucesor_de, antecesor_de = {}, {}, {}
+    def raiz(n):
+        while grupo.get(n, n) != n:
+            n = grupo[n]
+        return n
+    pares = []
+    for previo, siguiente in cadena:
+        previo, siguiente = int(previo), int(siguiente)
+        if previo == -1 or siguiente == -1 or previo == siguiente or previo == ultimo or siguiente == primero:
+            continue
+        if previo in sucesor_de or siguiente in antecesor_de or raiz(previo) == raiz(siguiente):
+            continue
+        sucesor_de[previo], antecesor_de[siguiente] = siguiente, previo
+        grupo[raiz(siguiente)] = raiz(previo)
+        pares.append((previo, siguiente))
+    return {"primero": primero, "ultimo": ultimo, "cadena": pares, "precedencias": [(int(a), int(b)) for a, b in precedencias]}
+
+def aplicar_restricciones(routing, manager, restricciones):
+    # Se fijan las variables "siguiente" en vez de vetar arcos con costos gigantes: la búsqueda ni los considera
+    if restricciones["primero"] != -1:
+        routing.NextVar(routing.Start(0)).SetValue(manager.NodeToIndex(restricciones["primero"]))
+    if restricciones["ultimo"] != -1:
+        routing.NextVar(manager.NodeToIndex(restricciones["ultimo"])).SetValue(routing.End(0))
+    for previo, siguiente in restricciones["cadena"]:
+        routing.NextVar(manager.NodeToIndex(previo)).SetValue(manager.NodeToIndex(siguiente))
+    if restricciones["precedencias"]:
+        paso = routing.RegisterUnaryTransitVector([1] * manager.GetNumberOfNodes())
+        routing.AddDimension(paso, 0, manager.GetNumberOfNodes(), True, "Sequence")
+        seq_dim = routing.GetDimensionOrDie("Sequence")
+        solver = routing.solver()
+        for antes, despues in restricciones["precedencias"]:
+            solver.Add(seq_dim.CumulVar(manager.NodeToIndex(antes)) < seq_dim.CumulVar(manager.NodeToIndex(despues)))
+
+def recorrido_factible(costo, inicio, fin, restricciones):
+    # Vecino más cercano entre las paradas habilitadas (antecesores ya visitados, pines respetados);
+    # la cadena que termina en 'ultimo' se reserva para el final. None si el orden voraz se traba.
+    costo = np.asarray(costo)
+    clientes = [k for k in range(len(costo)) if k != inicio and k != fin]
+    siguiente_fijo = dict(restricciones["cadena"])
+    anterior_fijo = {b: a for a, b in restricciones["cadena"]}
+    faltan_antes = dict.fromkeys(clientes, 0)
+    despues_de = {k: [] for k in clientes}
+    for antes, despues in restricciones["precedencias"]:
+        faltan_antes[despues] += 1
+        despues_de[antes].append(despues)
+    cola = []
+    if restricciones["ultimo"] != -1:
+        nodo = restricciones["ultimo"]
+        while nodo != -1:
+            cola.insert(0, nodo)
+            nodo = anterior_fijo.get(nodo, -1)
+    en_cola = set(cola)
+    ruta, visitados, actual = [], set(), inicio
+    while len(ruta) < len(clientes):
+        if len(clientes) - len(ruta) == len(cola) and cola[0] not in visitados:
+            forzado = cola[0]
+        elif actual == inicio and restricciones["primero"] != -1:
+            forzado = restricciones["primero"]
+        else:
+            forzado = siguiente_fijo.get(actual, -1)
+        if forzado != -1:
+            candidatos = [forzado] if faltan_antes[forzado] == 0 and forzado not in visitados else []
+        else:
+            candidatos = [k for k in clientes if k not in visitados and faltan_antes[k] == 0 and k not in anterior_fijo and k not in en_cola and k != restricciones["primero"]]
+        if not candidatos:
+            return None
+        actual = candidatos[int(np.argmin(costo[actual, candidatos]))]
+        ruta.append(actual)
+        visitados.add(actual)
+        for despues in despues_de[actual]:
+            faltan_antes[despues] -= 1
+    return ruta
+
+# --- MODELO DE UN SOLO RECORRIDO (RUTEO IA Y IA v2) ---
+def resolver_secuencia(costo, inicio, fin, restricciones=None, segundos_limite=5, segundos_sin_mejora=None, rutas_iniciales=None, reparar=False):
+    # Un vehículo de 'inicio' a 'fin' (nodos auxiliares a costo 0) con las restricciones de restricciones_recorrido()
+    if rutas_iniciales and reparar:
+        cubiertos = set(rutas_iniciales[0])
+        nuevos = [n for n in range(len(costo)) if n not in cubiertos and n != inicio and n != fin]
+        rutas_iniciales = [[n for ruta in insertar_mas_barato(rutas_iniciales[:1], nuevos, costo, inicio, fin) for n in ruta]]
+    manager = pywrapcp.RoutingIndexManager(len(costo), 1, [inicio], [fin])
+    routing = pywrapcp.RoutingModel(manager)
+    routing.SetArcCostEvaluatorOfAllVehicles(registrar_matriz(routing, costo))
+    restricciones = restricciones or restricciones_recorrido()
+    aplicar_restricciones(routing, manager, restricciones)
+    # Las heurísticas iniciales del solver no respetan pines ni precedencias: si hay, se parte de un recorrido factible propio
+    hay_restricciones = restricciones["primero"] != -1 or restricciones["ultimo"] != -1 or restricciones["cadena"] or restricciones["precedencias"]
+    factible = recorrido_factible(costo, inicio, fin, restricciones) if hay_restricciones else None
+
+    monitor = cortar_sin_mejora(routing, segundos_sin_mejora)
+    solution = resolver_desde_semilla(routing, manager, parametros_busqueda(segundos_limite, True), rutas_iniciales, factible and [factible], segundos_sin_semilla=segundos_limite / FRACCION_PRESUPUESTO_REPARACION if reparar else None)
+    if not solution:
+        return None
+    nodos = []
+    idx = routing.Start(0)
+    while not routing.IsEnd(idx):
+        node = manager.IndexToNode(idx)
+        if node != inicio:
+            nodos.append(node)
+        idx = solution.Value(routing.NextVar(idx))
+    return nodos
+
+# --- MOTOR PROPIO DE UN SOLO RECORRIDO: EXACTO PARA POCAS PARADAS, 2-OPT / OR-OPT VECTORIZADOS PARA EL RESTO ---
+PARADAS_MAX_EXACTO = 16
+LARGO_MAX_OR_OPT = 3
+PATEADAS_SIN_MEJORA = 100
+
+def cumple_restricciones(ruta, restricciones):
+    # Chequeo vectorizado sobre posiciones: primero/último en su lugar, cadenas pegadas y precedencias en orden
+    ruta = np.asarray(ruta, dtype=np.int64)
+    pos = np.empty(ruta.max() + 1 if len(ruta) else 0, dtype=np.int64)
+    pos[ruta] = np.arange(len(ruta))
+    if restricciones["primero"] != -1 and (not len(ruta) or ruta[0] != restricciones["primero"]):
+        return False
+    if restricciones["ultimo"] != -1 and (not len(ruta) or ruta[-1] != restricciones["ultimo"]):
+        return False
+    cadena = np.array(restricciones["cadena"], dtype=np.int64).reshape(-1, 2)
+    precedencias = np.array(restricciones["precedencias"], dtype=np.int64).reshape(-1, 2)
+    return bool((pos[cadena[:, 1]] == pos[cadena[:, 0]] + 1).all() and (pos[precedencias[:, 0]] < pos[precedencias[:, 1]]).all())
+
+def costo_camino(costo, inicio, fin, ruta):
+    secuencia = np.array([inicio] + list(ruta) + [fin], dtype=np.int64)
+    return int(costo[secuencia[:-1], secuencia[1:]].sum())
+
+def camino_exacto(costo, inicio, fin, clientes, restricciones):
+    # Held-Karp por capas de subconjuntos: dp[subconjunto, último] = menor costo de recorrer el subconjunto terminando ahí.
+    # Cada (subconjunto, último) sale de un único subconjunto previo, así que cada capa se llena sin min.at
+    n = len(clientes)
+    local = {c: u for u, c in enumerate(clientes)}
+    c = np.asarray(costo, dtype=float)[np.ix_(clientes, clientes)]
+    primero = local.get(restricciones["primero"], -1)
+    ultimo = local.get(restricciones["ultimo"], -1)
+    # permitido[i, j]: j puede ir justo después de i según primero/último y las cadenas
+    permitido = ~np.eye(n, dtype=bool)
+    for a, b in restricciones["cadena"]:
+        permitido[local[a], :] = False
+        permitido[:, local[b]] = False
+        permitido[local[a], local[b]] = True
+    if primero != -1:
+        permitido[:, primero] = False
+    if ultimo != -1:
+        permitido[ultimo, :] = False
+    requiere = np.zeros(n, dtype=np.int64)
+    for a, b in restricciones["precedencias"]:
+        requiere[local[b]] |= 1 << local[a]
+    con_antecesor_fijo = np.zeros(n, dtype=bool)
+    con_sucesor_fijo = np.zeros(n, dtype=bool)
+    for a, b in restricciones["cadena"]:
+        con_antecesor_fijo[local[b]] = True
+        con_sucesor_fijo[local[a]] = True
+
+    total = 1 << n
+    completo = total - 1
+    dp = np.full((total, n), np.inf)
+    padre = np.full((total, n), -1, dtype=np.int64)
+    arranque = (requiere == 0) & ~con_antecesor_fijo & ((np.arange(n) == primero) if primero != -1 else True) & ((np.arange(n) != ultimo) | (n == 1))
+    dp[1 << np.arange(n)[arranque], np.arange(n)[arranque]] = np.asarray(costo, dtype=float)[inicio, np.asarray(clientes)[arranque]]
+    mascaras = np.arange(total, dtype=np.int64)
+    bits = ((mascaras[:, np.newaxis] >> np.arange(n)) & 1).astype(bool)
+    por_capa = bits.sum(axis=1)
+    for capa in range(2, n + 1):
+        de_capa = mascaras[por_capa == capa]
+        for j in range(n):
+            destino = de_capa[bits[de_capa, j]]
+            if j == ultimo and capa < n:
+                continue
+            previo = destino ^ (1 << j)
+            valido = (previo & requiere[j]) == requiere[j]
+            destino, previo = destino[valido], previo[valido]
+            if not destino.size:
+                continue
+            candidato = np.where(permitido[:, j][np.newaxis, :], dp[previo] + c[:, j][np.newaxis, :], np.inf)
+            mejor = np.argmin(candidato, axis=1)
+            dp[destino, j] = candidato[np.arange(len(destino)), mejor]
+            padre[destino, j] = mejor
+    cierre = dp[completo] + np.asarray(costo, dtype=float)[np.asarray(clientes), fin]
+    cierre[con_sucesor_fijo] = np.inf
+    if ultimo != -1:
+        cierre[np.arange(n) != ultimo] = np.inf
+    if not np.isfinite(cierre.min()):
+        return None
+    ruta, mascara, j = [], completo, int(np.argmin(cierre))
+    while j != -1:
+        ruta.append(clientes[j])
+        mascara, j = mascara ^ (1 << j), int(padre[mascara, j])
+    return ruta[::-1]
+
+def mejorar_camino(costo, inicio, fin, ruta, restricciones, segundos_max):
+    # Búsqueda local con todos los movimientos evaluados de una vez: 2-opt con sumas prefijas en ambos sentidos
+    # (la matriz no es simétrica, el tramo invertido se paga al revés) y Or-opt de 1 a 3 paradas sin invertir.
+    # Se aplica el movimiento que más ahorra entre los que respetan las restricciones.
+    fin_busqueda = time.monotonic() + segundos_max
+    costo = np.asarray(costo, dtype=np.int64)
+    ruta = list(ruta)
+    n = len(ruta)
+    while n > 2 and time.monotonic() < fin_busqueda:
+        s = np.array([inicio] + ruta + [fin], dtype=np.int64)
+        ida = np.concatenate([[0], np.cumsum(costo[s[:-1], s[1:]])])
+        vuelta = np.concatenate([[0], np.cumsum(costo[s[1:], s[:-1]])])
+        # Cada movimiento es (ahorro, tipo, a, b); tipo 0 = 2-opt, tipo L = Or-opt de L paradas
+        deltas, tipos, desdes, hastas = [], [], [], []
+        # 2-opt: invertir s[i..j], 1 <= i < j <= n
+        i, j = np.triu_indices(n + 1, 1)
+        i, j = i[i >= 1], j[i >= 1]
+        delta = costo[s[i - 1], s[j]] + costo[s[i], s[j + 1]] - costo[s[i - 1], s[i]] - costo[s[j], s[j + 1]] + (vuelta[j] - vuelta[i]) - (ida[j] - ida[i])
+        mejora = delta < 0
+        deltas.append(delta[mejora]); tipos.append(np.zeros(mejora.sum(), dtype=np.int64)); desdes.append(i[mejora]); hastas.append(j[mejora])
+        # Or-opt: el tramo s[i..i+L-1] pasa a quedar entre s[k] y s[k+1]
+        for largo in range(1, min(LARGO_MAX_OR_OPT, n - 1) + 1):
+            i, k = np.meshgrid(np.arange(1, n - largo + 2), np.arange(0, n + 1), indexing='ij')
+            i, k = i.ravel(), k.ravel()
+            u = i + largo - 1
+            fuera = (k < i - 1) | (k > u)
+            i, k, u = i[fuera], k[fuera], u[fuera]
+            delta = (costo[s[k], s[i]] + costo[s[u], s[k + 1]] - costo[s[k], s[k + 1]]) - (costo[s[i - 1], s[i]] + costo[s[u], s[u + 1]] - costo[s[i - 1], s[u + 1]])
+            mejora = delta < 0
+            deltas.append(delta[mejora]); tipos.append(np.full(mejora.sum(), largo)); desdes.append(i[mejora]); hastas.append(k[mejora])
+        deltas, tipos, desdes, hastas = (np.concatenate(x) for x in (deltas, tipos, desdes, hastas))
+        aplicado = False
+        for m in np.argsort(deltas, kind='stable'):
+            tipo, a, b = int(tipos[m]), int(desdes[m]), int(hastas[m])
+            if tipo == 0:
+                candidata = ruta[:a - 1] + ruta[a - 1:b][::-1] + ruta[b:]
+            else:
+                tramo = ruta[a - 1:a - 1 + tipo]
+                resto = ruta[:a - 1] + ruta[a - 1 + tipo:]
+                corte = b if b < a else b - tipo
+                candidata = resto[:corte] + tramo + resto[corte:]
+            if cumple_restricciones(candidata, restricciones):
+                ruta, aplicado = candidata, True
+                break
+            if time.monotonic() >= fin_busqueda:
+                break
+        if not aplicado:
+            break
+    return ruta
+
+def resolver_camino(costo, inicio, fin, restricciones=None, segundos_limite=5, segundos_sin_mejora=None, rutas_iniciales=None, reparar=False):
+    # Mismo contrato que resolver_secuencia: exacto hasta PARADAS_MAX_EXACTO paradas; si no, la mejor semilla factible
+    # (plan conocido o vecino más cercano con restricciones) + búsqueda local iterada. Con cadenas o precedencias
+    # la búsqueda local se queda corta, así que su resultado siembra a resolver_secuencia y gana el más barato.
+    # Si no hay ninguna semilla factible, decide resolver_secuencia.
+    restricciones = restricciones or restricciones_recorrido()
+    clientes = [k for k in range(len(costo)) if k != inicio and k != fin]
+    if len(clientes) <= 1:
+        return clientes
+    if len(clientes) <= PARADAS_MAX_EXACTO:
+        return camino_exacto(costo, inicio, fin, clientes, restricciones)
+    semillas = []
+    if rutas_iniciales:
+        semilla = list(rutas_iniciales[0])
+        nuevos = [n for n in clientes if n not in set(semilla)]
+        semilla = [n for ruta in insertar_mas_barato([semilla], nuevos, costo, inicio, fin) for n in ruta]
+        if sorted(semilla) == clientes and cumple_restricciones(semilla, restricciones):
+            semillas.append(semilla)
+    if reparar and not semillas:
+        # La semilla no sirvió: esto ya no es una reparación y vuelve el presupuesto completo
+        segundos_limite /= FRACCION_PRESUPUESTO_REPARACION
+        reparar = False
+    factible = recorrido_factible(costo, inicio, fin, restricciones)
+    if factible is not None and cumple_restricciones(factible, restricciones):
+        semillas.append(factible)
+    if not semillas:
+        return resolver_secuencia(costo, inicio, fin, restricciones, segundos_limite, segundos_sin_mejora, rutas_iniciales, reparar)
+    costo = np.asarray(costo, dtype=np.int64)
+    fin_total = time.monotonic() + segundos_limite
+    pulir = bool(restricciones["cadena"] or restricciones["precedencias"])
+    fin_busqueda = time.monotonic() + (segundos_limite / 2 if pulir else segundos_limite)
+    mejor = mejorar_camino(costo, inicio, fin, min(semillas, key=lambda s: costo_camino(costo, inicio, fin, s)), restricciones, fin_busqueda - time.monotonic())
+    mejor_costo = costo_camino(costo, inicio, fin, mejor)
+    # Búsqueda local iterada: se intercambian dos tramos consecutivos (sin invertir) y se vuelve a bajar; termina tras
+    # PATEADAS_SIN_MEJORA intentos seguidos sin mejorar, segundos_sin_mejora sin bajar el costo o al agotar el tiempo
+    rng = np.random.default_rng(0)
+    sin_mejora = 0
+    ultima_mejora = time.monotonic()
+    while sin_mejora < PATEADAS_SIN_MEJORA and time.monotonic() < fin_busqueda:
+        if segundos_sin_mejora and time.monotonic() - ultima_mejora > segundos_sin_mejora:
+            break
+        sin_mejora += 1
+        a, b, c = np.sort(rng.choice(np.arange(1, len(mejor)), 3, replace=False))
+        pateada = mejor[:a] + mejor[b:c] + mejor[a:b] + mejor[c:]
+        if not cumple_restricciones(pateada, restricciones):
+            continue
+        nueva = mejorar_camino(costo, inicio, fin, pateada, restricciones, fin_busqueda - time.monotonic())
+        nuevo_costo = costo_camino(costo, inicio, fin, nueva)
+        if nuevo_costo < mejor_costo:
+            mejor, mejor_costo, sin_mejora, ultima_mejora = nueva, nuevo_costo, 0, time.monotonic()
+    if pulir:
+        pulido = resolver_secuencia(costo, inicio, fin, restricciones, max(SEGUNDOS_MIN_POR_MODELO, fin_total - time.monotonic()), segundos_sin_mejora, [mejor])
+        if pulido is not None and cumple_restricciones(pulido, restricciones) and costo_camino(costo, inicio, fin, pulido) < mejor_costo:
+            mejor = pulido
+    return mejor
+
+# --- COTAS DE FLOTA: EL MODELO ARRANCA CON LOS AUTOS QUE HACEN FALTA, NO CON UNO POR PARADA ---
+HOLGURA_FLOTA = 2
+
+def cotas_flota(tiempo, dummy_idx, end_idx, tiempo_max):
+    # Mínimo: con R autos, a lo sumo R clientes llegan desde el ficticio (sin viaje); el resto llega, como mínimo,
+    # desde el cliente más cercano, y cada auto paga un cierre. El menor R cuyo tiempo total cabe en R jornadas.
+    # Máximo: autos de un armado vecino-más-cercano que respeta la jornada (siempre existe una solución con esos).
+    tiempo = np.asarray(tiempo, dtype=np.int64)
+    clientes = np.array([n for n in range(len(tiempo)) if n != dummy_idx and n != end_idx], dtype=np.int64)
+    if not clientes.size:
+        return 0, 0
+    desde_ficticio = tiempo[dummy_idx, clientes].astype(float)
+    llegada = tiempo[np.ix_(clientes, clientes)].astype(float)
+    np.fill_diagonal(llegada, np.inf)
+    llegada = llegada.min(axis=0)
+    llegada = np.where(np.isfinite(llegada), llegada, desde_ficticio)
+    autos = np.arange(1, len(clientes) + 1)
+    primeros = np.cumsum(np.sort(np.maximum(0, llegada - desde_ficticio))[::-1])
+    cierres = np.cumsum(np.sort(tiempo[clientes, end_idx].astype(float)))
+    alcanza = llegada.sum() - primeros + cierres <= autos * tiempo_max
+    minimo = int(autos[np.argmax(alcanza)]) if alcanza.any() else len(clientes)
+
+    cierre = tiempo[clientes, end_idx]
+    pendientes = np.ones(len(clientes), dtype=bool)
+    maximo = 0
+    while pendientes.any():
+        # Cada auto arranca por el cliente pendiente más lejano del destino y suma el más cercano que aún le entra
+        maximo += 1
+        actual = np.flatnonzero(pendientes)[np.argmax(cierre[pendientes])]
+        pendientes[actual] = False
+        reloj = tiempo[dummy_idx, clientes[actual]]
+        while pendientes.any():
+            candidatos = np.flatnonzero(pendientes)
+            llega = reloj + tiempo[clientes[actual], clientes[candidatos]]
+            entra = llega + cierre[candidatos] <= tiempo_max
+            if not entra.any():
+                break
+            mejor = np.argmin(np.where(entra, llega, np.iinfo(np.int64).max))
+            actual, reloj = candidatos[mejor], llega[mejor]
+            pendientes[actual] = False
+    return minimo, maximo
+
+# --- MODELO DE FLOTA LIBRE (CREACIÓN DE RUTAS PROPIAS Y PATRÓN BASE) ---
+def restringir_a_vecinos(routing, manager, costo, vecinos_k, nodos, num_vehiculos, rutas_iniciales=None):
+    # Lista de candidatos dispersa: cada parada solo sigue hacia sus k sucesores más baratos o cierra el auto;
+    # los arcos de la semilla se conservan para que siga siendo una asignación válida
+    nodos = np.asarray(nodos, dtype=np.int64)
+    sub = np.asarray(costo, dtype=float)[np.ix_(nodos, nodos)]
+    np.fill_diagonal(sub, np.inf)
+    cercanos = nodos[np.argpartition(sub, vecinos_k - 1, axis=1)[:, :vecinos_k]]
+    permitidos = {int(i): set(cercanos[u].tolist()) for u, i in enumerate(nodos)}
+    for ruta in rutas_iniciales or []:
+        for a, b in zip(ruta, ruta[1:]):
+            permitidos[a].add(b)
+    cierres = [routing.End(v) for v in range(num_vehiculos)]
+    for i, sucesores in permitidos.items():
+        routing.NextVar(manager.NodeToIndex(i)).SetValues([manager.NodeToIndex(j) for j in sucesores] + cierres)
+
+def resolver_flota(costo, tiempo, dummy_idx, end_idx, tiempo_max, num_vehiculos=None, segundos_limite=10, busqueda_guiada=False, segundos_sin_mejora=None, rutas_iniciales=None, reparar=False, vecinos_k=None, cotas=None):
+    # Todos los autos salen del nodo ficticio y terminan en 'end_idx'; devuelve solo los autos usados, sin ficticio ni destino.
+    # Sin flota dada, el modelo se arma con la cota superior más una holgura que no pasa de la distancia a la
+    # inferior (si coinciden, esa flota ya es la mínima) y solo si no encuentra solución, con un auto por parada.
+    # No se prueba por debajo de la superior: un armado que no encuentra solución cuesta tanto como uno que sí.
+    # 'cotas' = (mínimo, máximo) de cotas_flota si quien llama ya las calculó.
+    tope = len(costo) - 1
+    if num_vehiculos is None:
+        minimo, maximo = cotas or cotas_flota(tiempo, dummy_idx, end_idx, tiempo_max)
+        intentos = [min(tope, maximo + min(HOLGURA_FLOTA, maximo - minimo)), tope]
+    else:
+        tope = num_vehiculos
+        intentos = [tope]
+    if rutas_iniciales:
+        # Los clientes que la semilla no cubre se insertan donde menos cuestan (modo reparación)
+        # o arrancan en un auto propio, siempre factible, y la búsqueda los reubica
+        cubiertos = {n for ruta in rutas_iniciales for n in ruta}
+        nuevos = [n for n in range(len(costo)) if n not in cubiertos and n != dummy_idx and n != end_idx]
+        if reparar:
+            rutas_iniciales = insertar_mas_barato(rutas_iniciales, nuevos, costo, dummy_idx, end_idx, np.asarray(tiempo), tiempo_max)
+        else:
+            rutas_iniciales = list(rutas_iniciales) + [[n] for n in nuevos]
+        if len(rutas_iniciales) > tope:
+            rutas_iniciales = None
+        else:
+            intentos = [max(flota, len(rutas_iniciales)) for flota in intentos]
+    # Los reintentos comparten el presupuesto: cada uno usa lo que dejó el anterior
+    fin_busqueda = time.monotonic() + segundos_limite
+    for flota in dict.fromkeys(intentos):
+        segundos = max(SEGUNDOS_MIN_POR_MODELO, fin_busqueda - time.monotonic())
+        rutas = resolver_flota_con(costo, tiempo, dummy_idx, end_idx, tiempo_max, flota, segundos, busqueda_guiada, segundos_sin_mejora, rutas_iniciales, vecinos_k, segundos / FRACCION_PRESUPUESTO_REPARACION if reparar else None)
+        if rutas is not None:
+            return rutas
+    return None
+
+def resolver_flota_con(costo, tiempo, dummy_idx, end_idx, tiempo_max, num_vehiculos, segundos_limite, busqueda_guiada, segundos_sin_mejora, rutas_iniciales, vecinos_k, segundos_sin_semilla=None):
+    manager = pywrapcp.RoutingIndexManager(len(costo), num_vehiculos, [dummy_idx] * num_vehiculos, [int(end_idx)] * num_vehiculos)
+    routing = pywrapcp.RoutingModel(manager)
+    routing.SetArcCostEvaluatorOfAllVehicles(registrar_matriz(routing, costo))
+    routing.SetFixedCostOfAllVehicles(COSTO_FIJO_VEHICULO)
+    routing.AddDimension(registrar_matriz(routing, tiempo), 0, int(tiempo_max), True, "Time")
+    clientes = [n for n in range(len(costo)) if n != dummy_idx and n != end_idx]
+    if vecinos_k and len(clientes) > vecinos_k + 1:
+        restringir_a_vecinos(routing, manager, costo, vecinos_k, clientes, num_vehiculos, rutas_iniciales)
+
+    monitor = cortar_sin_mejora(routing, segundos_sin_mejora)
+    solution = resolver_desde_semilla(routing, manager, parametros_busqueda(segundos_limite, busqueda_guiada), rutas_iniciales, segundos_sin_semilla=segundos_sin_semilla)
+    if not solution:
+        return None
+    rutas = []
+    for vehicle_id in range(num_vehiculos):
+        index = routing.Start(vehicle_id)
+        if manager.IndexToNode(solution.Value(routing.NextVar(index))) == end_idx:
+            continue
+        nodos = []
+        while not routing.IsEnd(index):
+            node = manager.IndexToNode(index)
+            if node != dummy_idx:
+                nodos.append(node)
+            index = solution.Value(routing.NextVar(index))
+        rutas.append(nodos)
+    return rutas
+
+# --- PATRÓN FIJO: INSERCIÓN DE CLIENTES ESPORÁDICOS CON RELOJ POR DÍA ---
+def reloj_ruta_por_dia(ruta, presente, dur, dist, end_idx, segundos_parada):
+    # Matrices [día, hueco] de una ruta maestra (hueco h = antes de la posición h, 0..L): parada anterior y siguiente
+    # que existen ese día (-1 = ninguna, end_idx = el destino), tiempo total de ese día y tramo que se reemplaza al insertar
+    g = np.asarray(ruta, dtype=np.int64)
+    largo = len(g)
+    activos = presente[g].T
+    dias = activos.shape[0]
+    posiciones = np.arange(largo)
+    ultimo = np.maximum.accumulate(np.where(activos, posiciones, -1), axis=1) if largo else np.empty((dias, 0), dtype=np.int64)
+    primero = np.minimum.accumulate(np.where(activos, posiciones, largo)[:, ::-1], axis=1)[:, ::-1] if largo else np.empty((dias, 0), dtype=np.int64)
+    pos_previa = np.concatenate([np.full((dias, 1), -1), ultimo], axis=1)
+    pos_siguiente = np.concatenate([primero, np.full((dias, 1), largo)], axis=1)
+    con_destino = np.append(g, end_idx)
+    previo = np.where(pos_previa >= 0, con_destino[pos_previa.clip(0)], -1)
+    siguiente = con_destino[pos_siguiente]
+    tiempo_dia = (activos * (segundos_parada + dur[g[np.newaxis, :], siguiente[:, 1:]])).sum(axis=1)
+    tiene_previo = previo >= 0
+    tramo_t = np.where(tiene_previo, dur[previo.clip(0), siguiente], 0)
+    tramo_d = np.where(tiene_previo, dist[previo.clip(0), siguiente], 0)
+    return previo, siguiente, np.repeat(tiempo_dia[:, np.newaxis], largo + 1, axis=1), tramo_t, tramo_d
+
+def costo_insercion(clientes, reloj, dias_cliente, dur, dist, segundos_parada, tiempo_limite):
+    # Costo [cliente, hueco]: solo los días en que el cliente existe (dias_cliente [cliente, día]) suman distancia
+    # y cada uno de esos días debe seguir dentro del tiempo límite; inf si no entra en el hueco
+    previo, siguiente, tiempo_dia, tramo_t, tramo_d = reloj
+    tiene_previo = previo >= 0
+    p = previo.clip(0)
+    c = np.asarray(clientes, dtype=np.int64)[:, np.newaxis, np.newaxis]
+    extra_t = segundos_parada + np.where(tiene_previo, dur[p, c], 0) + dur[c, siguiente] - tramo_t
+    extra_d = np.where(tiene_previo, dist[p, c], 0) + dist[c, siguiente] - tramo_d
+    en_dia = dias_cliente[:, :, np.newaxis]
+    valido = ((tiempo_dia + extra_t <= tiempo_limite) | ~en_dia).all(axis=1)
+    return np.where(valido, (extra_d * en_dia).sum(axis=1), np.inf)
+
+def insertar_esporadicos(rutas, clientes, presente, dur, dist, end_idx, segundos_parada, tiempo_limite):
+    # Inserción más barata en el orden dado. Los relojes de todas las rutas van pegados uno al lado del otro
+    # (columnas = huecos) y tras cada inserción solo se reemplazan las columnas de la ruta que cambió.
+    # presente[nodo, día] indica qué días existe cada nodo; los que no entran en ningún auto abren uno propio.
+    rutas = [list(r) for r in rutas]
+    dur = np.asarray(dur, dtype=np.int64)
+    dist = np.asarray(dist, dtype=np.int64)
+    dias_total = presente.shape[1]
+    relojes = [reloj_ruta_por_dia(r, presente, dur, dist, end_idx, segundos_parada) for r in rutas]
+    reloj = [np.concatenate([x[k] for x in relojes], axis=1) if relojes else np.empty((dias_total, 0), dtype=np.int64) for k in range(5)]
+    huecos = np.cumsum([0] + [len(r) + 1 for r in rutas])
+    for cliente in clientes:
+        dias = np.flatnonzero(presente[cliente])
+        costo = costo_insercion([cliente], [m[dias] for m in reloj], np.ones((1, len(dias)), dtype=bool), dur, dist, segundos_parada, tiempo_limite)[0]
+        mejor = int(np.argmin(costo)) if len(costo) else -1
+        if mejor == -1 or not np.isfinite(costo[mejor]):
+            rutas.append([cliente])
+            r = len(rutas) - 1
+            huecos = np.append(huecos, huecos[-1])
+        else:
+            r = int(np.searchsorted(huecos, mejor, side='right')) - 1
+            rutas[r].insert(mejor - int(huecos[r]), cliente)
+        nuevo = reloj_ruta_por_dia(rutas[r], presente, dur, dist, end_idx, segundos_parada)
+        reloj = [np.concatenate([m[:, :huecos[r]], n, m[:, huecos[r + 1]:]], axis=1) for m, n in zip(reloj, nuevo)]
+        huecos[r + 1:] += len(rutas[r]) + 1 - (huecos[r + 1] - huecos[r])
+    return rutas
+
+def insertar_esporadicos_regret(rutas, clientes, presente, dur, dist, end_idx, segundos_parada, tiempo_limite, k=2):
+    # Regret-k: en cada vuelta entra el cliente que más perdería si no tomara ya su mejor ruta
+    # (suma de diferencias con su 2ª..k-ésima mejor ruta), así los de pocas opciones no quedan para el final y abren autos.
+    # Se guarda el mejor costo [cliente, ruta] y tras cada inserción solo se re-evalúa, en bloque, la ruta que cambió
+    # y solo para los clientes que comparten algún día con el insertado (para el resto la ruta no cambió esos días).
+    rutas = [list(r) for r in rutas]
+    dur = np.asarray(dur, dtype=np.int64)
+    dist = np.asarray(dist, dtype=np.int64)
+    clientes = np.asarray(list(clientes), dtype=np.int64)
+    dias_cliente = presente[clientes]
+    costo = np.full((len(clientes), len(rutas)), np.inf)
+    posicion = np.zeros((len(clientes), len(rutas)), dtype=np.int64)
+    pendientes = np.ones(len(clientes), dtype=bool)
+    def reevaluar(r, afectados=None):
+        idx = np.flatnonzero(pendientes if afectados is None else pendientes & afectados)
+        reloj = reloj_ruta_por_dia(rutas[r], presente, dur, dist, end_idx, segundos_parada)
+        c = costo_insercion(clientes[idx], reloj, dias_cliente[idx], dur, dist, segundos_parada, tiempo_limite)
+        posicion[idx, r] = np.argmin(c, axis=1)
+        costo[idx, r] = c[np.arange(len(idx)), posicion[idx, r]]
+    for r in range(len(rutas)):
+        reevaluar(r)
+    while pendientes.any():
+        idx = np.flatnonzero(pendientes)
+        ordenados = np.sort(costo[idx], axis=1)
+        mejor = ordenados[:, 0] if len(rutas) else np.full(len(idx), np.inf)
+        sin_lugar = ~np.isfinite(mejor)
+        if sin_lugar.any():
+            # Un cliente que no entra en ningún auto abre uno propio, al que los demás ya pueden sumarse
+            i = idx[np.flatnonzero(sin_lugar)[0]]
+            rutas.append([int(clientes[i])])
+            costo = np.hstack([costo, np.full((len(clientes), 1), np.inf)])
+            posicion = np.hstack([posicion, np.zeros((len(clientes), 1), dtype=np.int64)])
+            r = len(rutas) - 1
+        else:
+            # Rutas donde no entra cuentan como una pérdida enorme pero finita, para poder ordenar
+            alternativas = np.where(np.isfinite(ordenados[:, 1:k]), ordenados[:, 1:k], 1e15)
+            regret = (alternativas - mejor[:, np.newaxis]).sum(axis=1)
+            j = np.lexsort((mejor, -regret))[0]
+            i = idx[j]
+            r = int(np.argmin(costo[i]))
+            rutas[r].insert(int(posicion[i, r]), int(clientes[i]))
+            # Los huecos después del insertado se corren uno; los días sin el insertado no cambian de costo
+            posicion[:, r] += posicion[:, r] > posicion[i, r]
+        pendientes[i] = False
+        if pendientes.any():
+            reevaluar(r, None if len(rutas[r]) == 1 else (dias_cliente & dias_cliente[i]).any(axis=1))
+    return rutas
+
+def mejorar_patron(rutas, presente, dur, dist, end_idx, segundos_parada, tiempo_limite, segundos_max=5.0):
+    # Búsqueda local sobre el patrón maestro completo: cada movimiento se mide en todos los días a la vez
+    # (cada día recorre solo sus paradas activas) y ningún día puede pasar el tiempo límite.
+    fin = time.monotonic() + segundos_max
+    rutas = [list(r) for r in rutas if r]
+    dur = np.asarray(dur, dtype=np.int64)
+    dist = np.asarray(dist, dtype=np.int64)
+
+    # 1. Eliminación de rutas: se intenta vaciar la de menos visitas semanales repartiendo sus clientes en las demás
+    eliminada = True
+    while eliminada and len(rutas) > 1 and time.monotonic() < fin:
+        eliminada = False
+        for r in np.argsort([presente[ruta].sum() for ruta in rutas], kind='stable'):
+            resto = rutas[:r] + rutas[r + 1:]
+            repartidas = insertar_esporadicos(resto, rutas[r], presente, dur, dist, end_idx, segundos_parada, tiempo_limite)
+            if len(repartidas) == len(resto):
+                rutas, eliminada = repartidas, True
+                break
+            if time.monotonic() >= fin:
+                break
+
+    # 2. Reubicación: cada cliente pasa al hueco de cualquier ruta que menos distancia semanal suma, si mejora
+    relojes = [reloj_ruta_por_dia(r, presente, dur, dist, end_idx, segundos_parada) for r in rutas]
+    mejoro = True
+    while mejoro and time.monotonic() < fin:
+        mejoro = False
+        for cliente in [c for ruta in rutas for c in ruta]:
+            if time.monotonic() >= fin:
+                break
+            r = next(i for i, ruta in enumerate(rutas) if cliente in ruta)
+            if len(rutas[r]) == 1:
+                continue
+            q = rutas[r].index(cliente)
+            sin_cliente = rutas[r][:q] + rutas[r][q + 1:]
+            reloj_sin = reloj_ruta_por_dia(sin_cliente, presente, dur, dist, end_idx, segundos_parada)
+            candidatos = relojes[:r] + [reloj_sin] + relojes[r + 1:]
+            dias = np.flatnonzero(presente[cliente])
+            huecos = np.cumsum([0] + [len(ruta) + 1 for ruta in rutas])
+            huecos[r + 1:] -= 1
+            reloj = tuple(np.concatenate([x[k][dias] for x in candidatos], axis=1) for k in range(5))
+            costo = costo_insercion([cliente], reloj, np.ones((1, len(dias)), dtype=bool), dur, dist, segundos_parada, tiempo_limite)[0]
+            mejor = int(np.argmin(costo))
+            if not costo[mejor] < costo[huecos[r] + q]:
+                continue
+            destino = int(np.searchsorted(huecos, mejor, side='right')) - 1
+            rutas[r] = sin_cliente
+            rutas[destino].insert(mejor - int(huecos[destino]), cliente)
+            relojes[r] = reloj_sin
+            relojes[destino] = reloj_ruta_por_dia(rutas[destino], presente, dur, dist, end_idx, segundos_parada)
+            mejoro = True
+    return rutas
+
+# --- DESCOMPOSICIÓN DE DÍAS GRANDES EN ZONAS BALANCEADAS ---
+METROS_POR_GRADO = 111320.0
+PESO_DEPTO_ZONAS_METROS = 3000.0
+
+def zonas_balanceadas(coords, tam_max, codigos_depto=None, peso_depto_metros=0.0, iteraciones=20, semilla=0):
+    # k-means con cupo: ninguna zona pasa de tam_max paradas. Si se da peso, estar en una zona de otro
+    # departamento cuesta como estar esos metros más lejos de su centro (pista, no frontera).
+    coords = np.asarray(coords, dtype=float)
+    n = len(coords)
+    k = -(-n // max(1, tam_max))
+    if k <= 1:
+        return np.zeros(n, dtype=np.int64)
+    xy = np.column_stack([coords[:, 0] * np.cos(np.radians(coords[:, 1].mean())), coords[:, 1]]) * METROS_POR_GRADO
+    codigos = np.full(n, -1) if codigos_depto is None else np.asarray(codigos_depto)
+    cupo = -(-n // k)
+
+    # Centros iniciales k-means++ con semilla fija para que el mismo día dé siempre las mismas zonas
+    rng = np.random.default_rng(semilla)
+    centros = [xy[rng.integers(n)]]
+    for _ in range(k - 1):
+        d2 = ((xy[:, np.newaxis, :] - np.array(centros)[np.newaxis, :, :]) ** 2).sum(axis=2).min(axis=1)
+        centros.append(xy[rng.choice(n, p=d2 / d2.sum())] if d2.sum() > 0 else xy[rng.integers(n)])
+    centros = np.array(centros)
+    depto_zona = np.full(k, -1)
+
+    zonas = np.full(n, -1)
+    for _ in range(iteraciones):
+        costo = np.sqrt(((xy[:, np.newaxis, :] - centros[np.newaxis, :, :]) ** 2).sum(axis=2))
+        costo += peso_depto_metros * ((codigos[:, np.newaxis] != depto_zona[np.newaxis, :]) & (codigos[:, np.newaxis] >= 0) & (depto_zona[np.newaxis, :] >= 0))
+        # Primero eligen las paradas que más pierden si no entran en su zona preferida
+        ordenado = np.sort(costo, axis=1)
+        nuevas = np.full(n, -1)
+        ocupacion = np.zeros(k, dtype=np.int64)
+        for i in np.argsort(ordenado[:, 0] - ordenado[:, 1], kind='stable'):
+            z = next(z for z in np.argsort(costo[i], kind='stable') if ocupacion[z] < cupo)
+            nuevas[i] = z
+            ocupacion[z] += 1
+        if np.array_equal(nuevas, zonas):
+            break
+        zonas = nuevas
+        for z in range(k):
+            miembros = zonas == z
+            centros[z] = xy[miembros].mean(axis=0)
+            con_depto = codigos[miembros & (codigos >= 0)]
+            depto_zona[z] = np.bincount(con_depto).argmax() if con_depto.size else -1
+    return zonas
@@ -0,0 +1,44 @@
+import codecs
+import csv
+import importlib.util
+import io
+import os
+import pandas as pd
+
+# Lectura de planillas subidas (Excel, CSV, Parquet) a un DataFrame con solo las columnas del planificador.
+# Sin Streamlit: la app cachea el resultado por huella del archivo.
+
+# --- LECTURA DE PLANILLAS: EXCEL, CSV Y PARQUET CON EL MISMO ESQUEMA ---
+COLUMNAS_PLANILLA = ['Orden', 'Día', 'Ruta', 'Departamento', 'Lugar', 'Coordenadas']
+COLUMNAS_CRONOGRAMA = COLUMNAS_PLANILLA + ['Llegada', 'Salida', 'Minutos Tramo', 'Minutos Acumulados', 'Km Tramo', 'Km Acumulados']
+BYTES_MUESTRA_CSV = 65536
+MOTOR_EXCEL_RAPIDO = "calamine" if importlib.util.find_spec("python_calamine") else None
+
+def es_columna_util(nombre):
+    return str(nombre).strip() in COLUMNAS_CRONOGRAMA
+
+def leer_csv(contenido):
+    # Separador ',' ';' o tabulación detectado sobre el encabezado; acepta UTF-8 (con o sin BOM) y Latin-1.
+    # La muestra se decodifica de a trozos: un carácter multibyte cortado al final queda pendiente y no cuenta como error
+    for codificacion in ("utf-8-sig", "latin-1"):
+        try:
+            muestra = codecs.getincrementaldecoder(codificacion)().decode(contenido[:BYTES_MUESTRA_CSV], final=False)
+            break
+        except UnicodeDecodeError:
+            continue
+    try:
+        separador = csv.Sniffer().sniff(muestra.splitlines()[0] if muestra else "", delimiters=",;\t").delimiter
+    except csv.Error:
+        separador = ","
+    return pd.read_csv(io.BytesIO(contenido), sep=separador, encoding=codificacion, usecols=es_columna_util, dtype={'Coordenadas': str})
+
+def leer_planilla(contenido, nombre_archivo):
+    extension = os.path.splitext(nombre_archivo.lower())[1]
+    if extension == ".csv":
+        return leer_csv(contenido)
+    if extension == ".parquet":
+        df = pd.read_parquet(io.BytesIO(contenido))
+        return df[[c for c in df.columns if es_columna_util(c)]]
+    if extension == ".xlsx" and MOTOR_EXCEL_RAPIDO:
+        return pd.read_excel(io.BytesIO(contenido), engine=MOTOR_EXCEL_RAPIDO, usecols=es_columna_util)
+    return pd.read_excel(io.BytesIO(contenido), usecols=es_columna_util)
@@ -0,0 +1,846 @@
+import datetime
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+import numpy as np
+import requests
+
+# Red de ruteo: proveedores de matriz y trazado, cupo de peticiones, reintentos y caché en disco.
+# Sin Streamlit: la app comparte sesión, limitadores y cortocircuitos entre reruns y los tests lo importan directo.
+
+# --- SESIÓN HTTP COMPARTIDA Y CUPO DE PETICIONES POR MINUTO ---
+ORS_HILOS_MAX = 6
+
+class LimitadorTasa:
+    # Cubeta de fichas: ráfaga corta y recarga continua para no superar el cupo en ninguna ventana de 60 s
+    def __init__(self, peticiones_por_minuto):
+        self.rafaga = max(1, int(peticiones_por_minuto) // 10)
+        self.tasa = max(1, int(peticiones_por_minuto) - self.rafaga) / 60.0
+        self.fichas = float(self.rafaga)
+        self.ultimo = time.monotonic()
+        self.pausa_hasta = 0.0
+        self.lock = threading.Lock()
+
+    def pausar(self, segundos):
+        # El servidor avisó que el cupo está agotado: nadie sale hasta que se reponga
+        with self.lock:
+            self.pausa_hasta = max(self.pausa_hasta, time.monotonic() + segundos)
+            self.fichas = 0.0
+
+    def esperar_turno(self, plazo=None):
+        # False si la pausa o la próxima ficha llegan recién después del plazo: quien llama corta sin dormir
+        while True:
+            with self.lock:
+                ahora = time.monotonic()
+                if ahora < self.pausa_hasta:
+                    espera = self.pausa_hasta - ahora
+                else:
+                    self.fichas = min(self.rafaga, self.fichas + (ahora - max(self.ultimo, self.pausa_hasta)) * self.tasa)
+                    self.ultimo = ahora
+                    if self.fichas >= 1:
+                        self.fichas -= 1
+                        return True
+                    espera = (1 - self.fichas) / self.tasa
+            if plazo is not None and ahora + espera >= plazo:
+                return False
+            time.sleep(espera)
+
+def crear_sesion_http():
+    sesion = requests.Session()
+    adaptador = requests.adapters.HTTPAdapter(pool_connections=ORS_HILOS_MAX, pool_maxsize=ORS_HILOS_MAX * 2)
+    sesion.mount("https://", adaptador)
+    sesion.mount("http://", adaptador)
+    return sesion
+
+# --- POLÍTICA DE REINTENTOS: CABECERAS DEL SERVIDOR, BACKOFF CON JITTER, PLAZO Y CORTOCIRCUITO ---
+REINTENTOS_MAX = 5
+BACKOFF_BASE_SEGUNDOS = 2.0
+BACKOFF_TOPE_SEGUNDOS = 60.0
+ERROR_REINTENTOS = "Superado el límite de reintentos. El servidor está caído temporalmente."
+ERROR_PLAZO = "Se agotó la espera máxima de red para este plan."
+ERROR_CIRCUITO = "El motor de ruteo falló varias veces seguidas; se pausan las consultas unos minutos."
+ERRORES_CON_RESPALDO = {"QUOTA_EXCEEDED", ERROR_PLAZO, ERROR_CIRCUITO, ERROR_REINTENTOS}
+PAUSA_MAX_SIN_PLAZO_SEGUNDOS = 300
+
+def pausar_hasta_plazo(limitador, segundos, plazo):
+    # El limitador es compartido: una espera pedida por el servidor (ej. reinicio del cupo diario) nunca pasa del plazo
+    # del plan; si lo supera, las peticiones siguientes de este plan cortan con ERROR_PLAZO y entra el respaldo
+    tope = PAUSA_MAX_SIN_PLAZO_SEGUNDOS if plazo is None else max(0.0, plazo - time.monotonic())
+    limitador.pausar(min(segundos, tope))
+
+def segundos_desde_cabeceras(cabeceras):
+    # Retry-After (segundos o fecha HTTP) o, si el cupo quedó en cero, x-ratelimit-reset
+    valor = cabeceras.get('Retry-After')
+    if valor:
+        try:
+            return max(0.0, float(valor))
+        except ValueError:
+            try:
+                return max(0.0, (parsedate_to_datetime(valor) - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    if cabeceras.get('x-ratelimit-remaining') == '0' and cabeceras.get('x-ratelimit-reset'):
+        try:
+            reset = float(cabeceras['x-ratelimit-reset'])
+        except ValueError:
+            return None
+        if reset > 1e12: reset /= 1000.0
+        return max(0.0, reset - time.time()) if reset > 1e9 else reset
+    return None
+
+def backoff_con_jitter(intento):
+    tope = min(BACKOFF_TOPE_SEGUNDOS, BACKOFF_BASE_SEGUNDOS * (2 ** intento))
+    return tope / 2 + random.uniform(0, tope / 2)
+
+class Cortocircuito:
+    # Tras varios fallos seguidos deja de insistir un rato y responde al instante
+    def __init__(self, umbral=3, enfriamiento_segundos=120):
+        self.umbral = umbral
+        self.enfriamiento = enfriamiento_segundos
+        self.fallos = 0
+        self.abierto_hasta = 0.0
+        self.lock = threading.Lock()
+
+    def abierto(self):
+        with self.lock:
+            return time.monotonic() < self.abierto_hasta
+
+    def registrar_exito(self):
+        with self.lock:
+            self.fallos = 0
+
+    def registrar_fallo(self):
+        with self.lock:
+            self.fallos += 1
+            if self.fallos >= self.umbral:
+                self.abierto_hasta = time.monotonic() + self.enfriamiento
+                self.fallos = 0
+
+# --- CONEXIÓN PURA BLINDADA CONTRA CAÍDAS ---
+def enviar_con_reintento(sesion, metodo, url, limitador=None, plazo=None, cortocircuito=None, **kwargs):
+    if cortocircuito is not None and cortocircuito.abierto():
+        return None, ERROR_CIRCUITO
+    for intento in range(REINTENTOS_MAX):
+        espera = None
+        try:
+            if limitador is not None and not limitador.esperar_turno(plazo):
+                return None, ERROR_PLAZO
+            timeout = 70 if plazo is None else max(5, min(70, plazo - time.monotonic()))
+            resp = sesion.request(metodo, url, timeout=timeout, **kwargs)
+            espera_servidor = segundos_desde_cabeceras(resp.headers)
+            if resp.status_code == 200:
+                if cortocircuito is not None: cortocircuito.registrar_exito()
+                if limitador is not None and espera_servidor: pausar_hasta_plazo(limitador, espera_servidor, plazo)
+                return resp.json(), None
+            elif "Quota" in resp.text or resp.status_code == 403:
+                return None, "QUOTA_EXCEEDED"
+            elif resp.status_code == 429 or "Rate limit" in resp.text:
+                espera = espera_servidor
+                if limitador is not None and espera: pausar_hasta_plazo(limitador, espera, plazo)
+            elif resp.status_code >= 500 or "unknown" in resp.text.lower():
+                espera = espera_servidor
+            else:
+                return None, resp.text
+        except requests.exceptions.RequestException:
+            pass
+        if espera is None:
+            espera = backoff_con_jitter(intento)
+        if plazo is not None and time.monotonic() + espera > plazo:
+            if cortocircuito is not None: cortocircuito.registrar_fallo()
+            return None, ERROR_PLAZO
+        time.sleep(espera)
+    if cortocircuito is not None: cortocircuito.registrar_fallo()
+    return None, ERROR_REINTENTOS
+
+# --- MOTORES DE RUTEO INTERCAMBIABLES (MATRIZ + TRAZADO) ---
+# Todos hablan el formato de ORS: matriz {"locations", "sources", "destinations"} -> {"distances", "durations"}
+# y trazado {"coordinates"} -> FeatureCollection con "segments" y "way_points".
+# La sesión y el cortocircuito se reciben de afuera para compartirlos entre proveedores del mismo servidor.
+class ProveedorORS:
+    def __init__(self, url_base, headers, perfil=None, limites=None, limitador_matriz=None, limitador_trazado=None, clave_cache=None, sesion=None, cortocircuito=None):
+        self.url_base = url_base.rstrip('/')
+        self.headers = headers
+        self.perfil = perfil or PERFIL_ORS
+        self.limites = limites or ORS_LIMITES_MATRIZ
+        self.simetrico = self.perfil in PERFILES_SIMETRICOS
+        self.clave_cache = clave_cache or self.perfil
+        self.limitador_matriz = limitador_matriz
+        self.limitador_trazado = limitador_trazado
+        self.sesion = sesion or crear_sesion_http()
+        self.cortocircuito = cortocircuito or Cortocircuito()
+        self.plazo = None
+        self.usa_cache = True
+        self.hilos = ORS_HILOS_MAX
+
+    def iniciar_plazo(self, segundos):
+        self.plazo = time.monotonic() + segundos
+
+    def pedir_matriz(self, body):
+        return enviar_con_reintento(self.sesion, "POST", f"{self.url_base}/v2/matrix/{self.perfil}", self.limitador_matriz, self.plazo, self.cortocircuito, json=body, headers=self.headers)
+
+    def pedir_trazado(self, body):
+        return enviar_con_reintento(self.sesion, "POST", f"{self.url_base}/v2/directions/{self.perfil}/geojson", self.limitador_trazado, self.plazo, self.cortocircuito, json=body, headers=self.headers)
+
+class ProveedorOSRM:
+    def __init__(self, url_base, perfil="driving", limites=None, sesion=None, cortocircuito=None):
+        self.url_base = url_base.rstrip('/')
+        self.perfil = perfil
+        self.limites = limites or {"max_locaciones": 1000, "max_celdas": 1000000}
+        self.simetrico = False
+        self.clave_cache = f"osrm:{perfil}"
+        self.sesion = sesion or crear_sesion_http()
+        self.cortocircuito = cortocircuito or Cortocircuito()
+        self.plazo = None
+        self.usa_cache = True
+        self.hilos = ORS_HILOS_MAX
+
+    def iniciar_plazo(self, segundos):
+        self.plazo = time.monotonic() + segundos
+
+    def pedir_matriz(self, body):
+        coords = ";".join(f"{pt[0]},{pt[1]}" for pt in body['locations'])
+        params = {"annotations": "distance,duration"}
+        if 'sources' in body: params['sources'] = ";".join(str(i) for i in body['sources'])
+        if 'destinations' in body: params['destinations'] = ";".join(str(i) for i in body['destinations'])
+        data, err = enviar_con_reintento(self.sesion, "GET", f"{self.url_base}/table/v1/{self.perfil}/{coords}", None, self.plazo, self.cortocircuito, params=params)
+        if not data: return None, err
+        if data.get('code') != 'Ok': return None, data.get('message', data.get('code'))
+        return {"distances": data.get('distances'), "durations": data.get('durations')}, None
+
+    def pedir_trazado(self, body):
+        coords = ";".join(f"{pt[0]},{pt[1]}" for pt in body['coordinates'])
+        params = {"overview": "full", "geometries": "geojson", "steps": "false"}
+        data, err = enviar_con_reintento(self.sesion, "GET", f"{self.url_base}/route/v1/{self.perfil}/{coords}", None, self.plazo, self.cortocircuito, params=params)
+        if not data: return None, err
+        if data.get('code') != 'Ok' or not data.get('routes'): return None, data.get('message', data.get('code'))
+        ruta = data['routes'][0]
+        geom = ruta['geometry']['coordinates']
+        way_points = ubicar_way_points(geom, [w['location'] for w in data.get('waypoints', [])])
+        return {
+            "type": "FeatureCollection",
+            "features": [{
+                "type": "Feature",
+                "properties": {
+                    "summary": {"distance": ruta['distance'], "duration": ruta['duration']},
+                    "segments": [{"distance": leg['distance'], "duration": leg['duration']} for leg in ruta['legs']],
+                    "way_points": way_points
+                },
+                "geometry": {"type": "LineString", "coordinates": geom}
+            }]
+        }, None
+
+def ubicar_way_points(geom, ubicaciones):
+    # OSRM no devuelve los índices de cada parada dentro de la geometría: los buscamos en orden
+    if not geom or not ubicaciones: return []
+    indices, desde = [], 0
+    for k, (lon, lat) in enumerate(ubicaciones):
+        if k == len(ubicaciones) - 1:
+            indices.append(len(geom) - 1)
+            break
+        mejor, mejor_d2 = desde, float('inf')
+        for idx in range(desde, len(geom)):
+            d2 = (geom[idx][0] - lon) ** 2 + (geom[idx][1] - lat) ** 2
+            if d2 < mejor_d2:
+                mejor, mejor_d2 = idx, d2
+            if d2 < 1e-10: break
+        indices.append(mejor)
+        desde = mejor
+    return indices
+
+# --- BORRADOR OFFLINE: LÍNEA RECTA x FACTOR DE DESVÍO, SIN RED ---
+RADIO_TIERRA_METROS = 6371008.8
+
+def haversine_pares_metros(origenes, destinos):
+    # Distancia en línea recta elemento a elemento entre arreglos [..., (lon, lat)] (con broadcasting)
+    o = np.radians(np.asarray(origenes, dtype=float))
+    d = np.radians(np.asarray(destinos, dtype=float))
+    dlon = d[..., 0] - o[..., 0]
+    dlat = d[..., 1] - o[..., 1]
+    a = np.sin(dlat / 2) ** 2 + np.cos(o[..., 1]) * np.cos(d[..., 1]) * np.sin(dlon / 2) ** 2
+    return 2 * RADIO_TIERRA_METROS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def matriz_haversine_metros(origenes, destinos):
+    o = np.asarray(origenes, dtype=float).reshape(-1, 2)
+    d = np.asarray(destinos, dtype=float).reshape(-1, 2)
+    return haversine_pares_metros(o[:, None, :], d[None, :, :])
+
+class ProveedorOffline:
+    def __init__(self, factor_desvio=1.3, velocidad_kmh=30.0):
+        self.factor_desvio = float(factor_desvio)
+        self.velocidad_ms = float(velocidad_kmh) / 3.6
+        self.limites = {"max_locaciones": 10 ** 9, "max_celdas": 10 ** 18}
+        self.simetrico = True
+        self.clave_cache = "offline"
+        self.usa_cache = False
+        self.hilos = 1
+
+    def iniciar_plazo(self, segundos):
+        pass
+
+    def estimar(self, origenes, destinos, pares=False):
+        recta = haversine_pares_metros(origenes, destinos) if pares else matriz_haversine_metros(origenes, destinos)
+        dist = recta * self.factor_desvio
+        return dist, dist / self.velocidad_ms
+
+    def pedir_matriz(self, body):
+        locs = np.asarray(body['locations'], dtype=float)
+        src = locs[body['sources']] if 'sources' in body else locs
+        dst = locs[body['destinations']] if 'destinations' in body else locs
+        dist, dur = self.estimar(src, dst)
+        return {"distances": dist.tolist(), "durations": dur.tolist()}, None
+
+    def pedir_trazado(self, body):
+        coords = body['coordinates']
+        pts = np.asarray(coords, dtype=float)
+        dist, dur = self.estimar(pts[:-1], pts[1:], pares=True)
+        return {
+            "type": "FeatureCollection",
+            "features": [{
+                "type": "Feature",
+                "properties": {
+                    "summary": {"distance": float(dist.sum()), "duration": float(dur.sum())},
+                    "segments": [{"distance": float(a), "duration": float(b)} for a, b in zip(dist, dur)],
+                    "way_points": list(range(len(coords)))
+                },
+                "geometry": {"type": "LineString", "coordinates": [list(pt) for pt in coords]}
+            }]
+        }, None
+
+def calibrar_desde_cache(perfil, muestra=20000):
+    # Factor de desvío y velocidad medianos a partir de celdas reales ya guardadas
+    try:
+        con = abrir_cache_ruteo()
+        try:
+            filas = con.execute(
+                "SELECT origen, destino, distancia, duracion FROM celdas_matriz WHERE perfil = ? AND distancia > 0 AND duracion > 0 ORDER BY usado DESC LIMIT ?",
+                (perfil, muestra)
+            ).fetchall()
+        finally:
+            con.close()
+    except sqlite3.Error:
+        return None
+    if not filas: return None
+    origenes = np.array([[float(x) for x in f[0].split(',')] for f in filas])
+    destinos = np.array([[float(x) for x in f[1].split(',')] for f in filas])
+    dist = np.array([f[2] for f in filas], dtype=float)
+    dur = np.array([f[3] for f in filas], dtype=float)
+    recta = haversine_pares_metros(origenes, destinos)
+    validas = recta > 500
+    if validas.sum() < 10: return None
+    factor = float(np.median(dist[validas] / recta[validas]))
+    velocidad_kmh = float(np.median(dist[validas] / dur[validas])) * 3.6
+    return max(1.0, factor), velocidad_kmh, int(validas.sum())
+
+class ProveedorConRespaldo:
+    # Si el motor principal se queda sin cupo, sin plazo o con el circuito abierto, responde el borrador offline
+    def __init__(self, principal, respaldo=None):
+        self.principal = principal
+        self.respaldo = respaldo
+        self.limites = principal.limites
+        self.simetrico = principal.simetrico
+        self.clave_cache = principal.clave_cache
+        self.usa_cache = principal.usa_cache
+        self.hilos = principal.hilos
+        self.avisos = set()
+        self.lock = threading.Lock()
+
+    def iniciar_plazo(self, segundos):
+        # Los avisos se conservan: el plazo se reinicia por fase (matrices, trazado) dentro del mismo plan
+        self.principal.iniciar_plazo(segundos)
+
+    def obtener_respaldo(self):
+        with self.lock:
+            if self.respaldo is None:
+                calibracion = calibrar_desde_cache(self.principal.clave_cache)
+                self.respaldo = ProveedorOffline(*calibracion[:2]) if calibracion else ProveedorOffline()
+            return self.respaldo
+
+    def con_respaldo(self, metodo, body):
+        data, err = getattr(self.principal, metodo)(body)
+        if data or err not in ERRORES_CON_RESPALDO:
+            return data, err
+        self.avisos.add(err)
+        data, err_respaldo = getattr(self.obtener_respaldo(), metodo)(body)
+        if data: data["estimado"] = True
+        return data, err_respaldo
+
+    def pedir_matriz(self, body):
+        return self.con_respaldo("pedir_matriz", body)
+
+    def pedir_trazado(self, body):
+        return self.con_respaldo("pedir_trazado", body)
+
+# --- CACHÉ PERSISTENTE DE CELDAS DE MATRIZ Y TRAMOS DE TRAZADO (SQLITE CON TTL + LRU) ---
+RUTA_CACHE_RUTEO = os.environ.get("RUTEO_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache_ruteo.sqlite3"))
+CACHE_TTL_SEGUNDOS = 30 * 24 * 3600
+CACHE_MAX_CELDAS = 2000000
+CACHE_MAX_TRAMOS = 300000
+CACHE_MAX_GRUPOS_FALTANTES = 4
+CACHE_PODA_FRACCION = 0.05
+PERFIL_ORS = "driving-car"
+
+def clave_coordenada(pt):
+    return f"{float(pt[0]):.6f},{float(pt[1]):.6f}"
+
+def abrir_cache_ruteo():
+    con = sqlite3.connect(RUTA_CACHE_RUTEO, timeout=30)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS celdas_matriz ("
+        "perfil TEXT NOT NULL, origen TEXT NOT NULL, destino TEXT NOT NULL, "
+        "distancia REAL, duracion REAL, creado REAL NOT NULL, usado REAL NOT NULL, "
+        "PRIMARY KEY (perfil, origen, destino)) WITHOUT ROWID"
+    )
+    con.execute("CREATE INDEX IF NOT EXISTS idx_celdas_usado ON celdas_matriz (usado)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_celdas_creado ON celdas_matriz (creado)")
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS tramos_trazado ("
+        "perfil TEXT NOT NULL, origen TEXT NOT NULL, destino TEXT NOT NULL, "
+        "distancia REAL, duracion REAL, geometria TEXT NOT NULL, creado REAL NOT NULL, usado REAL NOT NULL, "
+        "PRIMARY KEY (perfil, origen, destino)) WITHOUT ROWID"
+    )
+    con.execute("CREATE INDEX IF NOT EXISTS idx_tramos_usado ON tramos_trazado (usado)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_tramos_creado ON tramos_trazado (creado)")
+    return con
+
+def podar_tabla_cache(con, tabla, max_filas, ahora):
+    con.execute(f"DELETE FROM {tabla} WHERE creado < ?", (ahora - CACHE_TTL_SEGUNDOS,))
+    total = con.execute(f"SELECT COUNT(*) FROM {tabla}").fetchone()[0]
+    if total > max_filas:
+        # Exactamente las 'total - max_filas' menos usadas, por clave (las tablas no tienen rowid): cortar por
+        # 'usado <=' también borraría todas las filas que empatan con la marca de corte
+        con.execute(
+            f"DELETE FROM {tabla} WHERE (perfil, origen, destino) IN "
+            f"(SELECT perfil, origen, destino FROM {tabla} ORDER BY usado LIMIT ?)",
+            (total - max_filas,)
+        )
+
+# Filas escritas por tabla desde la última poda de este proceso: contar y podar recorre la tabla, así que se hace
+# la primera vez y luego cada vez que lo escrito llega a una fracción del tope (el tope se pasa a lo sumo en esa fracción)
+filas_sin_podar = {}
+
+def podar_si_corresponde(con, tabla, max_filas, ahora, escritas):
+    pendientes = filas_sin_podar.get(tabla)
+    if pendientes is not None and pendientes + escritas < max_filas * CACHE_PODA_FRACCION:
+        filas_sin_podar[tabla] = pendientes + escritas
+        return
+    podar_tabla_cache(con, tabla, max_filas, ahora)
+    filas_sin_podar[tabla] = 0
+
+def leer_celdas_cache(perfil, claves_origen, claves_destino):
+    encontradas = {}
+    destinos = set(claves_destino)
+    origenes = list(dict.fromkeys(claves_origen))
+    ahora = time.time()
+    try:
+        con = abrir_cache_ruteo()
+        try:
+            with con:
+                for k in range(0, len(origenes), 500):
+                    bloque = origenes[k:k + 500]
+                    marcas = ",".join("?" * len(bloque))
+                    filas = con.execute(
+                        f"SELECT origen, destino, distancia, duracion FROM celdas_matriz "
+                        f"WHERE perfil = ? AND creado >= ? AND origen IN ({marcas})",
+                        [perfil, ahora - CACHE_TTL_SEGUNDOS] + bloque
+                    ).fetchall()
+                    for o, d, dist, dur in filas:
+                        if d in destinos:
+                            encontradas[(o, d)] = (dist, dur)
+                    # LRU: marcamos como usadas las filas de estos orígenes
+                    con.execute(f"UPDATE celdas_matriz SET usado = ? WHERE perfil = ? AND origen IN ({marcas})", [ahora, perfil] + bloque)
+        finally:
+            con.close()
+    except sqlite3.Error:
+        return {}
+    return encontradas
+
+def guardar_celdas_cache(perfil, celdas):
+    if not celdas: return
+    ahora = time.time()
+    try:
+        con = abrir_cache_ruteo()
+        try:
+            with con:
+                con.executemany(
+                    "INSERT OR REPLACE INTO celdas_matriz (perfil, origen, destino, distancia, duracion, creado, usado) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(perfil, o, d, dist, dur, ahora, ahora) for o, d, dist, dur in celdas]
+                )
+                podar_si_corresponde(con, "celdas_matriz", CACHE_MAX_CELDAS, ahora, len(celdas))
+        finally:
+            con.close()
+    except sqlite3.Error:
+        pass
+
+def leer_tramos_cache(perfil, pares):
+    encontrados = {}
+    pares = list(dict.fromkeys(pares))
+    ahora = time.time()
+    try:
+        con = abrir_cache_ruteo()
+        try:
+            with con:
+                for o, d in pares:
+                    fila = con.execute(
+                        "SELECT distancia, duracion, geometria FROM tramos_trazado WHERE perfil = ? AND origen = ? AND destino = ? AND creado >= ?",
+                        (perfil, o, d, ahora - CACHE_TTL_SEGUNDOS)
+                    ).fetchone()
+                    if fila:
+                        encontrados[(o, d)] = (fila[0], fila[1], json.loads(fila[2]))
+                con.executemany("UPDATE tramos_trazado SET usado = ? WHERE perfil = ? AND origen = ? AND destino = ?", [(ahora, perfil, o, d) for o, d in encontrados])
+        finally:
+            con.close()
+    except sqlite3.Error:
+        return {}
+    return encontrados
+
+def guardar_tramos_cache(perfil, tramos):
+    if not tramos: return
+    ahora = time.time()
+    try:
+        con = abrir_cache_ruteo()
+        try:
+            with con:
+                con.executemany(
+                    "INSERT OR REPLACE INTO tramos_trazado (perfil, origen, destino, distancia, duracion, geometria, creado, usado) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(perfil, o, d, dist, dur, json.dumps(geom), ahora, ahora) for (o, d), (dist, dur, geom) in tramos.items()]
+                )
+                podar_si_corresponde(con, "tramos_trazado", CACHE_MAX_TRAMOS, ahora, len(tramos))
+        finally:
+            con.close()
+    except sqlite3.Error:
+        pass
+
+def vaciar_cache_ruteo():
+    try:
+        con = abrir_cache_ruteo()
+        try:
+            with con:
+                con.execute("DELETE FROM celdas_matriz")
+                con.execute("DELETE FROM tramos_trazado")
+        finally:
+            con.close()
+    except sqlite3.Error:
+        pass
+
+# --- PLANIFICADOR DE TESELAS SEGÚN LOS LÍMITES DEL PROVEEDOR ---
+ORS_LIMITES_MATRIZ = {"max_locaciones": 50, "max_celdas": 3500}
+PERFILES_SIMETRICOS = {"foot-walking", "foot-hiking", "wheelchair"}
+
+def partir_en_grupos(indices, tam):
+    return [indices[k:k + tam] for k in range(0, len(indices), tam)]
+
+def planificar_teselas_matriz(n_origenes, n_destinos, mismo_conjunto, limites, simetrico=False):
+    # Cada tesela es (filas, columnas, espejar): índices de origen, índices de destino y si se copia la transpuesta
+    max_locs, max_celdas = limites["max_locaciones"], limites["max_celdas"]
+    filas_todas, columnas_todas = list(range(n_origenes)), list(range(n_destinos))
+
+    if mismo_conjunto:
+        N = n_origenes
+        if N <= max_locs and N * N <= max_celdas:
+            return [(filas_todas, filas_todas, False)]
+        candidatos = []
+        # Pares de grupos: una sola petición todos-contra-todos cubre los bloques (a,b), (b,a) y ambas diagonales
+        g = max_locs // 2
+        while g > 1 and (2 * g) ** 2 > max_celdas: g -= 1
+        grupos = partir_en_grupos(filas_todas, g)
+        candidatos.append([(ga + gb, ga + gb, False) for a, ga in enumerate(grupos) for gb in grupos[a + 1:]])
+        if simetrico:
+            # Perfil simétrico: solo el triángulo superior de bloques rectangulares y se espeja el resto
+            g = max_locs // 2
+            while g > 1 and g * g > max_celdas: g -= 1
+            grupos = partir_en_grupos(filas_todas, g)
+            candidatos.append([(ga, gb, a != b) for a, ga in enumerate(grupos) for b, gb in enumerate(grupos) if b >= a])
+        return min(candidatos, key=len)
+
+    # Bloques rectangulares origen x destino con el tamaño que minimiza la cantidad de peticiones
+    mejor = None
+    for s in range(1, min(n_origenes, max_locs - 1) + 1):
+        d = min(n_destinos, max_locs - s, max_celdas // s)
+        if d < 1: continue
+        costo = -(-n_origenes // s) * -(-n_destinos // d)
+        if mejor is None or costo < mejor[0]:
+            mejor = (costo, s, d)
+    _, s, d = mejor
+    return [(filas, columnas, False) for filas in partir_en_grupos(filas_todas, s) for columnas in partir_en_grupos(columnas_todas, d)]
+
+def armar_cuerpo_matriz(src_pts, dst_pts):
+    posiciones, locs = {}, []
+    def indice(pt):
+        clave = clave_coordenada(pt)
+        if clave not in posiciones:
+            posiciones[clave] = len(locs)
+            locs.append(pt)
+        return posiciones[clave]
+    src_indices = [indice(pt) for pt in src_pts]
+    dst_indices = [indice(pt) for pt in dst_pts]
+    return {"locations": locs, "sources": src_indices, "destinations": dst_indices, "metrics": ["distance", "duration"]}
+
+COSTO_INALCANZABLE = 99999999
+
+def sanear_matriz(matriz):
+    # None/NaN (sin camino) -> costo prohibitivo y todo a enteros, sin recorrer celda por celda
+    matriz = np.asarray(matriz, dtype=float)
+    return np.where(np.isnan(matriz), COSTO_INALCANZABLE, matriz).astype(np.int64)
+
+def pedir_bloque_matriz(origenes, destinos, proveedor):
+    matriz_dist = np.full((len(origenes), len(destinos)), np.nan)
+    matriz_dur = np.full((len(origenes), len(destinos)), np.nan)
+    mismo_conjunto = [clave_coordenada(pt) for pt in origenes] == [clave_coordenada(pt) for pt in destinos]
+    plan = planificar_teselas_matriz(len(origenes), len(destinos), mismo_conjunto, proveedor.limites, proveedor.simetrico)
+    teselas = [(filas, columnas, espejar, armar_cuerpo_matriz([origenes[u] for u in filas], [destinos[v] for v in columnas])) for filas, columnas, espejar in plan]
+
+    # Las teselas salen en paralelo compartiendo sesión HTTP y el cupo de peticiones por minuto del proveedor
+    hubo_estimados = False
+    with ThreadPoolExecutor(max_workers=max(1, min(proveedor.hilos, len(teselas)))) as pool:
+        futuros = [pool.submit(proveedor.pedir_matriz, t[3]) for t in teselas]
+        for (filas, columnas, espejar, _), futuro in zip(teselas, futuros):
+            data, err = futuro.result()
+            if not data:
+                for f in futuros: f.cancel()
+                return None, None, err, False
+            hubo_estimados = hubo_estimados or bool(data.get('estimado'))
+            dists = np.array(data['distances'], dtype=float)
+            durs = np.array(data['durations'], dtype=float)
+            matriz_dist[np.ix_(filas, columnas)] = dists
+            matriz_dur[np.ix_(filas, columnas)] = durs
+            if espejar:
+                matriz_dist[np.ix_(columnas, filas)] = dists.T
+                matriz_dur[np.ix_(columnas, filas)] = durs.T
+    return matriz_dist, matriz_dur, None, hubo_estimados
+
+def obtener_matriz_masiva(lista_coords, proveedor):
+    if not proveedor.usa_cache and len(lista_coords) <= proveedor.limites["max_locaciones"]:
+        data, err = proveedor.pedir_matriz({"locations": lista_coords, "metrics": ["distance", "duration"]})
+        return (sanear_matriz(data['distances']), sanear_matriz(data['durations']), None) if data else (None, None, err)
+
+    # Solo se piden al proveedor las celdas (perfil, origen, destino) que no están en la caché
+    claves = [clave_coordenada(pt) for pt in lista_coords]
+    coord_por_clave = {}
+    for clave, pt in zip(claves, lista_coords):
+        coord_por_clave.setdefault(clave, pt)
+    unicas = list(coord_por_clave)
+    posicion = {clave: k for k, clave in enumerate(unicas)}
+
+    celdas = leer_celdas_cache(proveedor.clave_cache, unicas, unicas) if proveedor.usa_cache else {}
+    matriz_dist = np.full((len(unicas), len(unicas)), np.nan)
+    matriz_dur = np.full((len(unicas), len(unicas)), np.nan)
+    conocidas = np.zeros((len(unicas), len(unicas)), dtype=bool)
+    for (o, d), (dist, dur) in celdas.items():
+        matriz_dist[posicion[o], posicion[d]] = np.nan if dist is None else dist
+        matriz_dur[posicion[o], posicion[d]] = np.nan if dur is None else dur
+        conocidas[posicion[o], posicion[d]] = True
+
+    faltantes_por_origen = {}
+    for k, o in enumerate(unicas):
+        columnas_faltantes = np.flatnonzero(~conocidas[k])
+        if columnas_faltantes.size:
+            faltantes_por_origen[o] = tuple(unicas[c] for c in columnas_faltantes)
+
+    # Agrupamos orígenes con los mismos destinos faltantes (ej: puntos nuevos -> fila + columna)
+    grupos = {}
+    for o, faltan in faltantes_por_origen.items():
+        grupos.setdefault(faltan, []).append(o)
+    if len(grupos) > CACHE_MAX_GRUPOS_FALTANTES:
+        destinos_union = tuple(dict.fromkeys(d for faltan in grupos for d in faltan))
+        grupos = {destinos_union: list(faltantes_por_origen)}
+
+    nuevas = []
+    for destinos, origenes in grupos.items():
+        dists, durs, err, estimado = pedir_bloque_matriz([coord_por_clave[c] for c in origenes], [coord_por_clave[c] for c in destinos], proveedor)
+        if err:
+            if proveedor.usa_cache: guardar_celdas_cache(proveedor.clave_cache, nuevas)
+            return None, None, err
+        filas = [posicion[o] for o in origenes]
+        columnas = [posicion[d] for d in destinos]
+        matriz_dist[np.ix_(filas, columnas)] = dists
+        matriz_dur[np.ix_(filas, columnas)] = durs
+        if not estimado:
+            for u, o in enumerate(origenes):
+                for v, d in enumerate(destinos):
+                    nuevas.append((o, d, None if np.isnan(dists[u, v]) else float(dists[u, v]), None if np.isnan(durs[u, v]) else float(durs[u, v])))
+    if proveedor.usa_cache: guardar_celdas_cache(proveedor.clave_cache, nuevas)
+
+    # Puntos repetidos comparten fila/columna: la matriz final se arma por indexado
+    indices = [posicion[c] for c in claves]
+    return sanear_matriz(matriz_dist[np.ix_(indices, indices)]), sanear_matriz(matriz_dur[np.ix_(indices, indices)]), None
+
+# --- MODO DISPERSO: COSTO REAL SOLO ENTRE VECINOS CERCANOS, ESTIMADO CALIBRADO PARA EL RESTO ---
+FILAS_POR_BLOQUE_VECINOS = 1024
+
+def vecinos_mas_cercanos(puntos, k):
+    # Índices de los k puntos más cercanos en línea recta de cada punto (sin sí mismo), por bloques de filas
+    puntos = np.asarray(puntos, dtype=float)
+    vecinos = np.empty((len(puntos), k), dtype=np.int64)
+    for desde in range(0, len(puntos), FILAS_POR_BLOQUE_VECINOS):
+        bloque = matriz_haversine_metros(puntos[desde:desde + FILAS_POR_BLOQUE_VECINOS], puntos)
+        bloque[np.arange(len(bloque)), np.arange(desde, desde + len(bloque))] = np.inf
+        vecinos[desde:desde + len(bloque)] = np.argpartition(bloque, k - 1, axis=1)[:, :k]
+    return vecinos
+
+def obtener_matriz_dispersa(lista_coords, proveedor, k, obligatorios=()):
+    # Mismo contrato que obtener_matriz_masiva, pero solo se piden los pares con alguno de los k vecinos más cercanos
+    # (en ambos sentidos) y la fila/columna completa de los puntos obligatorios (el destino); el resto se estima
+    claves = [clave_coordenada(pt) for pt in lista_coords]
+    coord_por_clave = {}
+    for clave, pt in zip(claves, lista_coords):
+        coord_por_clave.setdefault(clave, pt)
+    unicas = list(coord_por_clave)
+    posicion = {clave: n for n, clave in enumerate(unicas)}
+    puntos = np.array([coord_por_clave[c] for c in unicas], dtype=float)
+    n = len(unicas)
+
+    requeridas = np.zeros((n, n), dtype=bool)
+    requeridas[np.arange(n)[:, np.newaxis], vecinos_mas_cercanos(puntos, min(k, n - 1))] = True
+    requeridas |= requeridas.T
+    fijos = [posicion[clave_coordenada(pt)] for pt in obligatorios if clave_coordenada(pt) in posicion]
+    requeridas[fijos, :] = True
+    requeridas[:, fijos] = True
+    np.fill_diagonal(requeridas, False)
+
+    matriz_dist = np.full((n, n), np.nan)
+    matriz_dur = np.full((n, n), np.nan)
+    conocidas = np.eye(n, dtype=bool)
+    np.fill_diagonal(matriz_dist, 0)
+    np.fill_diagonal(matriz_dur, 0)
+    celdas = leer_celdas_cache(proveedor.clave_cache, unicas, unicas) if proveedor.usa_cache else {}
+    for (o, d), (dist, dur) in celdas.items():
+        matriz_dist[posicion[o], posicion[d]] = np.nan if dist is None else dist
+        matriz_dur[posicion[o], posicion[d]] = np.nan if dur is None else dur
+        conocidas[posicion[o], posicion[d]] = True
+
+    # Orígenes en orden espacial (franjas de latitud) para que cada bloque comparta casi todos sus vecinos;
+    # los obligatorios van solos porque piden la fila entera
+    faltan = requeridas & ~conocidas
+    orden = [o for o in np.lexsort((puntos[:, 0], np.floor(puntos[:, 1] / 0.02))) if o not in fijos and faltan[o].any()]
+    bloques = [[o] for o in fijos if faltan[o].any()] + partir_en_grupos(orden, max(1, proveedor.limites["max_locaciones"] // 2))
+    nuevas = []
+    for filas in bloques:
+        columnas = np.flatnonzero(faltan[filas].any(axis=0)).tolist()
+        dists, durs, err, estimado = pedir_bloque_matriz(puntos[filas].tolist(), puntos[columnas].tolist(), proveedor)
+        if err:
+            if proveedor.usa_cache: guardar_celdas_cache(proveedor.clave_cache, nuevas)
+            return None, None, err
+        matriz_dist[np.ix_(filas, columnas)] = dists
+        matriz_dur[np.ix_(filas, columnas)] = durs
+        conocidas[np.ix_(filas, columnas)] = True
+        if not estimado:
+            for u, o in enumerate(filas):
+                for v, d in enumerate(columnas):
+                    nuevas.append((unicas[o], unicas[d], None if np.isnan(dists[u, v]) else float(dists[u, v]), None if np.isnan(durs[u, v]) else float(durs[u, v])))
+    if proveedor.usa_cache: guardar_celdas_cache(proveedor.clave_cache, nuevas)
+
+    # Resto de la matriz: línea recta x desvío y velocidad medianos de las celdas reales de este mismo plan
+    recta = matriz_haversine_metros(puntos, puntos)
+    reales = conocidas & ~np.isnan(matriz_dist) & ~np.isnan(matriz_dur) & (recta > 500) & (matriz_dur > 0)
+    if reales.sum() >= 10:
+        factor = max(1.0, float(np.median(matriz_dist[reales] / recta[reales])))
+        velocidad_ms = float(np.median(matriz_dist[reales] / matriz_dur[reales]))
+    else:
+        estimador = ProveedorOffline()
+        factor, velocidad_ms = estimador.factor_desvio, estimador.velocidad_ms
+    matriz_dist = np.where(conocidas, matriz_dist, recta * factor)
+    matriz_dur = np.where(conocidas, matriz_dur, recta * factor / velocidad_ms)
+
+    indices = [posicion[c] for c in claves]
+    return sanear_matriz(matriz_dist[np.ix_(indices, indices)]), sanear_matriz(matriz_dur[np.ix_(indices, indices)]), None
+
+# --- TRAZADOS: CACHÉ POR TRAMO Y PETICIONES EN PARALELO PARA TODO EL PLAN ---
+TRAZADO_MAX_COORDS = 40
+
+def separar_tramos_trazado(claves_chunk, data):
+    # Corta la geometría de ORS en un tramo por cada par de puntos consecutivos
+    feature = data['features'][0]
+    segs = feature['properties'].get('segments', [])
+    way_points = feature['properties'].get('way_points', [])
+    geom = feature['geometry']['coordinates']
+    if len(segs) != len(claves_chunk) - 1 or len(way_points) != len(claves_chunk):
+        return None
+    tramos = {}
+    for k in range(len(segs)):
+        par = (claves_chunk[k], claves_chunk[k + 1])
+        tramos[par] = (segs[k].get('distance', 0), segs[k].get('duration', 0), geom[way_points[k]:way_points[k + 1] + 1])
+    return tramos
+
+def obtener_trazados_masivos(lista_rutas, proveedor):
+    claves_rutas = [[clave_coordenada(pt) for pt in coords] for coords in lista_rutas]
+    coord_por_clave = {}
+    for claves, coords in zip(claves_rutas, lista_rutas):
+        for clave, pt in zip(claves, coords):
+            coord_por_clave.setdefault(clave, pt)
+
+    pares = [par for claves in claves_rutas for par in zip(claves, claves[1:])]
+    tramos = leer_tramos_cache(proveedor.clave_cache, pares) if proveedor.usa_cache else {}
+
+    # Corridas de tramos faltantes consecutivos, cortadas cada TRAZADO_MAX_COORDS puntos
+    chunks, programados = [], set()
+    for claves in claves_rutas:
+        corrida = []
+        for par in zip(claves, claves[1:]):
+            if par not in tramos and par not in programados:
+                programados.add(par)
+                if not corrida: corrida = [par[0]]
+                corrida.append(par[1])
+                if len(corrida) == TRAZADO_MAX_COORDS:
+                    chunks.append(corrida)
+                    corrida = [par[1]]
+            else:
+                if len(corrida) > 1: chunks.append(corrida)
+                corrida = []
+        if len(corrida) > 1: chunks.append(corrida)
+
+    errores_por_par = {}
+    if chunks:
+        nuevos = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(proveedor.hilos, len(chunks)))) as pool:
+            futuros = []
+            for corrida in chunks:
+                body_dirs = {"coordinates": [coord_por_clave[c] for c in corrida], "radiuses": [-1] * len(corrida)}
+                futuros.append(pool.submit(proveedor.pedir_trazado, body_dirs))
+            for corrida, futuro in zip(chunks, futuros):
+                data, err = futuro.result()
+                tramos_chunk = separar_tramos_trazado(corrida, data) if data else None
+                if tramos_chunk is None:
+                    err = err or "Respuesta de trazado incompleta."
+                    for par in zip(corrida, corrida[1:]): errores_por_par[par] = err
+                    continue
+                if data.get('estimado'):
+                    tramos.update(tramos_chunk)
+                else:
+                    nuevos.update(tramos_chunk)
+        tramos.update(nuevos)
+        if proveedor.usa_cache: guardar_tramos_cache(proveedor.clave_cache, nuevos)
+
+    resultados = []
+    for claves in claves_rutas:
+        pares_ruta = list(zip(claves, claves[1:]))
+        err = next((errores_por_par[p] for p in pares_ruta if p in errores_por_par), None)
+        if err:
+            resultados.append((None, err))
+            continue
+        total_dist, total_dur = 0, 0
+        all_segments, merged_coordinates = [], []
+        for par in pares_ruta:
+            dist, dur, geom = tramos[par]
+            total_dist += dist
+            total_dur += dur
+            all_segments.append({"distance": dist, "duration": dur})
+            if not merged_coordinates:
+                merged_coordinates.extend(geom)
+            else:
+                merged_coordinates.extend(geom[1:])
+        fake_geojson = {
+            "type": "FeatureCollection",
+            "features": [{
+                "type": "Feature",
+                "properties": {"summary": {"distance": total_dist, "duration": total_dur}, "segments": all_segments},
+                "geometry": {"type": "LineString", "coordinates": merged_coordinates}
+            }]
+        }
+        resultados.append((fake_geojson, None))
+    return resultados
@@ -0,0 +1,173 @@
+import json
+import sys
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import red_ruteo  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def cache_temporal(tmp_path, monkeypatch):
+    # Ningún test toca la caché real junto a la app
+    ruta = tmp_path / "cache_ruteo.sqlite3"
+    monkeypatch.setattr(red_ruteo, "RUTA_CACHE_RUTEO", str(ruta))
+    monkeypatch.setattr(red_ruteo, "filas_sin_podar", {})
+    return ruta
+
+
+# --- SERVIDOR DE RUTEO LOCAL: OSRM (/table, /route) Y ORS (matrix, directions) SOBRE LÍNEA RECTA x DESVÍO ---
+class ServidorRuteoLocal:
+    def __init__(self):
+        self.estimador = red_ruteo.ProveedorOffline(factor_desvio=1.3, velocidad_kmh=36.0)
+        self.peticiones = []
+        self.forzadas = []
+        self.lock = threading.Lock()
+        self.http = ThreadingHTTPServer(("127.0.0.1", 0), self.manejador())
+        self.url = f"http://127.0.0.1:{self.http.server_address[1]}"
+        self.hilo = threading.Thread(target=self.http.serve_forever, daemon=True)
+
+    def forzar(self, veces, estado, datos=None, cabeceras=None):
+        # Las próximas 'veces' peticiones reciben esta respuesta en lugar de la normal
+        with self.lock:
+            self.forzadas.extend([(estado, datos or {}, cabeceras or {})] * veces)
+
+    def responder_429(self, veces, retry_after):
+        self.forzar(veces, 429, {"error": "Rate limit exceeded"}, {"Retry-After": retry_after})
+
+    def matriz(self, locs, fuentes, destinos):
+        locs = np.asarray(locs, dtype=float)
+        return self.estimador.estimar(locs[fuentes], locs[destinos])
+
+    def geometria(self, coords):
+        # Un punto intermedio por tramo: las paradas quedan en los índices pares de la geometría
+        geom = [list(coords[0])]
+        for a, b in zip(coords, coords[1:]):
+            geom.append([(a[0] + b[0]) / 2, (a[1] + b[1]) / 2])
+            geom.append(list(b))
+        dist, dur = self.estimador.estimar(np.asarray(coords[:-1], dtype=float), np.asarray(coords[1:], dtype=float), pares=True)
+        return geom, dist.tolist(), dur.tolist()
+
+    def osrm(self, ruta, consulta):
+        _, servicio, _, perfil, texto_coords = ruta.split("/", 4)
+        coords = [[float(x) for x in par.split(",")] for par in urllib.parse.unquote(texto_coords).split(";")]
+        if servicio == "table":
+            todos = list(range(len(coords)))
+            fuentes = [int(i) for i in consulta["sources"][0].split(";")] if "sources" in consulta else todos
+            destinos = [int(i) for i in consulta["destinations"][0].split(";")] if "destinations" in consulta else todos
+            dist, dur = self.matriz(coords, fuentes, destinos)
+            return 200, {"code": "Ok", "distances": dist.tolist(), "durations": dur.tolist()}
+        geom, dist, dur = self.geometria(coords)
+        return 200, {
+            "code": "Ok",
+            "routes": [{
+                "distance": sum(dist), "duration": sum(dur), "geometry": {"type": "LineString", "coordinates": geom},
+                "legs": [{"distance": a, "duration": b} for a, b in zip(dist, dur)]
+            }],
+            "waypoints": [{"location": pt} for pt in coords]
+        }
+
+    def ors(self, ruta, cuerpo):
+        if ruta.startswith("/v2/matrix/"):
+            todos = list(range(len(cuerpo["locations"])))
+            dist, dur = self.matriz(cuerpo["locations"], cuerpo.get("sources", todos), cuerpo.get("destinations", todos))
+            return 200, {"distances": dist.tolist(), "durations": dur.tolist()}
+        coords = cuerpo["coordinates"]
+        geom, dist, dur = self.geometria(coords)
+        return 200, {
+            "type": "FeatureCollection",
+            "features": [{
+                "type": "Feature",
+                "properties": {
+                    "summary": {"distance": sum(dist), "duration": sum(dur)},
+                    "segments": [{"distance": a, "duration": b} for a, b in zip(dist, dur)],
+                    "way_points": list(range(0, len(geom), 2))
+                },
+                "geometry": {"type": "LineString", "coordinates": geom}
+            }]
+        }
+
+    def manejador(self):
+        servidor = self
+
+        class Manejador(BaseHTTPRequestHandler):
+            def responder(self, estado, datos, cabeceras=None):
+                cuerpo = json.dumps(datos).encode()
+                self.send_response(estado)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(cuerpo)))
+                for clave, valor in (cabeceras or {}).items():
+                    self.send_header(clave, valor)
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def atender(self, metodo):
+                partes = urllib.parse.urlsplit(self.path)
+                with servidor.lock:
+                    servidor.peticiones.append((metodo, partes.path))
+                    forzada = servidor.forzadas.pop(0) if servidor.forzadas else None
+                if forzada is not None:
+                    return self.responder(*forzada)
+                if metodo == "GET":
+                    return self.responder(*servidor.osrm(partes.path, urllib.parse.parse_qs(partes.query)))
+                largo = int(self.headers.get("Content-Length", 0))
+                return self.responder(*servidor.ors(partes.path, json.loads(self.rfile.read(largo))))
+
+            def do_GET(self):
+                self.atender("GET")
+
+            def do_POST(self):
+                self.atender("POST")
+
+            def log_message(self, formato, *args):
+                pass
+
+        return Manejador
+
+
+@pytest.fixture
+def servidor_ruteo():
+    servidor = ServidorRuteoLocal()
+    servidor.hilo.start()
+    yield servidor
+    servidor.http.shutdown()
+    servidor.http.server_close()
+
+
+class RelojFalso:
+    # Reemplaza el módulo time de red_ruteo: dormir solo adelanta el reloj
+    def __init__(self):
+        self.ahora = 1000.0
+        self.siestas = []
+
+    def monotonic(self):
+        return self.ahora
+
+    def time(self):
+        return self.ahora
+
+    def sleep(self, segundos):
+        # Como un reloj real, siempre avanza al menos un tic (una espera de fracción de ulp no lo movería)
+        self.siestas.append(segundos)
+        self.ahora += max(segundos, 1e-9)
+
+
+@pytest.fixture
+def reloj(monkeypatch):
+    reloj = RelojFalso()
+    monkeypatch.setattr(red_ruteo, "time", reloj)
+    return reloj
+
+
+PUNTOS = [[-56.1645, -34.9011], [-56.1913, -34.9058], [-56.1500, -34.8800], [-56.1702, -34.8950], [-56.1645, -34.9011], [-56.2100, -34.8700]]
+
+
+@pytest.fixture
+def puntos():
+    return [list(pt) for pt in PUNTOS]
@@ -0,0 +1,83 @@
+import sqlite3
+
+import numpy as np
+
+import red_ruteo
+from red_ruteo import ProveedorOSRM, abrir_cache_ruteo, guardar_celdas_cache, leer_celdas_cache, podar_tabla_cache, obtener_matriz_masiva
+
+
+def filas(tabla="celdas_matriz"):
+    con = abrir_cache_ruteo()
+    try:
+        return con.execute(f"SELECT COUNT(*) FROM {tabla}").fetchone()[0]
+    finally:
+        con.close()
+
+
+def test_segunda_corrida_sale_de_la_cache(servidor_ruteo, puntos):
+    proveedor = ProveedorOSRM(servidor_ruteo.url, limites={"max_locaciones": 3, "max_celdas": 9})
+
+    dist, dur, err = obtener_matriz_masiva(puntos, proveedor)
+    pedidas = len(servidor_ruteo.peticiones)
+    dist_2, dur_2, err_2 = obtener_matriz_masiva(puntos, proveedor)
+
+    assert err is None and err_2 is None
+    assert pedidas > 0
+    assert len(servidor_ruteo.peticiones) == pedidas
+    assert np.array_equal(dist, dist_2) and np.array_equal(dur, dur_2)
+
+
+def test_punto_nuevo_pide_solo_su_fila_y_columna(servidor_ruteo, puntos):
+    proveedor = ProveedorOSRM(servidor_ruteo.url)
+    obtener_matriz_masiva(puntos[:4], proveedor)
+    servidor_ruteo.peticiones.clear()
+
+    _, _, err = obtener_matriz_masiva(puntos[:4] + [[-56.2300, -34.8600]], proveedor)
+
+    # Dos consultas: los 4 orígenes conocidos contra el punto nuevo y el punto nuevo contra todos
+    assert err is None
+    assert len(servidor_ruteo.peticiones) == 2
+    assert filas() == 5 * 5
+
+
+def test_celdas_vencidas_no_se_leen(monkeypatch):
+    guardar_celdas_cache("p", [("a", "b", 10.0, 1.0)])
+    assert leer_celdas_cache("p", ["a"], ["b"]) == {("a", "b"): (10.0, 1.0)}
+
+    monkeypatch.setattr(red_ruteo, "CACHE_TTL_SEGUNDOS", -1)
+    assert leer_celdas_cache("p", ["a"], ["b"]) == {}
+
+
+def test_poda_deja_exactamente_el_tope_aunque_haya_empates():
+    con = abrir_cache_ruteo()
+    try:
+        with con:
+            # De a 10 filas con la misma marca de uso: el corte cae en medio de un empate
+            con.executemany("INSERT INTO celdas_matriz VALUES ('p', ?, 'd', 1, 1, 0, ?)", [(str(i), float(i // 10)) for i in range(100)])
+            podar_tabla_cache(con, "celdas_matriz", 75, 0)
+        quedan = con.execute("SELECT origen FROM celdas_matriz").fetchall()
+    finally:
+        con.close()
+
+    assert len(quedan) == 75
+    assert {int(o) for (o,) in quedan} == set(range(25, 100))
+
+
+def test_guardar_poda_al_tope_por_volumen_escrito(monkeypatch):
+    monkeypatch.setattr(red_ruteo, "CACHE_MAX_CELDAS", 40)
+    guardar_celdas_cache("p", [(f"a{i}", "d", 1.0, 1.0) for i in range(30)])
+    # Menos del 5 % del tope desde la última poda: no se vuelve a contar la tabla
+    guardar_celdas_cache("p", [(f"b{i}", "d", 1.0, 1.0) for i in range(1)])
+    assert filas() == 31
+    guardar_celdas_cache("p", [(f"c{i}", "d", 1.0, 1.0) for i in range(20)])
+    assert filas() == 40
+
+
+def test_esquema_con_indices_de_uso_y_creacion(cache_temporal):
+    abrir_cache_ruteo().close()
+    con = sqlite3.connect(cache_temporal)
+    try:
+        indices = {n for (n,) in con.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    finally:
+        con.close()
+    assert {"idx_celdas_usado", "idx_celdas_creado", "idx_tramos_usado", "idx_tramos_creado"} <= indices
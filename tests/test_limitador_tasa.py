@@ -0,0 +1,47 @@
+import pytest
+
+from red_ruteo import LimitadorTasa
+
+
+def turnos(limitador, reloj, cantidad):
+    momentos = []
+    for _ in range(cantidad):
+        assert limitador.esperar_turno()
+        momentos.append(reloj.ahora)
+    return momentos
+
+
+def test_rafaga_inicial_y_luego_espaciado_uniforme(reloj):
+    limitador = LimitadorTasa(60)
+    momentos = turnos(limitador, reloj, 20)
+
+    # Ráfaga de 6 sin esperar; después, una ficha cada 60 / 54 s
+    assert momentos[:6] == [1000.0] * 6
+    separaciones = [b - a for a, b in zip(momentos[6:], momentos[7:])]
+    assert separaciones == pytest.approx([60 / 54] * len(separaciones))
+
+
+def test_nunca_supera_el_cupo_en_una_ventana_de_un_minuto(reloj):
+    limitador = LimitadorTasa(40)
+    momentos = turnos(limitador, reloj, 200)
+
+    for k, inicio in enumerate(momentos):
+        en_ventana = sum(1 for t in momentos[k:] if t < inicio + 60)
+        assert en_ventana <= 40
+
+
+def test_pausa_del_servidor_frena_a_todos_y_vacia_la_cubeta(reloj):
+    limitador = LimitadorTasa(600)
+    limitador.pausar(10)
+
+    # Nadie sale antes de que termine la pausa, y la cubeta quedó vacía: sin ráfaga, una ficha cada 60 / 540 s
+    momentos = turnos(limitador, reloj, 3)
+    assert momentos == pytest.approx([1010 + 1 / 9, 1010 + 2 / 9, 1010 + 3 / 9])
+
+
+def test_turno_despues_del_plazo_corta_sin_dormir(reloj):
+    limitador = LimitadorTasa(60)
+    limitador.pausar(30)
+
+    assert not limitador.esperar_turno(plazo=reloj.ahora + 5)
+    assert reloj.siestas == []
@@ -0,0 +1,368 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from motor_vrp import (
+    restricciones_recorrido, recorrido_factible, resolver_secuencia, cumple_restricciones, costo_camino, camino_exacto, resolver_camino,
+    insertar_esporadicos, insertar_esporadicos_regret, mejorar_patron, zonas_balanceadas, matriz_costo_flota, matriz_tiempo_con_espera, cotas_flota,
+    resolver_flota, semilla_reparable, COSTO_FIJO_VEHICULO, HOLGURA_FLOTA
+)
+
+
+def matriz_camino(clientes, semilla):
+    # Distancias asimétricas entre 'clientes' paradas más inicio y fin auxiliares (a costo 0), como arma la app
+    rng = np.random.default_rng(semilla)
+    xy = rng.uniform(0, 20000, (clientes, 2))
+    d = (np.hypot(*(xy[:, np.newaxis] - xy[np.newaxis]).transpose(2, 0, 1)) * rng.uniform(1.1, 1.5, (clientes, clientes))).astype(np.int64)
+    np.fill_diagonal(d, 0)
+    return np.pad(d, ((0, 2), (0, 2))), clientes, clientes + 1
+
+
+def restricciones_al_azar(clientes, semilla):
+    # Algunas se contradicen (ciclos de precedencias, cadenas contra pines): ahí no hay recorrido válido
+    rng = np.random.default_rng(semilla)
+    elegir = lambda: int(rng.integers(clientes))
+    primero = elegir() if rng.random() < 0.5 else -1
+    ultimo = elegir() if rng.random() < 0.5 else -1
+    cadena = [(elegir(), elegir()) for _ in range(rng.integers(0, 3))]
+    precedencias = [(a, b) for a, b in ((elegir(), elegir()) for _ in range(rng.integers(0, 4))) if a != b]
+    return restricciones_recorrido(primero, ultimo, cadena, precedencias)
+
+
+def optimo_fuerza_bruta(costo, inicio, fin, clientes, restricciones):
+    validos = [list(p) for p in itertools.permutations(clientes) if cumple_restricciones(list(p), restricciones)]
+    return min((costo_camino(costo, inicio, fin, p) for p in validos), default=None)
+
+
+# --- RESTRICCIONES DE UN RECORRIDO ---
+def test_restricciones_descartan_pines_contradictorios():
+    restricciones = restricciones_recorrido(primero=2, ultimo=2, cadena=[(0, 1), (1, 0), (0, 3), (3, 2), (4, 4)])
+
+    assert restricciones["ultimo"] == -1
+    assert restricciones["cadena"] == [(0, 1)]
+
+
+@pytest.mark.parametrize("semilla", range(30))
+def test_recorrido_factible_respeta_las_restricciones(semilla):
+    costo, inicio, fin = matriz_camino(7, semilla)
+    restricciones = restricciones_al_azar(7, semilla)
+
+    ruta = recorrido_factible(costo, inicio, fin, restricciones)
+
+    # El armado voraz puede trabarse, pero nunca devuelve un recorrido inválido
+    if ruta is not None:
+        assert sorted(ruta) == list(range(7))
+        assert cumple_restricciones(ruta, restricciones)
+    if optimo_fuerza_bruta(costo, inicio, fin, list(range(7)), restricciones) is None:
+        assert ruta is None
+
+
+@pytest.mark.parametrize("semilla", range(8))
+def test_resolver_secuencia_aplica_las_restricciones(semilla):
+    costo, inicio, fin = matriz_camino(6, semilla)
+    restricciones = restricciones_al_azar(6, 100 + semilla)
+
+    ruta = resolver_secuencia(costo, inicio, fin, restricciones, segundos_limite=0.5)
+
+    optimo = optimo_fuerza_bruta(costo, inicio, fin, list(range(6)), restricciones)
+    if optimo is None:
+        assert ruta is None
+    else:
+        assert sorted(ruta) == list(range(6))
+        assert cumple_restricciones(ruta, restricciones)
+        assert costo_camino(costo, inicio, fin, ruta) >= optimo
+
+
+# --- MOTOR PROPIO DE UN SOLO RECORRIDO ---
+@pytest.mark.parametrize("semilla", range(40))
+def test_camino_exacto_coincide_con_fuerza_bruta(semilla):
+    clientes = 3 + semilla % 5
+    costo, inicio, fin = matriz_camino(clientes, semilla)
+    restricciones = restricciones_al_azar(clientes, semilla)
+
+    ruta = camino_exacto(costo, inicio, fin, list(range(clientes)), restricciones)
+
+    optimo = optimo_fuerza_bruta(costo, inicio, fin, list(range(clientes)), restricciones)
+    if optimo is None:
+        assert ruta is None
+    else:
+        assert sorted(ruta) == list(range(clientes))
+        assert cumple_restricciones(ruta, restricciones)
+        assert costo_camino(costo, inicio, fin, ruta) == optimo
+
+
+def test_resolver_camino_es_exacto_con_pocas_paradas():
+    costo, inicio, fin = matriz_camino(8, 7)
+    restricciones = restricciones_recorrido(primero=0, ultimo=1, cadena=[(2, 3)], precedencias=[(4, 5), (5, 6)])
+
+    ruta = resolver_camino(costo, inicio, fin, restricciones)
+
+    assert cumple_restricciones(ruta, restricciones)
+    assert costo_camino(costo, inicio, fin, ruta) == optimo_fuerza_bruta(costo, inicio, fin, list(range(8)), restricciones)
+
+
+@pytest.mark.parametrize("restricciones", [
+    restricciones_recorrido(),
+    restricciones_recorrido(primero=0, ultimo=1, cadena=[(2, 3), (3, 4)]),
+    restricciones_recorrido(primero=0, precedencias=[(5, 6), (6, 7), (8, 9)]),
+])
+def test_resolver_camino_con_busqueda_local_respeta_y_mejora_la_semilla(restricciones):
+    costo, inicio, fin = matriz_camino(24, 3)
+
+    ruta = resolver_camino(costo, inicio, fin, restricciones, segundos_limite=1)
+
+    assert sorted(ruta) == list(range(24))
+    assert cumple_restricciones(ruta, restricciones)
+    assert costo_camino(costo, inicio, fin, ruta) <= costo_camino(costo, inicio, fin, recorrido_factible(costo, inicio, fin, restricciones))
+
+
+def patron_al_azar(semilla):
+    # Paradas en un plano con distancia Manhattan; presente[nodo, día] al azar y el destino existe todos los días.
+    # El límite deja entrar a cualquier cliente solo en un auto: ninguna ruta nueva puede pasarse
+    rng = np.random.default_rng(semilla)
+    n = int(rng.integers(20, 60))
+    xy = rng.random((n, 2)) * 20000
+    dist = np.abs(xy[:, np.newaxis, :] - xy[np.newaxis, :, :]).sum(-1).astype(np.int64)
+    dur = dist // 8
+    presente = rng.random((n, int(rng.integers(2, 6)))) < 0.5
+    presente[n - 1] = True
+    nodos = [int(x) for x in rng.permutation(n - 1)]
+    return nodos, presente, dur, dist, n - 1, 300, int(rng.integers(6000, 12000))
+
+
+def tiempos_por_dia(ruta, presente, dur, end_idx, segundos_parada):
+    tiempos = []
+    for dia in range(presente.shape[1]):
+        del_dia = [n for n in ruta if presente[n, dia]] + [end_idx]
+        tiempos.append(sum(segundos_parada + int(dur[a, b]) for a, b in zip(del_dia, del_dia[1:])))
+    return tiempos
+
+
+def distancia_semanal(rutas, presente, dist, end_idx):
+    total = 0
+    for ruta in rutas:
+        for dia in range(presente.shape[1]):
+            del_dia = [n for n in ruta if presente[n, dia]]
+            if del_dia:
+                total += sum(int(dist[a, b]) for a, b in zip(del_dia, del_dia[1:] + [end_idx]))
+    return total
+
+
+def validar_patron(rutas, nodos, presente, dur, end_idx, segundos_parada, tiempo_limite):
+    assert sorted(n for ruta in rutas for n in ruta) == sorted(nodos)
+    for ruta in rutas:
+        assert max(tiempos_por_dia(ruta, presente, dur, end_idx, segundos_parada)) <= tiempo_limite
+
+
+# --- PATRÓN FIJO: INSERCIÓN DE ESPORÁDICOS ---
+def insercion_original(rutas, clientes, presente, dur, dist, end_idx, segundos_parada, tiempo_limite):
+    # El bucle que tenía la app: prueba cada hueco de cada ruta y recalcula todos los días del cliente desde cero
+    rutas = [list(r) for r in rutas]
+    def calcular_tiempo_ruta_en_dia(ruta, dia):
+        del_dia = [n for n in ruta if presente[n, dia]]
+        if not del_dia:
+            return 0, 0
+        t = d = 0
+        for a, b in zip(del_dia, del_dia[1:] + [end_idx]):
+            t += segundos_parada + int(dur[a, b])
+            d += int(dist[a, b])
+        return t, d
+    for cliente in clientes:
+        mejor_r, mejor_pos, menor_extra = -1, -1, float('inf')
+        for r, ruta in enumerate(rutas):
+            for pos in range(len(ruta) + 1):
+                simulada = ruta[:pos] + [cliente] + ruta[pos:]
+                valida, extra = True, 0
+                for dia in np.flatnonzero(presente[cliente]):
+                    t, d = calcular_tiempo_ruta_en_dia(simulada, dia)
+                    if t > tiempo_limite:
+                        valida = False
+                        break
+                    extra += d - calcular_tiempo_ruta_en_dia(ruta, dia)[1]
+                if valida and extra < menor_extra:
+                    mejor_r, mejor_pos, menor_extra = r, pos, extra
+        if mejor_r != -1:
+            rutas[mejor_r].insert(mejor_pos, cliente)
+        else:
+            rutas.append([cliente])
+    return rutas
+
+
+@pytest.mark.parametrize("semilla", range(30))
+def test_insertar_esporadicos_coincide_con_el_bucle_original(semilla):
+    rng = np.random.default_rng(semilla)
+    n = int(rng.integers(10, 40))
+    end_idx = n - 1
+    dur = rng.integers(60, 900, (n, n))
+    dist = rng.integers(100, 9000, (n, n))
+    presente = rng.random((n, int(rng.integers(1, 6)))) < 0.5
+    presente[end_idx] = True
+    nodos = [int(x) for x in rng.permutation(end_idx)]
+    k = int(rng.integers(0, len(nodos) // 2 + 1))
+    base = [nodos[i:min(i + 4, k)] for i in range(0, k, 4)]
+    segundos_parada, tiempo_limite = int(rng.integers(0, 600)), int(rng.integers(1500, 9000))
+
+    rutas = insertar_esporadicos(base, nodos[k:], presente, dur, dist, end_idx, segundos_parada, tiempo_limite)
+
+    assert rutas == insercion_original(base, nodos[k:], presente, dur, dist, end_idx, segundos_parada, tiempo_limite)
+
+
+@pytest.mark.parametrize("semilla", range(10))
+def test_insertar_esporadicos_cubre_a_todos_sin_pasar_el_limite(semilla):
+    nodos, presente, dur, dist, end_idx, segundos_parada, tiempo_limite = patron_al_azar(semilla)
+
+    rutas = insertar_esporadicos([], nodos, presente, dur, dist, end_idx, segundos_parada, tiempo_limite)
+
+    validar_patron(rutas, nodos, presente, dur, end_idx, segundos_parada, tiempo_limite)
+
+
+@pytest.mark.parametrize("k", [2, 3])
+@pytest.mark.parametrize("semilla", range(10))
+def test_regret_cubre_a_todos_sin_pasar_el_limite(semilla, k):
+    nodos, presente, dur, dist, end_idx, segundos_parada, tiempo_limite = patron_al_azar(semilla)
+    # Rutas base ya válidas (las del día pico) y el resto como esporádicos
+    corte = len(nodos) // 3
+    base = insertar_esporadicos([], nodos[:corte], presente, dur, dist, end_idx, segundos_parada, tiempo_limite)
+
+    rutas = insertar_esporadicos_regret(base, nodos[corte:], presente, dur, dist, end_idx, segundos_parada, tiempo_limite, k)
+
+    validar_patron(rutas, nodos, presente, dur, end_idx, segundos_parada, tiempo_limite)
+    assert len(rutas) >= len(base)
+
+
+def test_regret_sin_rutas_base_abre_las_que_hacen_falta():
+    nodos, presente, dur, dist, end_idx, segundos_parada, tiempo_limite = patron_al_azar(11)
+
+    rutas = insertar_esporadicos_regret([], nodos, presente, dur, dist, end_idx, segundos_parada, tiempo_limite)
+
+    validar_patron(rutas, nodos, presente, dur, end_idx, segundos_parada, tiempo_limite)
+
+
+@pytest.mark.parametrize("semilla", range(8))
+def test_mejorar_patron_conserva_clientes_y_jornada(semilla):
+    nodos, presente, dur, dist, end_idx, segundos_parada, tiempo_limite = patron_al_azar(semilla)
+    inicial = insertar_esporadicos([], nodos, presente, dur, dist, end_idx, segundos_parada, tiempo_limite)
+
+    rutas = mejorar_patron(inicial, presente, dur, dist, end_idx, segundos_parada, tiempo_limite, segundos_max=1.0)
+
+    validar_patron(rutas, nodos, presente, dur, end_idx, segundos_parada, tiempo_limite)
+    assert len(rutas) <= len(inicial)
+    # Sin autos eliminados solo hubo reubicaciones, y cada una baja la distancia semanal
+    if len(rutas) == len(inicial):
+        assert distancia_semanal(rutas, presente, dist, end_idx) <= distancia_semanal(inicial, presente, dist, end_idx)
+
+
+# --- ZONAS BALANCEADAS ---
+@pytest.mark.parametrize("n, tam_max", [(10, 3), (57, 10), (200, 64), (300, 25)])
+def test_zonas_cubren_todo_sin_pasar_el_cupo(n, tam_max):
+    rng = np.random.default_rng(n)
+    coords = np.column_stack([rng.uniform(-56.4, -55.9, n), rng.uniform(-35.0, -34.7, n)])
+    codigos = (coords[:, 0] > -56.15).astype(int) + 2 * (coords[:, 1] > -34.85)
+
+    zonas = zonas_balanceadas(coords, tam_max, codigos, 3000.0)
+
+    assert zonas.shape == (n,)
+    assert zonas.min() >= 0 and zonas.max() < -(-n // tam_max)
+    assert np.bincount(zonas).max() <= tam_max
+    assert np.array_equal(zonas, zonas_balanceadas(coords, tam_max, codigos, 3000.0))
+
+
+def test_zonas_separan_grupos_lejanos():
+    rng = np.random.default_rng(0)
+    este = np.column_stack([rng.uniform(-56.20, -56.15, 20), rng.uniform(-34.90, -34.85, 20)])
+    oeste = este - [1.0, 0.0]
+    zonas = zonas_balanceadas(np.vstack([este, oeste]), 20)
+
+    assert len(set(zonas[:20])) == 1 and len(set(zonas[20:])) == 1
+    assert zonas[0] != zonas[20]
+
+
+def test_una_sola_zona_si_entra_todo():
+    assert np.array_equal(zonas_balanceadas([[-56.1, -34.9], [-56.2, -34.8]], 5), [0, 0])
+
+
+def flota_al_azar(clientes, semilla):
+    # Mismo armado que la creación de rutas propias: destino en n, ficticio en n + 1, 15 min por parada
+    rng = np.random.default_rng(semilla)
+    xy = np.vstack([rng.uniform(0, 20000, (clientes, 2)), [[10000, 10000]]])
+    d = (np.hypot(*(xy[:, np.newaxis] - xy[np.newaxis]).transpose(2, 0, 1)) * 1.3).astype(np.int64)
+    dist = np.pad(d, ((0, 1), (0, 1)))
+    dur = np.pad(d // 8, ((0, 1), (0, 1)))
+    dummy_idx, end_idx = clientes + 1, clientes
+    costo = matriz_costo_flota(dist, dummy_idx, end_idx)
+    tiempo = matriz_tiempo_con_espera(dur, 900, [dummy_idx, end_idx])
+    return costo, tiempo, dummy_idx, end_idx
+
+
+def validar_flota(rutas, costo, tiempo, dummy_idx, end_idx, tiempo_max):
+    assert sorted(n for ruta in rutas for n in ruta) == [n for n in range(len(costo)) if n not in (dummy_idx, end_idx)]
+    for ruta in rutas:
+        secuencia = [dummy_idx] + ruta + [end_idx]
+        assert sum(int(tiempo[a, b]) for a, b in zip(secuencia, secuencia[1:])) <= tiempo_max
+
+
+def costo_flota(rutas, costo, dummy_idx, end_idx):
+    return sum(costo_camino(costo, dummy_idx, end_idx, ruta) + COSTO_FIJO_VEHICULO for ruta in rutas)
+
+
+# --- COTAS Y MODELO DE FLOTA ---
+@pytest.mark.parametrize("semilla", range(3))
+def test_cota_inferior_no_pasa_la_flota_que_devuelve_el_modelo(semilla):
+    costo, tiempo, dummy_idx, end_idx = flota_al_azar(25, semilla)
+    tiempo_max = 2 * 3600
+
+    minimo, maximo = cotas_flota(tiempo, dummy_idx, end_idx, tiempo_max)
+    rutas = resolver_flota(costo, tiempo, dummy_idx, end_idx, tiempo_max, segundos_limite=2, segundos_sin_mejora=0.5, cotas=(minimo, maximo))
+
+    validar_flota(rutas, costo, tiempo, dummy_idx, end_idx, tiempo_max)
+    assert 1 <= minimo <= len(rutas) <= maximo + HOLGURA_FLOTA
+
+
+def test_cotas_con_un_cliente_por_auto():
+    # Cada cliente ocupa más de media jornada: no hay dos en el mismo auto y el armado voraz ya es la flota exacta
+    costo, tiempo, dummy_idx, end_idx = flota_al_azar(6, 0)
+    tiempo = tiempo.copy()
+    tiempo[:, :end_idx] += 3 * 3600
+
+    minimo, maximo = cotas_flota(tiempo, dummy_idx, end_idx, 5 * 3600)
+    rutas = resolver_flota(costo, tiempo, dummy_idx, end_idx, 5 * 3600, segundos_limite=1, cotas=(minimo, maximo))
+
+    assert len(rutas) == maximo == 6
+    assert minimo <= 6
+
+
+# --- ARRANQUE EN CALIENTE DESDE UN PLAN CONOCIDO ---
+def test_flota_sembrada_no_empeora_la_semilla():
+    costo, tiempo, dummy_idx, end_idx = flota_al_azar(20, 5)
+    tiempo_max = 3 * 3600
+    previo = resolver_flota(costo, tiempo, dummy_idx, end_idx, tiempo_max, segundos_limite=1)
+
+    assert semilla_reparable(costo, previo, dummy_idx, end_idx, tiempo, tiempo_max)
+    assert not semilla_reparable(costo, previo, dummy_idx, end_idx, tiempo, tiempo_max, num_vehiculos=len(previo) - 1)
+    rutas = resolver_flota(costo, tiempo, dummy_idx, end_idx, tiempo_max, segundos_limite=0.5, rutas_iniciales=previo)
+
+    validar_flota(rutas, costo, tiempo, dummy_idx, end_idx, tiempo_max)
+    assert costo_flota(rutas, costo, dummy_idx, end_idx) <= costo_flota(previo, costo, dummy_idx, end_idx)
+
+
+def test_flota_reparada_suma_los_clientes_nuevos():
+    costo, tiempo, dummy_idx, end_idx = flota_al_azar(20, 6)
+    tiempo_max = 3 * 3600
+    previo = resolver_flota(costo, tiempo, dummy_idx, end_idx, tiempo_max, segundos_limite=1)
+    # Dos clientes del plan anterior "aparecen" como nuevos
+    sin_dos = [[n for n in ruta if n not in (0, 1)] for ruta in previo]
+
+    rutas = resolver_flota(costo, tiempo, dummy_idx, end_idx, tiempo_max, segundos_limite=1, rutas_iniciales=[r for r in sin_dos if r], reparar=True)
+
+    validar_flota(rutas, costo, tiempo, dummy_idx, end_idx, tiempo_max)
+
+
+def test_camino_sembrado_no_empeora_la_semilla():
+    costo, inicio, fin = matriz_camino(24, 9)
+    semilla = [int(x) for x in np.random.default_rng(9).permutation(24)]
+
+    ruta = resolver_camino(costo, inicio, fin, segundos_limite=0.5, rutas_iniciales=[semilla])
+
+    assert sorted(ruta) == list(range(24))
+    assert costo_camino(costo, inicio, fin, ruta) <= costo_camino(costo, inicio, fin, semilla)
@@ -0,0 +1,44 @@
+from planillas import BYTES_MUESTRA_CSV, leer_planilla
+
+ENCABEZADO = "Orden,Día,Ruta,Lugar,Coordenadas\n"
+FILA = '{n},Lunes,R1,Lugar {n},"-34.90, -56.16"\n'
+
+
+def csv_con_lugar_en(posicion, lugar, codificacion="utf-8"):
+    # Filas de relleno y una última fila con 'lugar' empezando justo en el byte 'posicion'
+    texto = ENCABEZADO
+    n = 0
+    while len((texto + FILA.format(n=n)).encode(codificacion)) < posicion - 100:
+        texto += FILA.format(n=n)
+        n += 1
+    inicio = f'{n},Lunes,R1,'
+    relleno = posicion - len((texto + inicio).encode(codificacion))
+    return (texto + inicio + "x" * relleno + lugar + ',"-34.91, -56.17"\n').encode(codificacion)
+
+
+def test_csv_utf8_con_caracter_multibyte_en_el_borde_de_la_muestra():
+    # 'Pe' termina justo antes del borde: la 'ñ' (2 bytes en UTF-8) queda partida por la muestra
+    contenido = csv_con_lugar_en(BYTES_MUESTRA_CSV - 3, "Peñarol")
+    assert contenido[:BYTES_MUESTRA_CSV].endswith("Pe".encode() + "ñ".encode()[:1])
+
+    df = leer_planilla(contenido, "plan.csv")
+
+    assert list(df.columns) == ["Orden", "Día", "Ruta", "Lugar", "Coordenadas"]
+    assert df["Lugar"].iloc[-1].endswith("Peñarol")
+    assert not df["Lugar"].str.contains("Ã").any()
+
+
+def test_csv_latin1_sigue_funcionando():
+    df = leer_planilla(csv_con_lugar_en(200, "Peñarol", "latin-1"), "plan.csv")
+
+    assert "Día" in df.columns
+    assert df["Lugar"].iloc[-1].endswith("Peñarol")
+
+
+def test_csv_con_punto_y_coma_y_bom():
+    contenido = "﻿Día;Ruta;Lugar;Coordenadas;Otra\nLunes;R1;Peñarol;-34.9, -56.1;x\n".encode("utf-8")
+
+    df = leer_planilla(contenido, "PLAN.CSV")
+
+    assert list(df.columns) == ["Día", "Ruta", "Lugar", "Coordenadas"]
+    assert df["Coordenadas"].iloc[0] == "-34.9, -56.1"
@@ -0,0 +1,29 @@
+import numpy as np
+
+from red_ruteo import ProveedorOffline, matriz_haversine_metros, obtener_matriz_masiva
+
+
+def test_matriz_offline_es_linea_recta_con_desvio(puntos):
+    proveedor = ProveedorOffline(factor_desvio=1.3, velocidad_kmh=36.0)
+    dist, dur, err = obtener_matriz_masiva(puntos, proveedor)
+
+    assert err is None
+    recta = matriz_haversine_metros(np.array(puntos), np.array(puntos))
+    assert dist.shape == dur.shape == (len(puntos), len(puntos))
+    assert np.allclose(dist, recta * 1.3, atol=1)
+    assert np.allclose(dur, recta * 1.3 / 10.0, atol=1)
+    assert np.all(np.diag(dist) == 0)
+    assert dist[0, 4] == 0
+
+
+def test_matriz_offline_por_teselas_coincide_con_la_directa(puntos):
+    directa = ProveedorOffline()
+    por_teselas = ProveedorOffline()
+    por_teselas.limites = {"max_locaciones": 2, "max_celdas": 4}
+
+    dist, dur, err = obtener_matriz_masiva(puntos, directa)
+    dist_t, dur_t, err_t = obtener_matriz_masiva(puntos, por_teselas)
+
+    assert err is None and err_t is None
+    assert np.array_equal(dist, dist_t)
+    assert np.array_equal(dur, dur_t)
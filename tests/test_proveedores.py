@@ -0,0 +1,102 @@
+import time
+
+import numpy as np
+
+from red_ruteo import ProveedorORS, ProveedorOSRM, ProveedorConRespaldo, LimitadorTasa, ubicar_way_points, obtener_matriz_masiva, obtener_trazados_masivos, sanear_matriz, ERROR_PLAZO
+
+LIMITES_CHICOS = {"max_locaciones": 3, "max_celdas": 9}
+
+
+def esperada(servidor, puntos):
+    todos = list(range(len(puntos)))
+    dist, dur = servidor.matriz(puntos, todos, todos)
+    return sanear_matriz(dist), sanear_matriz(dur)
+
+
+def proveedor_osrm(servidor, **kwargs):
+    return ProveedorOSRM(servidor.url, **kwargs)
+
+
+def proveedor_ors(servidor, **kwargs):
+    return ProveedorORS(servidor.url, {"Content-Type": "application/json"}, **kwargs)
+
+
+def test_matriz_osrm_por_teselas(servidor_ruteo, puntos):
+    dist, dur, err = obtener_matriz_masiva(puntos, proveedor_osrm(servidor_ruteo, limites=LIMITES_CHICOS))
+
+    assert err is None
+    dist_ok, dur_ok = esperada(servidor_ruteo, puntos)
+    assert np.abs(dist - dist_ok).max() <= 1
+    assert np.abs(dur - dur_ok).max() <= 1
+    assert len(servidor_ruteo.peticiones) > 1
+    assert all(metodo == "GET" and ruta.startswith("/table/v1/driving/") for metodo, ruta in servidor_ruteo.peticiones)
+
+
+def test_matriz_ors_por_teselas(servidor_ruteo, puntos):
+    dist, dur, err = obtener_matriz_masiva(puntos, proveedor_ors(servidor_ruteo, limites=LIMITES_CHICOS))
+
+    assert err is None
+    dist_ok, dur_ok = esperada(servidor_ruteo, puntos)
+    assert np.abs(dist - dist_ok).max() <= 1
+    assert np.abs(dur - dur_ok).max() <= 1
+    assert all(metodo == "POST" and ruta == "/v2/matrix/driving-car" for metodo, ruta in servidor_ruteo.peticiones)
+
+
+def test_trazado_osrm_y_ors_coinciden(servidor_ruteo, puntos):
+    rutas = [puntos[:4], puntos[2:]]
+    trazados_osrm = obtener_trazados_masivos(rutas, proveedor_osrm(servidor_ruteo))
+    trazados_ors = obtener_trazados_masivos(rutas, proveedor_ors(servidor_ruteo, clave_cache="ors-local"))
+
+    for coords, (osrm, err_osrm), (ors, err_ors) in zip(rutas, trazados_osrm, trazados_ors):
+        assert err_osrm is None and err_ors is None
+        for geojson in (osrm, ors):
+            feature = geojson["features"][0]
+            assert len(feature["properties"]["segments"]) == len(coords) - 1
+            assert feature["geometry"]["coordinates"][0] == coords[0]
+            assert feature["geometry"]["coordinates"][-1] == coords[-1]
+        assert np.isclose(osrm["features"][0]["properties"]["summary"]["distance"], ors["features"][0]["properties"]["summary"]["distance"])
+
+
+def test_ubicar_way_points_sigue_el_orden_de_las_paradas():
+    geom = [[0, 0], [1, 0], [2, 0], [1, 0], [0, 0]]
+    # La vuelta pasa otra vez por (1, 0): la búsqueda avanza y no retrocede al primer paso
+    assert ubicar_way_points(geom, [[0, 0], [2, 0], [1, 0], [0, 0]]) == [0, 2, 3, 4]
+    assert ubicar_way_points([], [[0, 0]]) == []
+
+
+def test_429_con_retry_after_se_espera_y_reintenta(servidor_ruteo, puntos):
+    servidor_ruteo.responder_429(1, "0.3")
+    proveedor = proveedor_ors(servidor_ruteo, limitador_matriz=LimitadorTasa(600))
+
+    inicio = time.monotonic()
+    data, err = proveedor.pedir_matriz({"locations": puntos[:3]})
+
+    assert err is None
+    assert len(data["distances"]) == 3
+    assert time.monotonic() - inicio >= 0.3
+    assert len(servidor_ruteo.peticiones) == 2
+
+
+def test_429_mas_alla_del_plazo_corta_sin_esperar(servidor_ruteo, puntos):
+    servidor_ruteo.responder_429(1, "30")
+    proveedor = proveedor_osrm(servidor_ruteo)
+    proveedor.iniciar_plazo(2)
+
+    inicio = time.monotonic()
+    data, err = proveedor.pedir_matriz({"locations": puntos[:3]})
+
+    assert data is None and err == ERROR_PLAZO
+    assert time.monotonic() - inicio < 2
+
+
+def test_respaldo_conserva_avisos_al_reiniciar_el_plazo(servidor_ruteo, puntos):
+    # Cada fase del plan (matrices, trazado) reinicia el plazo de red sin perder los avisos de la anterior
+    servidor_ruteo.responder_429(1, "30")
+    proveedor = ProveedorConRespaldo(proveedor_osrm(servidor_ruteo))
+    proveedor.iniciar_plazo(2)
+
+    data, err = proveedor.pedir_matriz({"locations": puntos[:3]})
+    proveedor.iniciar_plazo(2)
+
+    assert err is None and data["estimado"]
+    assert proveedor.avisos == {ERROR_PLAZO}
@@ -0,0 +1,80 @@
+import email.utils
+import time
+
+import pytest
+
+from red_ruteo import Cortocircuito, crear_sesion_http, enviar_con_reintento, segundos_desde_cabeceras, ERROR_CIRCUITO, ERROR_REINTENTOS, REINTENTOS_MAX
+
+
+@pytest.mark.parametrize("cabeceras, esperado", [
+    ({"Retry-After": "7"}, 7.0),
+    ({"Retry-After": "0.5"}, 0.5),
+    ({"Retry-After": "-3"}, 0.0),
+    ({"x-ratelimit-remaining": "0", "x-ratelimit-reset": "12"}, 12.0),
+    ({"x-ratelimit-remaining": "3", "x-ratelimit-reset": "12"}, None),
+    ({"x-ratelimit-remaining": "0", "x-ratelimit-reset": "pronto"}, None),
+    ({"Retry-After": "cuando pueda"}, None),
+    ({}, None),
+])
+def test_cabeceras_en_segundos(cabeceras, esperado):
+    assert segundos_desde_cabeceras(cabeceras) == esperado
+
+
+def test_retry_after_como_fecha_http():
+    fecha = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert segundos_desde_cabeceras({"Retry-After": fecha}) == pytest.approx(30, abs=2)
+
+
+@pytest.mark.parametrize("escala", [1, 1000])
+def test_reinicio_del_cupo_como_marca_de_tiempo(escala):
+    # Época en segundos o en milisegundos: se devuelve lo que falta hasta el reinicio
+    reinicio = (time.time() + 20) * escala
+    cabeceras = {"x-ratelimit-remaining": "0", "x-ratelimit-reset": str(reinicio)}
+    assert segundos_desde_cabeceras(cabeceras) == pytest.approx(20, abs=2)
+
+
+def test_cortocircuito_abre_tras_fallos_seguidos_y_cierra_al_enfriarse(reloj):
+    circuito = Cortocircuito(umbral=3, enfriamiento_segundos=120)
+
+    circuito.registrar_fallo()
+    circuito.registrar_fallo()
+    circuito.registrar_exito()
+    circuito.registrar_fallo()
+    circuito.registrar_fallo()
+    # Un éxito en medio reinicia la cuenta: dos fallos seguidos no alcanzan
+    assert not circuito.abierto()
+
+    circuito.registrar_fallo()
+    assert circuito.abierto()
+    reloj.sleep(119)
+    assert circuito.abierto()
+    reloj.sleep(1)
+    assert not circuito.abierto()
+
+
+def test_5xx_se_reintenta_con_la_espera_del_servidor(servidor_ruteo):
+    servidor_ruteo.forzar(2, 503, cabeceras={"Retry-After": "0"})
+
+    data, err = enviar_con_reintento(crear_sesion_http(), "POST", f"{servidor_ruteo.url}/v2/matrix/driving-car", json={"locations": [[0, 0], [0, 0.01]]})
+
+    assert err is None and len(data["distances"]) == 2
+    assert len(servidor_ruteo.peticiones) == 3
+
+
+def test_cupo_agotado_no_se_reintenta(servidor_ruteo):
+    servidor_ruteo.forzar(1, 403, {"error": "Quota exceeded"})
+
+    data, err = enviar_con_reintento(crear_sesion_http(), "POST", f"{servidor_ruteo.url}/v2/matrix/driving-car", json={"locations": [[0, 0]]})
+
+    assert data is None and err == "QUOTA_EXCEEDED"
+    assert len(servidor_ruteo.peticiones) == 1
+
+
+def test_circuito_abierto_responde_sin_consultar(servidor_ruteo):
+    servidor_ruteo.forzar(REINTENTOS_MAX, 503, cabeceras={"Retry-After": "0"})
+    circuito = Cortocircuito(umbral=1)
+    url = f"{servidor_ruteo.url}/v2/matrix/driving-car"
+
+    assert enviar_con_reintento(crear_sesion_http(), "POST", url, cortocircuito=circuito, json={"locations": [[0, 0]]}) == (None, ERROR_REINTENTOS)
+    assert enviar_con_reintento(crear_sesion_http(), "POST", url, cortocircuito=circuito, json={"locations": [[0, 0]]}) == (None, ERROR_CIRCUITO)
+    assert len(servidor_ruteo.peticiones) == REINTENTOS_MAX